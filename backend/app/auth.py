@@ -1,21 +1,22 @@
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from . import models, schemas
-from .database import get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import models, schemas, user_cache
+from .passwords import pwd_context
+from .database import get_async_db
 
 # Security configuration
 SECRET_KEY = "your-secret-key-keep-it-secret"  # In production, use environment variable
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Blocking helpers for scripts; request handlers use the async functions in passwords.py
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
@@ -32,7 +33,7 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -41,12 +42,27 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
-        if email is None:
+        user_id = payload.get("uid")  # Absent from tokens issued before the claim was added
+        if email is None or (user_id is not None and not isinstance(user_id, int)):
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    
-    user = db.query(models.User).filter(models.User.email == email).first()
+
+    key = user_cache.cache_key(user_id, email)
+    user = await user_cache.get_user(key)
     if user is None:
+        if user_id is not None:
+            db_user = await db.get(models.User, user_id)
+        else:
+            result = await db.execute(select(models.User).where(models.User.email == email))
+            db_user = result.scalars().first()
+        if db_user is None:
+            raise credentials_exception
+        user = user_cache.CurrentUser.from_model(db_user)
+        if user.is_active:
+            await user_cache.set_user(key, user)
+
+    # A changed email or a deactivated account invalidates tokens issued before the change
+    if user.email != email or not user.is_active:
         raise credentials_exception
     return user
@@ -0,0 +1,205 @@
+"""
+Content-addressed storage for attachments and chat files.
+
+Every uploaded file is stored once under BLOB_STORE_DIR, named after its
+SHA-256, however many emails or messages carry it; the inbox and sent copies
+of an email, forwards and repeated sends of the same file all share one blob.
+Each blob has a row in `blobs` whose refcount the database keeps in step with
+the attachments and chat messages that reference it (triggers from migration
+0008), so deleting emails never touches files directly.
+
+Storing a file registers its blob before anything references it: the upsert
+stamps orphaned_at if the refcount is still 0, so the collector leaves it alone
+for BLOB_GC_GRACE_SECONDS while the uploading request commits its rows. The
+collector deletes files of blobs that have stayed unreferenced past that grace
+period, claiming them with FOR UPDATE SKIP LOCKED so several processes can run it.
+Its DELETE checks the same conditions again and only the files of the rows it
+returned are removed, so a blob referenced in the meantime survives.
+
+Files are written and hashed on a worker thread, and the registration runs in
+its own short transaction on that thread; callers store uploads before they
+start writing their own rows, so on SQLite the two never wait on each other.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import timedelta
+from pathlib import Path
+from typing import Iterable, List, Optional
+from uuid import uuid4
+from fastapi import UploadFile
+from sqlalchemy import case, delete, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from . import models, metrics, uploads
+from .config import get_settings
+from .database import SessionLocal, engine
+from .outbox import utcnow
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+BLOB_DIR = Path(settings.BLOB_STORE_DIR)
+TMP_DIR = BLOB_DIR / "tmp"
+
+STORED = metrics.counter("blob_stored_total", "Uploads stored as a new blob")
+DEDUP_HITS = metrics.counter("blob_dedup_hits_total", "Uploads whose content was already stored")
+COLLECTED = metrics.counter("blobs_collected_total", "Unreferenced blobs deleted by the collector")
+BYTES_FREED = metrics.counter("blob_bytes_freed_total", "Bytes freed by the blob collector")
+
+_collector: Optional[asyncio.Task] = None
+
+def blob_path(sha256: str) -> Path:
+    # Two levels of fan-out keep directories small
+    return BLOB_DIR / sha256[:2] / sha256[2:4] / sha256
+
+def _register(sha256: str, size: int):
+    """Upsert the blob row; an unreferenced blob gets a fresh orphaned_at so the collector waits for our reference"""
+    table = models.Blob.__table__
+    dialect = postgresql if engine.dialect.name == "postgresql" else sqlite
+    stmt = dialect.insert(table).values(sha256=sha256, size=size, refcount=0, orphaned_at=utcnow())
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.sha256],
+        set_={"orphaned_at": case((table.c.refcount == 0, stmt.excluded.orphaned_at), else_=table.c.orphaned_at)}
+    )
+    with engine.begin() as conn:
+        conn.execute(stmt)
+
+def store_file(source, max_bytes: Optional[int] = None) -> uploads.StoredFile:
+    """Copy a binary file object into the store (blocking); returns the blob's path, size and hash"""
+    TMP_DIR.mkdir(parents=True, exist_ok=True)
+    temp = TMP_DIR / uuid4().hex
+    stored = uploads.copy_stream(source, temp, max_bytes)
+    try:
+        _register(stored.sha256, stored.size)
+        path = blob_path(stored.sha256)
+        if path.exists():
+            DEDUP_HITS.inc()
+            temp.unlink()
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(temp, path)
+            STORED.inc()
+    except BaseException:
+        temp.unlink(missing_ok=True)
+        raise
+    return uploads.StoredFile(path, stored.size, stored.sha256)
+
+async def store_upload(upload: UploadFile, max_bytes: Optional[int] = None) -> uploads.StoredFile:
+    """Store an uploaded file on a worker thread. Call before adding rows that reference it."""
+    max_bytes = uploads.check_upload(upload, max_bytes)
+    return await asyncio.to_thread(store_file, upload.file, max_bytes)
+
+def legacy_paths(attachments: Iterable) -> List[str]:
+    """File paths of attachments stored outside the blob store (before it existed)"""
+    return [
+        attachment.file_path for attachment in attachments
+        if attachment.file_path
+        and not (attachment.content_hash and Path(attachment.file_path) == blob_path(attachment.content_hash))
+    ]
+
+def remove_unreferenced_files(paths: Iterable[str]):
+    """
+    Delete legacy files that no attachment row points at any more (blocking).
+    Run after the deleting transaction commits; blob files are left to the collector.
+    """
+    paths = sorted(set(paths))
+    if not paths:
+        return
+    referenced = set()
+    db = SessionLocal()
+    try:
+        for i in range(0, len(paths), 500):
+            referenced.update(db.scalars(
+                select(models.Attachment.file_path).where(models.Attachment.file_path.in_(paths[i:i + 500]))
+            ))
+    finally:
+        db.close()
+    for path in paths:
+        if path in referenced:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Error deleting attachment file {path}: {str(e)}")
+
+def _collect_batch(db: Session, limit: int) -> int:
+    cutoff = utcnow() - timedelta(seconds=settings.BLOB_GC_GRACE_SECONDS)
+    collectable = (models.Blob.refcount == 0, models.Blob.orphaned_at < cutoff)
+    candidates = db.execute(
+        select(models.Blob.sha256)
+        .where(*collectable)
+        .order_by(models.Blob.orphaned_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    ).scalars().all()
+    if not candidates:
+        return 0
+    # Checked again as the rows are deleted: a blob referenced or stored again
+    # since the select keeps its row and its file
+    rows = db.execute(
+        delete(models.Blob)
+        .where(models.Blob.sha256.in_(candidates), *collectable)
+        .returning(models.Blob.sha256, models.Blob.size)
+        .execution_options(synchronize_session=False)
+    ).all()
+    # Files go before the commit: if we die in between, the rows are simply collected again
+    for sha256, size in rows:
+        blob_path(sha256).unlink(missing_ok=True)
+    db.commit()
+    COLLECTED.inc(len(rows))
+    BYTES_FREED.inc(sum(size or 0 for _, size in rows))
+    return len(candidates)
+
+def _sweep_temp_files():
+    # Leftovers from uploads interrupted between copying and placing the file
+    cutoff = time.time() - settings.BLOB_GC_GRACE_SECONDS
+    if TMP_DIR.exists():
+        for temp in TMP_DIR.iterdir():
+            try:
+                if temp.stat().st_mtime < cutoff:
+                    temp.unlink()
+            except OSError:
+                pass
+
+def collect_garbage() -> int:
+    """Delete blobs unreferenced for longer than the grace period (blocking); returns how many"""
+    total = 0
+    db = SessionLocal()
+    try:
+        while True:
+            collected = _collect_batch(db, settings.BLOB_GC_BATCH_SIZE)
+            total += collected
+            if collected < settings.BLOB_GC_BATCH_SIZE:
+                break
+    finally:
+        db.close()
+    _sweep_temp_files()
+    return total
+
+async def _collect_periodically():
+    while True:
+        try:
+            collected = await asyncio.to_thread(collect_garbage)
+            if collected:
+                logger.info(f"Collected {collected} unreferenced blobs")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error in blob collector: {str(e)}")
+        await asyncio.sleep(settings.BLOB_GC_INTERVAL_SECONDS)
+
+def start():
+    global _collector
+    _collector = asyncio.create_task(_collect_periodically())
+
+async def stop():
+    global _collector
+    if _collector is not None:
+        _collector.cancel()
+        await asyncio.gather(_collector, return_exceptions=True)
+        _collector = None
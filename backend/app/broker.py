@@ -0,0 +1,333 @@
+"""
+Pub/sub and presence shared by every worker process.
+
+Websocket rooms (websocket.py) and the per-user notification channel
+(notifications.py) hold their connections in the process that accepted them.
+To reach a user connected to another worker, everything they send goes through
+a broker channel instead: each process subscribes to the channels of the rooms
+and users it has connections for and delivers what arrives to them, including
+its own messages, so every process sees a channel's messages in the same order.
+
+Besides pub/sub the broker keeps, per room:
+- presence: who is connected anywhere, with a little data each (name, media
+  state). Every process refreshes its own members every third of
+  BROKER_PRESENCE_TTL_SECONDS, so members of a crashed worker expire;
+- a sequence: every room event is published under the next of a per-room
+  series of numbers, so clients can tell which events they have seen;
+- a bounded history of the events that make up room state (chat, polls), from
+  which a process opening a room that is already active elsewhere rebuilds it;
+- a bounded replay log of all recent events, from which the same process can
+  bring a reconnecting client up to date without a full snapshot.
+Numbering, logging and publishing an event happen atomically, so the numbers
+follow the order in which subscribers receive the events. A sequence starts
+from the current time in microseconds, so numbers keep growing when a room is
+emptied and opened again, and a client's last number from an earlier session
+always predates the log.
+
+BROKER_URL selects the backend: empty (or memory://) keeps everything in this
+process, which is what tests and single-worker deployments use; redis://...
+shares it through Redis, which needs the redis package.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+from . import frames, metrics
+from .config import get_settings
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+Handler = Callable[[Dict], Awaitable[None]]
+
+PUBLISHED = metrics.counter("broker_messages_published_total", "Messages published to the broker")
+RECEIVED = metrics.counter("broker_messages_received_total", "Broker messages delivered to a local subscriber")
+HANDLER_ERRORS = metrics.counter("broker_handler_errors_total", "Broker messages whose local handler failed")
+
+class Broker:
+    """Backend-independent part: local subscriptions and presence heartbeats"""
+
+    def __init__(self, presence_ttl: float):
+        self.presence_ttl = presence_ttl
+        self._handlers: Dict[str, Handler] = {}
+        self._members: Dict[Tuple[str, str], Dict] = {}  # members joined through this process
+        self._heartbeat: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._heartbeat = asyncio.create_task(self._refresh_presence())
+
+    async def stop(self):
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            await asyncio.gather(self._heartbeat, return_exceptions=True)
+            self._heartbeat = None
+        for room, member_id in list(self._members):
+            await self.leave(room, member_id)
+
+    async def _dispatch(self, channel: str, message: Dict):
+        handler = self._handlers.get(channel)
+        if handler is None:
+            return
+        RECEIVED.inc()
+        try:
+            await handler(message)
+        except Exception as e:
+            HANDLER_ERRORS.inc()
+            logger.error(f"Error handling broker message on {channel}: {str(e)}")
+
+    async def subscribe(self, channel: str, handler: Handler):
+        self._handlers[channel] = handler
+
+    async def unsubscribe(self, channel: str):
+        self._handlers.pop(channel, None)
+
+    async def publish(self, channel: str, message: Dict):
+        raise NotImplementedError
+
+    # Presence
+
+    async def join(self, room: str, member_id: str, data: Dict):
+        """Record a member connected through this process (again, to update its data)"""
+        self._members[(room, member_id)] = data
+        await self._set_member(room, member_id, data)
+
+    async def leave(self, room: str, member_id: str):
+        self._members.pop((room, member_id), None)
+        await self._remove_member(room, member_id)
+
+    async def members(self, room: str) -> Dict[str, Dict]:
+        raise NotImplementedError
+
+    async def _set_member(self, room: str, member_id: str, data: Dict):
+        raise NotImplementedError
+
+    async def _remove_member(self, room: str, member_id: str):
+        raise NotImplementedError
+
+    async def _refresh_presence(self):
+        while True:
+            await asyncio.sleep(self.presence_ttl / 3)
+            for (room, member_id), data in list(self._members.items()):
+                try:
+                    await self._set_member(room, member_id, data)
+                except Exception as e:
+                    logger.error(f"Error refreshing presence in {room}: {str(e)}")
+
+    # Sequenced room events
+
+    async def publish_event(self, channel: str, event: Dict, history_size: int, replay_size: int):
+        """
+        Publish an event under the channel's next sequence number, which is set
+        as event["seq"] for subscribers. It goes into the replay log, and into
+        the history too unless history_size is 0.
+        """
+        raise NotImplementedError
+
+    async def snapshot(self, channel: str) -> Tuple[int, List[Dict], List[Dict]]:
+        """The latest sequence number and the history and replay logs as of it"""
+        raise NotImplementedError
+
+    async def forget(self, channel: str):
+        """Drop the sequence and logs of a channel"""
+        raise NotImplementedError
+
+class MemoryBroker(Broker):
+    """Single-process broker; messages are handed to the subscriber directly"""
+
+    def __init__(self, presence_ttl: float):
+        super().__init__(presence_ttl)
+        self._presence: Dict[str, Dict[str, Tuple[float, Dict]]] = {}
+        self._sequences: Dict[str, int] = {}
+        self._history: Dict[str, Deque[Dict]] = {}
+        self._replay: Dict[str, Deque[Dict]] = {}
+
+    async def publish(self, channel: str, message: Dict):
+        PUBLISHED.inc()
+        await self._dispatch(channel, message)
+
+    async def members(self, room: str) -> Dict[str, Dict]:
+        now = time.monotonic()
+        return {
+            member_id: data
+            for member_id, (expires_at, data) in self._presence.get(room, {}).items()
+            if expires_at > now
+        }
+
+    async def _set_member(self, room: str, member_id: str, data: Dict):
+        self._presence.setdefault(room, {})[member_id] = (time.monotonic() + self.presence_ttl, data)
+
+    async def _remove_member(self, room: str, member_id: str):
+        members = self._presence.get(room)
+        if members is not None:
+            members.pop(member_id, None)
+            if not members:
+                del self._presence[room]
+
+    @staticmethod
+    def _append(logs: Dict[str, Deque[Dict]], channel: str, event: Dict, maxlen: int):
+        log = logs.get(channel)
+        if log is None or log.maxlen != maxlen:
+            log = logs[channel] = deque(log or (), maxlen=maxlen)
+        log.append(event)
+
+    async def publish_event(self, channel: str, event: Dict, history_size: int, replay_size: int):
+        # Nothing is awaited before the dispatch, so numbering and delivery order agree
+        seq = self._sequences.get(channel) or time.time_ns() // 1000
+        self._sequences[channel] = event["seq"] = seq + 1
+        self._append(self._replay, channel, event, replay_size)
+        if history_size:
+            self._append(self._history, channel, event, history_size)
+        await self.publish(channel, event)
+
+    async def snapshot(self, channel: str) -> Tuple[int, List[Dict], List[Dict]]:
+        return (
+            self._sequences.get(channel, 0),
+            list(self._history.get(channel, ())),
+            list(self._replay.get(channel, ()))
+        )
+
+    async def forget(self, channel: str):
+        self._sequences.pop(channel, None)
+        self._history.pop(channel, None)
+        self._replay.pop(channel, None)
+
+# KEYS: sequence, replay log, history, channel
+# ARGV: event JSON without "seq", replay size, history size (0 to skip), log TTL
+PUBLISH_EVENT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    local now = redis.call('TIME')
+    redis.call('SET', KEYS[1], now[1] .. string.format('%06d', now[2]))
+end
+local seq = redis.call('INCR', KEYS[1])
+local event = '{"seq":' .. string.format('%d', seq) .. ',' .. string.sub(ARGV[1], 2)
+redis.call('RPUSH', KEYS[2], event)
+redis.call('LTRIM', KEYS[2], -tonumber(ARGV[2]), -1)
+if tonumber(ARGV[3]) > 0 then
+    redis.call('RPUSH', KEYS[3], event)
+    redis.call('LTRIM', KEYS[3], -tonumber(ARGV[3]), -1)
+    redis.call('EXPIRE', KEYS[3], ARGV[4])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+redis.call('PUBLISH', KEYS[4], event)
+return seq
+"""
+
+class RedisBroker(Broker):
+    """
+    Broker shared through Redis pub/sub. Presence is a hash per room whose
+    fields carry their own expiry; logs are capped lists. Room events are
+    numbered, logged and published by one script, which Redis runs atomically.
+    """
+    prefix = "broker:"
+
+    def __init__(self, url: str, presence_ttl: float, log_ttl: int):
+        super().__init__(presence_ttl)
+        import redis.asyncio as aioredis
+        self.log_ttl = log_ttl
+        self._redis = aioredis.from_url(url)
+        self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        self._publish_event = self._redis.register_script(PUBLISH_EVENT)
+        self._reader: Optional[asyncio.Task] = None
+
+    async def start(self):
+        await super().start()
+        self._reader = asyncio.create_task(self._read())
+
+    async def stop(self):
+        await super().stop()
+        if self._reader is not None:
+            self._reader.cancel()
+            await asyncio.gather(self._reader, return_exceptions=True)
+            self._reader = None
+        await self._pubsub.close()
+        await self._redis.close()
+
+    async def _read(self):
+        # One reader per process, so each channel's messages are handled in order
+        while True:
+            try:
+                message = await self._pubsub.get_message(timeout=1.0)
+                if message is None:
+                    continue
+                await self._dispatch(message["channel"].decode()[len(self.prefix):], frames.loads(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error reading from the broker: {str(e)}")
+                await asyncio.sleep(1)
+
+    async def subscribe(self, channel: str, handler: Handler):
+        await super().subscribe(channel, handler)
+        await self._pubsub.subscribe(self.prefix + channel)
+
+    async def unsubscribe(self, channel: str):
+        await super().unsubscribe(channel)
+        await self._pubsub.unsubscribe(self.prefix + channel)
+
+    async def publish(self, channel: str, message: Dict):
+        PUBLISHED.inc()
+        await self._redis.publish(self.prefix + channel, frames.dumps(message))
+
+    def _presence_key(self, room: str) -> str:
+        return f"{self.prefix}presence:{room}"
+
+    async def members(self, room: str) -> Dict[str, Dict]:
+        now = time.time()
+        members, expired = {}, []
+        for member_id, raw in (await self._redis.hgetall(self._presence_key(room))).items():
+            entry = frames.loads(raw)
+            if entry["expires_at"] > now:
+                members[member_id.decode()] = entry["data"]
+            else:
+                expired.append(member_id)
+        if expired:
+            await self._redis.hdel(self._presence_key(room), *expired)
+        return members
+
+    async def _set_member(self, room: str, member_id: str, data: Dict):
+        key = self._presence_key(room)
+        entry = frames.dumps({"expires_at": time.time() + self.presence_ttl, "data": data})
+        async with self._redis.pipeline(transaction=True) as pipe:
+            await pipe.hset(key, member_id, entry).expire(key, int(self.presence_ttl) + 1).execute()
+
+    async def _remove_member(self, room: str, member_id: str):
+        await self._redis.hdel(self._presence_key(room), member_id)
+
+    def _event_keys(self, channel: str) -> List[str]:
+        return [
+            f"{self.prefix}seq:{channel}",
+            f"{self.prefix}replay:{channel}",
+            f"{self.prefix}log:{channel}",
+        ]
+
+    async def publish_event(self, channel: str, event: Dict, history_size: int, replay_size: int):
+        PUBLISHED.inc()
+        await self._publish_event(
+            keys=self._event_keys(channel) + [self.prefix + channel],
+            args=[frames.dumps(event), replay_size, history_size, self.log_ttl]
+        )
+
+    async def snapshot(self, channel: str) -> Tuple[int, List[Dict], List[Dict]]:
+        seq_key, replay_key, history_key = self._event_keys(channel)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            seq, history, replay = await pipe.get(seq_key).lrange(history_key, 0, -1).lrange(replay_key, 0, -1).execute()
+        return (
+            int(seq or 0),
+            [frames.loads(raw) for raw in history],
+            [frames.loads(raw) for raw in replay]
+        )
+
+    async def forget(self, channel: str):
+        await self._redis.delete(*self._event_keys(channel))
+
+def create_broker(url: str) -> Broker:
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBroker(url, settings.BROKER_PRESENCE_TTL_SECONDS, settings.BROKER_LOG_TTL_SECONDS)
+    if url in ("", "memory://"):
+        return MemoryBroker(settings.BROKER_PRESENCE_TTL_SECONDS)
+    raise ValueError(f"Unsupported BROKER_URL: {url}")
+
+broker = create_broker(settings.BROKER_URL)
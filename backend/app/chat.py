@@ -1,16 +1,23 @@
-from typing import Dict, Set, List
+from typing import Deque, Dict
+from collections import deque
 from fastapi import WebSocket
-import json
 from datetime import datetime
-import base64
 from pathlib import Path
 import os
+from . import frames
+from .outbound import Outbound
 
 # Create chat uploads directory
 CHAT_UPLOAD_DIR = Path("chat_uploads")
 CHAT_UPLOAD_DIR.mkdir(exist_ok=True)
 
+# Messages kept per room
+HISTORY_SIZE = 100
+
 class ChatMessage:
+    # Rooms keep up to HISTORY_SIZE of these each; slots spare a dict per message
+    __slots__ = ("type", "user_id", "content", "timestamp", "file_data", "reply_to", "reactions", "is_rich_text")
+
     def __init__(
         self,
         message_type: str,
@@ -28,7 +35,7 @@ class ChatMessage:
         self.timestamp = timestamp or datetime.now().isoformat()
         self.file_data = file_data
         self.reply_to = reply_to
-        self.reactions = reactions or {}
+        self.reactions = reactions
         self.is_rich_text = is_rich_text
 
     def to_dict(self) -> Dict:
@@ -39,36 +46,34 @@ class ChatMessage:
             "timestamp": self.timestamp,
             "file_data": self.file_data,
             "reply_to": self.reply_to,
-            "reactions": self.reactions,
+            "reactions": self.reactions or {},
             "is_rich_text": self.is_rich_text
         }
 
 class ChatRoom:
+    __slots__ = ("room_id", "connections", "messages", "typing_users")
+
     def __init__(self, room_id: str):
         self.room_id = room_id
-        self.connections: Set[WebSocket] = set()
-        self.messages: List[ChatMessage] = []
+        self.connections: Dict[WebSocket, Outbound] = {}
+        self.messages: Deque[ChatMessage] = deque(maxlen=HISTORY_SIZE)
         self.typing_users: Dict[str, str] = {}  # user_id -> name
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.connections.add(websocket)
+        self.connections[websocket] = Outbound(websocket)
 
     def disconnect(self, websocket: WebSocket):
-        self.connections.remove(websocket)
+        self.connections.pop(websocket).cancel()
 
-    async def broadcast(self, message: str):
-        for connection in self.connections:
-            try:
-                await connection.send_text(message)
-            except Exception as e:
-                print(f"Error broadcasting message: {str(e)}")
+    async def broadcast(self, message: str, key=None):
+        # Queued per connection; a slow client never holds up the others
+        for outbound in self.connections.values():
+            outbound.send(message, key)
 
     def add_message(self, message: ChatMessage):
+        # The deque drops the oldest message past HISTORY_SIZE
         self.messages.append(message)
-        # Keep only last 100 messages
-        if len(self.messages) > 100:
-            self.messages = self.messages[-100:]
 
 class ChatManager:
     def __init__(self):
@@ -93,37 +98,22 @@ class ChatManager:
         if websocket in self.user_rooms:
             del self.user_rooms[websocket]
 
-    async def broadcast(self, message: str, room_id: str):
+    async def broadcast(self, message: str, room_id: str, websocket: WebSocket = None):
         try:
-            data = json.loads(message)
+            data = frames.loads(message)
             room = self.get_room(room_id)
 
-            if data["type"] == "file":
-                # Handle file upload
-                file_content = data.pop("file_content", None)
-                if file_content:
-                    filename = data.pop("filename")
-                    content_type = data.pop("content_type")
-                    
-                    # Save file
-                    file_path = self.uploads_dir / f"{room_id}_{filename}"
-                    file_bytes = base64.b64decode(file_content)
-                    with open(file_path, "wb") as f:
-                        f.write(file_bytes)
-                    
-                    # Add file data to message
-                    data["file_data"] = {
-                        "filename": filename,
-                        "content_type": content_type,
-                        "size": len(file_bytes)
-                    }
+            if "file_content" in data:
+                # Files go over the websocket in binary chunks now (see transfers.py)
+                raise ValueError("base64 file_content is no longer accepted; send the file with file_start")
 
             # Create and store message
             chat_message = ChatMessage(**data)
             room.add_message(chat_message)
             
             # Broadcast to all users in the room
-            await room.broadcast(json.dumps(chat_message.to_dict()))
+            # Encoded once for the whole room
+            await room.broadcast(frames.dumps(chat_message.to_dict()))
 
         except Exception as e:
             print(f"Error broadcasting message: {str(e)}")
@@ -132,7 +122,9 @@ class ChatManager:
                 "type": "error",
                 "message": f"Failed to process message: {str(e)}"
             }
-            await websocket.send_text(json.dumps(error_message))
+            sender = self.get_room(room_id).connections.get(websocket)
+            if sender is not None:
+                sender.send(frames.dumps(error_message))
 
     async def handle_typing(self, websocket: WebSocket, data: Dict):
         room_id = self.user_rooms.get(websocket)
@@ -143,13 +135,13 @@ class ChatManager:
             else:
                 room.typing_users.pop(data["user_id"], None)
             
-            # Broadcast typing status
-            await room.broadcast(json.dumps({
+            # Broadcast typing status; only the latest one per user matters
+            await room.broadcast(frames.dumps({
                 "type": "typing",
                 "user_id": data["user_id"],
                 "user_name": data["user_name"],
                 "is_typing": data["is_typing"]
-            }))
+            }), key=("typing", data["user_id"]))
 
     def get_file_path(self, room_id: str, filename: str) -> Path:
         return self.uploads_dir / f"{room_id}_{filename}"
@@ -157,24 +149,26 @@ class ChatManager:
 class ConnectionManager:
     def __init__(self):
         # Store active connections per room
-        self.active_connections: Dict[str, Set[WebSocket]] = {}
+        self.active_connections: Dict[str, Dict[WebSocket, Outbound]] = {}
 
     async def connect(self, websocket: WebSocket, room_id: str):
         await websocket.accept()
         if room_id not in self.active_connections:
-            self.active_connections[room_id] = set()
-        self.active_connections[room_id].add(websocket)
+            self.active_connections[room_id] = {}
+        self.active_connections[room_id][websocket] = Outbound(websocket)
 
     def disconnect(self, websocket: WebSocket, room_id: str):
         if room_id in self.active_connections:
-            self.active_connections[room_id].discard(websocket)
+            outbound = self.active_connections[room_id].pop(websocket, None)
+            if outbound is not None:
+                outbound.cancel()
             if not self.active_connections[room_id]:
                 del self.active_connections[room_id]
 
     async def broadcast(self, message: str, room_id: str):
         if room_id in self.active_connections:
-            for connection in self.active_connections[room_id]:
-                await connection.send_text(message)
+            for outbound in self.active_connections[room_id].values():
+                outbound.send(message)
 
 manager = ChatManager()
 manager_connection = ConnectionManager()
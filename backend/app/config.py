@@ -4,12 +4,36 @@ from functools import lru_cache
 class Settings(BaseSettings):
     # Database settings
     DATABASE_URL: str = "postgresql://postgres:postgres@db:5432/maildb"
+    ASYNC_DATABASE_URL: str = ""  # Derived from DATABASE_URL (asyncpg/aiosqlite) when empty
+
+    # Connection pool settings (PostgreSQL), applied to the sync and async engines separately
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: int = 30  # Seconds to wait for a free connection
+    DB_POOL_RECYCLE: int = 1800  # Seconds before a connection is replaced
+    DB_POOL_PRE_PING: bool = True  # Detect connections killed by a database restart
+    DB_STATEMENT_TIMEOUT_MS: int = 0  # 0 disables the default statement timeout
+    DB_SEARCH_STATEMENT_TIMEOUT_MS: int = 5000
+    DB_PGBOUNCER: bool = False  # Running behind PgBouncer in transaction pooling mode
     
     # JWT settings
     SECRET_KEY: str = "your-secret-key-here"
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
 
+    # Password hashing
+    BCRYPT_ROUNDS: int = 12  # Changing it rehashes each password on the user's next login
+    PASSWORD_HASH_WORKERS: int = 2  # Threads computing hashes off the event loop
+    PASSWORD_HASH_MAX_QUEUE: int = 64  # Jobs allowed to wait for a thread before requests get a 503
+
+    # Cache of the user behind a token, so authenticated requests skip the users lookup
+    AUTH_CACHE_TTL_SECONDS: int = 60  # 0 disables the cache
+    AUTH_CACHE_MAX_ENTRIES: int = 10000
+    AUTH_CACHE_REDIS_URL: str = ""  # Shared cache for multi-worker deployments, e.g. redis://redis:6379/0
+    AUTH_CACHE_LOCAL_TTL_SECONDS: int = 5  # Per-worker TTL when the shared cache is enabled
+    AUTH_CACHE_REDIS_TIMEOUT_SECONDS: float = 0.5  # A slower shared cache is treated as down
+    AUTH_CACHE_REDIS_RETRY_SECONDS: float = 5  # How long a worker skips the shared cache after it fails
+
     # SMTP Settings for local server
     SMTP_HOST: str = "host.docker.internal"  # Special Docker DNS for host machine
     SMTP_PORT: int = 25  # Default SMTP port
@@ -19,6 +43,76 @@ class Settings(BaseSettings):
     SMTP_SSL: bool = False
     FROM_EMAIL: str = "noreply@localhost"
     FROM_NAME: str = "Mail Service"
+    SMTP_TIMEOUT: int = 30
+    SMTP_POOL_SIZE: int = 2  # Persistent SMTP connections per worker process
+    SMTP_MAX_MESSAGES_PER_CONNECTION: int = 100  # Reconnect after this many messages
+
+    # Outbound delivery queue (see outbox.py)
+    OUTBOX_WORKERS: int = 2
+    OUTBOX_BATCH_SIZE: int = 20  # Messages claimed and sent over one connection at a time
+    OUTBOX_POLL_SECONDS: int = 5
+    OUTBOX_CLAIM_SECONDS: int = 900  # Must exceed the worst-case batch send time (batch size x SMTP_TIMEOUT)
+    OUTBOX_MAX_ATTEMPTS: int = 8
+    OUTBOX_RETRY_BASE_SECONDS: int = 30  # Doubles after each failed attempt
+    OUTBOX_RETRY_MAX_SECONDS: int = 3600
+
+    # Scheduled-send dispatcher (see scheduler.py)
+    SCHEDULER_WORKERS: int = 1
+    SCHEDULER_BATCH_SIZE: int = 500
+    SCHEDULER_POLL_SECONDS: int = 5
+
+    # Upload limits
+    UPLOAD_MAX_FILE_BYTES: int = 25 * 1024 * 1024  # Per attachment or chat file
+    UPLOAD_MAX_REQUEST_BYTES: int = 100 * 1024 * 1024  # Whole request body, checked before parsing
+
+    # Trash retention (see tasks.py)
+    TRASH_RETENTION_DAYS: int = 30
+    TRASH_RETENTION_INTERVAL_SECONDS: int = 24 * 60 * 60  # One run per period across all workers
+    TRASH_RETENTION_POLL_SECONDS: int = 60 * 60  # How often each worker checks for an expired lease
+    TRASH_PURGE_CHUNK_SIZE: int = 500  # Emails deleted per transaction
+    TRASH_PURGE_PAUSE_SECONDS: float = 0  # Breather between chunks for a busy database
+
+    # Materialized unread and folder counters (see counters.py)
+    COUNTERS_RECONCILE_INTERVAL_SECONDS: int = 6 * 60 * 60  # One reconciliation pass per period across all workers
+    COUNTERS_RECONCILE_POLL_SECONDS: int = 15 * 60  # How often each worker checks for an expired lease
+    COUNTERS_RECONCILE_BATCH_USERS: int = 500  # Users reconciled per transaction
+
+    # Cross-worker pub/sub for websocket rooms and notifications (see broker.py)
+    BROKER_URL: str = ""  # Empty keeps everything in-process; redis://redis:6379/1 for several workers
+    BROKER_PRESENCE_TTL_SECONDS: int = 30  # Members of a worker that stops refreshing them expire after this
+    BROKER_LOG_TTL_SECONDS: int = 24 * 60 * 60  # Idle room logs are dropped after this (Redis)
+    ROOM_LOG_SIZE: int = 500  # Recent chat and poll events kept for workers that open the room later
+    ROOM_REPLAY_SIZE: int = 200  # Recent room events a reconnecting client can resume from
+
+    # Websocket send queues (see outbound.py)
+    WS_SEND_QUEUE_SIZE: int = 256  # Messages queued per connection
+    WS_SEND_TIMEOUT_SECONDS: float = 10  # A send stuck this long closes the connection
+    WS_SLOW_CONSUMER_POLICY: str = "disconnect"  # Full queue: "disconnect" the client or "drop" the message
+
+    # Websocket login (see authenticate_websocket in main.py)
+    WS_AUTH_TIMEOUT_SECONDS: float = 10  # For a client sending its token in the first message
+
+    # Per-user notification websocket (see notifications.py)
+    NOTIFY_QUEUE_SIZE: int = 256  # Events buffered per connection before a slow client is dropped
+
+    # Chunked file transfer over the chat room websocket (see transfers.py)
+    CHAT_FILE_CHUNK_BYTES: int = 256 * 1024  # Largest binary frame accepted
+    CHAT_FILE_PROGRESS_INTERVAL_SECONDS: float = 0.5  # Between file_progress events to the room
+    CHAT_FILE_PARTIAL_TTL_SECONDS: int = 24 * 60 * 60  # Unfinished uploads can be resumed for this long
+    CHAT_FILE_MAX_ACTIVE_UPLOADS: int = 4  # Unfinished uploads open at once on one connection; 0 disables the limit
+    CHAT_FILE_MAX_PENDING_BYTES: int = 200 * 1024 * 1024  # Total size of one user's unfinished uploads per worker; 0 disables
+
+    # Content-addressed attachment store (see blobs.py)
+    BLOB_STORE_DIR: str = "blobs"  # Served only through signed, expiring URLs (see downloads.py)
+    BLOB_GC_INTERVAL_SECONDS: int = 3600
+    BLOB_GC_GRACE_SECONDS: int = 3600  # Unreferenced blobs younger than this are kept (uploads in flight)
+    BLOB_GC_BATCH_SIZE: int = 500
+
+    # File downloads (see downloads.py)
+    DOWNLOAD_MAX_AGE_SECONDS: int = 86400  # Browsers revalidate with the ETag afterwards
+    DOWNLOAD_ACCEL_REDIRECT_PREFIX: str = ""  # e.g. "/_files" behind nginx; empty serves from the app
+    DOWNLOAD_SIGNING_KEY: str = ""  # Defaults to a key derived from SECRET_KEY
+    DOWNLOAD_URL_TTL_SECONDS: int = 3600  # Signed URLs stay valid for one to two of these
 
     # GIPHY Settings
     GIPHY_API_KEY: str = ""
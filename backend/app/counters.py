@@ -0,0 +1,251 @@
+"""
+Materialized mailbox and chat unread counters.
+
+Triggers from migration 0010 adjust mailbox_counters and chat_unread_counters
+on every insert, delete and relevant update of emails and chat_messages, so
+reads here are primary-key range lookups whatever the mailbox size. Because
+the triggers see every write path (request handlers, bulk operations, the
+scheduler, trash retention), nothing in the application updates counts by hand,
+except marking a group read, which moves the member's read marker.
+
+Counters can still drift (a trigger dropped by a manual restore, rows edited
+by hand). The reconciliation job recomputes them from the source tables for a
+batch of users at a time and repairs any difference with a compare-and-set
+update, so a concurrent trigger update is never overwritten; on PostgreSQL each
+batch reads both sides from one REPEATABLE READ snapshot. Only the worker
+holding the "counter-reconciliation" lease runs it.
+"""
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import and_, case, func, or_, select, update
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from . import leases, metrics, models
+from .config import get_settings
+from .crud import VALID_FOLDERS
+from .database import SessionLocal, engine
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+LEASE = "counter-reconciliation"
+
+DRIFT = metrics.counter("counter_drift_total", "Counter rows corrected by reconciliation, by table")
+RECONCILED_USERS = metrics.counter("counter_reconciled_users_total", "Users whose counters were reconciled")
+CONFLICTS = metrics.counter("counter_reconcile_conflicts_total", "Reconciliation batches retried later after a concurrent write")
+
+_reconciler: Optional[asyncio.Task] = None
+
+def _email_folders():
+    """(user column, folder or None for "the email's status", condition), as in crud.folder_filter and migration 0010"""
+    email = models.Email
+    return [
+        (email.recipient_id, "inbox", email.status == "inbox"),
+        (email.sender_id, "sent", email.status == "sent"),
+        (email.sender_id, "draft", email.is_draft == True),
+        (email.recipient_id, None, email.status.in_(["spam", "trash"])),
+        (email.sender_id, None, and_(
+            email.status.in_(["spam", "trash"]),
+            or_(email.recipient_id.is_(None), email.sender_id != email.recipient_id)
+        )),
+    ]
+
+# Reads
+
+async def folder_counts(db: AsyncSession, user_id: int) -> Dict[str, dict]:
+    """Total and unread per folder, with a per-category breakdown"""
+    counts = {folder: {"total": 0, "unread": 0, "categories": {}} for folder in VALID_FOLDERS}
+    rows = await db.scalars(select(models.MailboxCounter).where(
+        models.MailboxCounter.user_id == user_id,
+        models.MailboxCounter.total > 0
+    ))
+    for row in rows:
+        folder = counts.setdefault(row.folder, {"total": 0, "unread": 0, "categories": {}})
+        folder["total"] += row.total
+        folder["unread"] += row.unread
+        folder["categories"][row.category] = {"total": row.total, "unread": row.unread}
+    return counts
+
+async def chat_unread_counts(db: AsyncSession, user_id: int, kind: str) -> Dict[str, int]:
+    """Unread messages per sender ("user") or per group ("group"), omitting zeros"""
+    rows = await db.execute(
+        select(models.ChatUnreadCounter.peer_id, models.ChatUnreadCounter.unread).where(
+            models.ChatUnreadCounter.user_id == user_id,
+            models.ChatUnreadCounter.kind == kind,
+            models.ChatUnreadCounter.unread > 0
+        )
+    )
+    return {str(peer_id): unread for peer_id, unread in rows}
+
+def _group_unread(member):
+    """Select counting a member's unread messages in their group"""
+    message = models.ChatMessage
+    return select(func.count(message.id)).where(
+        message.group_id == member.group_id,
+        message.id > func.coalesce(member.last_read_message_id, 0),
+        message.sender_id != member.user_id,
+        message.created_at >= member.joined_at
+    )
+
+def mark_group_read(db: Session, user_id: int, group_id: int) -> bool:
+    """Move the member's read marker to the group's latest message; False if not a member"""
+    member = models.ChatGroupMember
+    latest = select(func.max(models.ChatMessage.id)).where(models.ChatMessage.group_id == group_id).scalar_subquery()
+    marked = db.execute(
+        update(member)
+        .where(member.group_id == group_id, member.user_id == user_id)
+        .values(last_read_message_id=latest)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not marked:
+        return False
+    # Anything sent after the marker moved stays unread
+    counter = models.ChatUnreadCounter
+    remaining = _group_unread(member).where(member.group_id == group_id, member.user_id == user_id).scalar_subquery()
+    db.execute(
+        update(counter)
+        .where(counter.user_id == user_id, counter.kind == "group", counter.peer_id == group_id)
+        .values(unread=remaining)
+        .execution_options(synchronize_session=False)
+    )
+    return True
+
+# Reconciliation
+
+def _actual_mailbox(db: Session, user_ids: List[int]) -> Dict[Tuple, Tuple[int, int]]:
+    email = models.Email
+    category = func.coalesce(email.category, "primary")
+    unread = func.sum(case((email.is_read == True, 0), else_=1))
+    actual: Dict[Tuple, Tuple[int, int]] = {}
+    for user_column, folder, condition in _email_folders():
+        rows = db.execute(
+            select(user_column, email.status, category, func.count(), unread)
+            .where(user_column.in_(user_ids), condition)
+            .group_by(user_column, email.status, category)
+        )
+        for user_id, status, row_category, total, row_unread in rows:
+            key = (user_id, folder or status, row_category)
+            previous = actual.get(key, (0, 0))
+            actual[key] = (previous[0] + total, previous[1] + row_unread)
+    return actual
+
+def _actual_chat(db: Session, user_ids: List[int]) -> Dict[Tuple, int]:
+    message = models.ChatMessage
+    actual = {}
+    private = db.execute(
+        select(message.recipient_id, message.sender_id, func.count())
+        .where(
+            message.recipient_id.in_(user_ids),
+            message.sender_id.isnot(None),
+            or_(message.is_read == False, message.is_read.is_(None))
+        )
+        .group_by(message.recipient_id, message.sender_id)
+    )
+    for user_id, sender_id, unread in private:
+        actual[(user_id, "user", sender_id)] = unread
+    member = models.ChatGroupMember
+    groups = db.execute(
+        select(member.user_id, member.group_id, _group_unread(member).scalar_subquery())
+        .where(member.user_id.in_(user_ids))
+    )
+    for user_id, group_id, unread in groups:
+        if unread:
+            key = (user_id, "group", group_id)
+            actual[key] = actual.get(key, 0) + unread
+    return actual
+
+def _repair(db: Session, model, key_columns, value_columns, actual: Dict, stored: Dict) -> int:
+    """Compare-and-set every stored row that differs from its actual value; returns rows fixed"""
+    fixed = 0
+    table = model.__table__
+    for key in set(actual) | set(stored):
+        zero = tuple(0 for _ in value_columns)
+        want = actual.get(key, zero)
+        have = stored.get(key)
+        if have == want or (have is None and want == zero):
+            continue
+        where = [table.c[column] == value for column, value in zip(key_columns, key)]
+        if have is None:
+            db.execute(table.insert().values(**dict(zip(key_columns, key)), **dict(zip(value_columns, want))))
+        else:
+            where += [table.c[column] == value for column, value in zip(value_columns, have)]
+            db.execute(table.update().where(*where).values(**dict(zip(value_columns, want))))
+        fixed += 1
+    return fixed
+
+def reconcile_batch(after_user_id: int, limit: int) -> Optional[int]:
+    """Reconcile the next `limit` users after `after_user_id` (blocking); returns the last user id, or None when done"""
+    db = SessionLocal()
+    try:
+        if engine.dialect.name == "postgresql":
+            db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+        user_ids = db.scalars(
+            select(models.User.id).where(models.User.id > after_user_id).order_by(models.User.id).limit(limit)
+        ).all()
+        if not user_ids:
+            return None
+
+        counter = models.MailboxCounter
+        stored_mailbox = {
+            (row.user_id, row.folder, row.category): (row.total, row.unread)
+            for row in db.query(counter).filter(counter.user_id.in_(user_ids))
+        }
+        chat_counter = models.ChatUnreadCounter
+        stored_chat = {
+            (row.user_id, row.kind, row.peer_id): (row.unread,)
+            for row in db.query(chat_counter).filter(chat_counter.user_id.in_(user_ids))
+        }
+        actual_mailbox = _actual_mailbox(db, user_ids)
+        actual_chat = {key: (unread,) for key, unread in _actual_chat(db, user_ids).items()}
+
+        try:
+            mailbox_fixed = _repair(db, counter, ("user_id", "folder", "category"), ("total", "unread"),
+                                    actual_mailbox, stored_mailbox)
+            chat_fixed = _repair(db, chat_counter, ("user_id", "kind", "peer_id"), ("unread",),
+                                 actual_chat, stored_chat)
+            db.commit()
+        except DBAPIError:
+            # A concurrent write touched the same rows (serialization failure or
+            # duplicate key); its trigger kept the counter right, so try again next run
+            db.rollback()
+            CONFLICTS.inc()
+            return user_ids[-1]
+
+        DRIFT.inc(mailbox_fixed, table="mailbox_counters")
+        DRIFT.inc(chat_fixed, table="chat_unread_counters")
+        RECONCILED_USERS.inc(len(user_ids))
+        return user_ids[-1]
+    finally:
+        db.close()
+
+async def reconcile_all() -> None:
+    last_user_id = 0
+    while last_user_id is not None:
+        last_user_id = await asyncio.to_thread(reconcile_batch, last_user_id, settings.COUNTERS_RECONCILE_BATCH_USERS)
+        if last_user_id is not None:
+            await asyncio.to_thread(leases.renew, LEASE, settings.COUNTERS_RECONCILE_INTERVAL_SECONDS)
+
+async def _reconcile_periodically():
+    while True:
+        try:
+            if await asyncio.to_thread(leases.acquire, LEASE, settings.COUNTERS_RECONCILE_INTERVAL_SECONDS):
+                await reconcile_all()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error reconciling counters: {str(e)}")
+        await asyncio.sleep(settings.COUNTERS_RECONCILE_POLL_SECONDS)
+
+def start():
+    global _reconciler
+    _reconciler = asyncio.create_task(_reconcile_periodically())
+
+async def stop():
+    global _reconciler
+    if _reconciler is not None:
+        _reconciler.cancel()
+        await asyncio.gather(_reconciler, return_exceptions=True)
+        _reconciler = None
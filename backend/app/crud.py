@@ -1,5 +1,16 @@
-from sqlalchemy.orm import Session
-from . import models, schemas
+from typing import List, Optional
+from sqlalchemy import or_, and_, case, delete, func, literal, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, selectinload
+from . import blobs, models, outbox, schemas
+from .pagination import keyset_page
+
+VALID_FOLDERS = ["inbox", "sent", "spam", "trash", "draft"]
+
+# Sort keys for keyset pagination; the trailing id makes each key unique
+FOLDER_SORT_KEY = (models.Email.priority, models.Email.created_at, models.Email.id)
+CHAT_SORT_KEY = (models.ChatMessage.created_at, models.ChatMessage.id)
 
 def get_email(db: Session, email_id: int):
     return db.query(models.Email).filter(models.Email.id == email_id).first()
@@ -18,3 +29,203 @@ def create_email(db: Session, email: schemas.EmailCreate):
     db.commit()
     db.refresh(db_email)
     return db_email
+
+
+def email_listing_options():
+    """Loader options that fetch everything the Email schema renders in a fixed number of queries."""
+    recipient_user = selectinload(models.EmailRecipient.user)
+    return (
+        selectinload(models.Email.sender_user),
+        selectinload(models.Email.recipient_user),
+        selectinload(models.Email.attachments),
+        selectinload(models.Email.label_rows),
+        selectinload(models.Email.cc_recipients).options(recipient_user),
+        selectinload(models.Email.bcc_recipients).options(recipient_user),
+        selectinload(models.Email.replies, recursion_depth=-1).options(
+            selectinload(models.Email.attachments),
+            selectinload(models.Email.label_rows),
+            selectinload(models.Email.cc_recipients).options(recipient_user),
+            selectinload(models.Email.bcc_recipients).options(recipient_user),
+        ),
+    )
+
+def folder_filter(user_id: int, folder: str):
+    """Return the WHERE clause selecting the given user's emails in a folder"""
+    if folder == "sent":
+        return and_(models.Email.sender_id == user_id, models.Email.status == "sent")
+    if folder == "draft":
+        return and_(models.Email.sender_id == user_id, models.Email.is_draft == True)
+    if folder in ["spam", "trash"]:
+        return or_(
+            and_(models.Email.recipient_id == user_id, models.Email.status == folder),
+            and_(models.Email.sender_id == user_id, models.Email.status == folder)
+        )
+    return and_(models.Email.recipient_id == user_id, models.Email.status == "inbox")
+
+def mailbox_filter(user_id: int):
+    """Return the WHERE clause selecting every email in any of the user's folders"""
+    return or_(*[folder_filter(user_id, folder) for folder in VALID_FOLDERS])
+
+def fill_email_addresses(emails):
+    """Copy the eager-loaded user addresses onto the attributes the Email schema reads"""
+    for email in emails:
+        email.sender_email = email.sender_user.email if email.sender_user else None
+        email.recipient_email = email.recipient_user.email if email.recipient_user else None
+        for recipient in list(email.cc_recipients) + list(email.bcc_recipients):
+            recipient.user_email = recipient.user.email if recipient.user else None
+    return emails
+
+async def list_emails(db: AsyncSession, stmt, skip: int = 0, limit: int = 100):
+    """Execute a listing select with its related rows eager-loaded"""
+    result = await db.scalars(stmt.options(*email_listing_options()).offset(skip).limit(limit))
+    return fill_email_addresses(result.all())
+
+async def page_emails(db: AsyncSession, stmt, cursor: str, limit: int = 100):
+    """Execute a listing select as a keyset page; returns (emails, next_cursor)"""
+    emails, next_cursor = await keyset_page(db, stmt.options(*email_listing_options()), FOLDER_SORT_KEY, cursor, limit)
+    return fill_email_addresses(emails), next_cursor
+
+def folder_query(user_id: int, folder: str):
+    """Select of a folder's emails in listing order"""
+    return select(models.Email).where(folder_filter(user_id, folder)).order_by(
+        *[column.desc() for column in FOLDER_SORT_KEY]
+    )
+
+def chat_listing_options():
+    """Loader options for rendering chat messages without per-row lazy loads"""
+    return (
+        selectinload(models.ChatMessage.sender),
+        selectinload(models.ChatMessage.recipient),
+        selectinload(models.ChatMessage.replies, recursion_depth=-1),
+    )
+
+def fill_chat_addresses(messages):
+    for msg in messages:
+        msg.sender_email = msg.sender.email if msg.sender else None
+        if msg.recipient_id:
+            msg.recipient_email = msg.recipient.email if msg.recipient else None
+    return messages
+
+async def list_chat_messages(db: AsyncSession, stmt, cursor: Optional[str] = None, limit: int = 100):
+    """
+    Return a conversation in chronological order.
+
+    Without a cursor the whole conversation is returned (legacy clients). With a
+    cursor (empty for the first page) the newest `limit` messages before it are
+    returned along with a cursor for the next, older page.
+    """
+    stmt = stmt.options(*chat_listing_options())
+    if cursor is None:
+        result = await db.scalars(stmt.order_by(*[column.asc() for column in CHAT_SORT_KEY]))
+        return fill_chat_addresses(result.all()), None
+    messages, next_cursor = await keyset_page(db, stmt, CHAT_SORT_KEY, cursor, limit)
+    messages.reverse()
+    return fill_chat_addresses(messages), next_cursor
+
+def label_filter(label: str):
+    """WHERE clause matching emails that carry exactly this label"""
+    return models.Email.label_rows.any(models.EmailLabel.label == label)
+
+def _insert_ignore(db: Session, table):
+    # Both supported dialects spell "skip duplicate keys" as ON CONFLICT DO NOTHING
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    return dialect.insert(table)
+
+def add_labels(db: Session, owned_ids, labels: List[str]):
+    """Attach labels to every email selected by `owned_ids` (a select of email ids)"""
+    for label in labels:
+        stmt = _insert_ignore(db, models.EmailLabel.__table__).from_select(
+            ["email_id", "label"],
+            select(models.Email.id, literal(label)).where(models.Email.id.in_(owned_ids))
+        ).on_conflict_do_nothing()
+        db.execute(stmt)
+
+def remove_labels(db: Session, owned_ids, labels: List[str]):
+    """Detach labels from every email selected by `owned_ids` (a select of email ids)"""
+    if labels:
+        db.query(models.EmailLabel).filter(
+            models.EmailLabel.email_id.in_(owned_ids),
+            models.EmailLabel.label.in_(labels)
+        ).delete(synchronize_session=False)
+
+def label_counts(db: Session, user_id: int):
+    """Total and unread email counts per label across the user's mailbox, in one grouped query"""
+    return db.query(
+        models.EmailLabel.label,
+        func.count(models.EmailLabel.email_id).label("total"),
+        func.sum(case((models.Email.is_read == False, 1), else_=0)).label("unread")
+    ).join(
+        models.Email, models.Email.id == models.EmailLabel.email_id
+    ).filter(
+        mailbox_filter(user_id)
+    ).group_by(
+        models.EmailLabel.label
+    ).order_by(
+        models.EmailLabel.label
+    ).all()
+
+# Explicit id lists stay well under SQLite's bound-parameter limit
+BULK_MAX_IDS = 5000
+
+def bulk_filter(user_id: int, selection: schemas.BulkSelection, scope):
+    """WHERE clause for a bulk selection, limited to `scope` (the emails the operation may touch)"""
+    clauses = [scope]
+    if selection.folder:
+        clauses.append(folder_filter(user_id, selection.folder))
+    if selection.email_ids is not None:
+        clauses.append(models.Email.id.in_(selection.email_ids))
+    return and_(*clauses)
+
+def bulk_result(selection: schemas.BulkSelection, done: List[int], error: str) -> schemas.BulkResult:
+    """Per-id outcome: every requested id is reported, or every affected id for a folder selection"""
+    done = set(done)
+    if selection.email_ids is None:
+        results = [schemas.BulkItemResult(id=email_id, ok=True) for email_id in sorted(done)]
+    else:
+        results = [
+            schemas.BulkItemResult(id=email_id, ok=True) if email_id in done
+            else schemas.BulkItemResult(id=email_id, ok=False, error=error)
+            for email_id in dict.fromkeys(selection.email_ids)
+        ]
+    return schemas.BulkResult(updated=len(done), results=results)
+
+def bulk_update(db: Session, where, values: dict) -> List[int]:
+    """One UPDATE over every selected email; returns the ids it changed"""
+    return db.execute(
+        update(models.Email)
+        .where(where)
+        .values(**values)
+        .returning(models.Email.id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+
+def bulk_delete(db: Session, where):
+    """
+    Delete every selected email and its dependent rows with one statement per table.
+    Returns the deleted ids and the legacy attachment files to remove once committed.
+    """
+    targets = select(models.Email.id).where(where)
+    # Lock the selection so nothing moves out of trash between the statements below
+    if not db.scalars(targets.with_for_update()).all():
+        return [], []
+    paths = blobs.legacy_paths(db.execute(
+        select(models.Attachment.file_path, models.Attachment.content_hash)
+        .where(models.Attachment.email_id.in_(targets))
+    ))
+    for column in (models.Attachment.email_id, models.EmailLabel.email_id, models.EmailRecipient.email_id):
+        db.execute(delete(column.class_).where(column.in_(targets)).execution_options(synchronize_session=False))
+    # What the ORM cascade did per email: detach delivery jobs and replies. Jobs
+    # still held for a scheduled send would otherwise stay held forever
+    outbox.cancel_scheduled(db, targets)
+    db.execute(
+        update(models.OutboundEmail).where(models.OutboundEmail.email_id.in_(targets))
+        .values(email_id=None).execution_options(synchronize_session=False)
+    )
+    db.execute(
+        update(models.Email).where(models.Email.in_reply_to.in_(targets))
+        .values(in_reply_to=None).execution_options(synchronize_session=False)
+    )
+    deleted = db.execute(
+        delete(models.Email).where(where).returning(models.Email.id).execution_options(synchronize_session=False)
+    ).scalars().all()
+    return deleted, paths
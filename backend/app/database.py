@@ -1,17 +1,121 @@
-from sqlalchemy import create_engine
+import time
+from uuid import uuid4
+from sqlalchemy import create_engine, event, exc, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
 from .config import get_settings
+from . import metrics
 
 settings = get_settings()
 
+POOL_CHECKED_OUT = metrics.gauge("db_pool_checked_out", "Connections currently checked out of the pool")
+POOL_WAIT = metrics.histogram("db_pool_wait_seconds", "Time spent waiting to check out a pooled connection")
+POOL_OVERFLOW = metrics.counter("db_pool_overflow_total", "Connections opened beyond pool_size")
+POOL_TIMEOUTS = metrics.counter("db_pool_timeouts_total", "Checkouts that gave up after pool_timeout")
+
+class _InstrumentedPool:
+    """Records checkout wait time, overflow connections and checkout timeouts"""
+    metric_label = "sync"
+
+    def _do_get(self):
+        overflow = self.overflow()
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            POOL_TIMEOUTS.inc(engine=self.metric_label)
+            raise
+        finally:
+            POOL_WAIT.observe(time.perf_counter() - started, engine=self.metric_label)
+        if self.overflow() > max(overflow, 0):
+            POOL_OVERFLOW.inc(engine=self.metric_label)
+        return connection
+
+class InstrumentedQueuePool(_InstrumentedPool, QueuePool):
+    metric_label = "sync"
+
+class InstrumentedAsyncPool(_InstrumentedPool, AsyncAdaptedQueuePool):
+    metric_label = "async"
+
+def statement_timeout_sql(timeout_ms: int):
+    # SET does not take bind parameters; the value is forced to an int
+    return text(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+
+def _engine_options(url: str, is_async: bool) -> dict:
+    """Pool and connection options for an engine, from Settings"""
+    if make_url(url).get_backend_name() != "postgresql":
+        return {}
+
+    options = {"pool_pre_ping": settings.DB_POOL_PRE_PING}
+    connect_args = {}
+    if settings.DB_PGBOUNCER:
+        # PgBouncer in transaction mode does the pooling, and a server connection
+        # can change between transactions: no local pool, no named prepared statements
+        options["poolclass"] = NullPool
+        if is_async:
+            connect_args["statement_cache_size"] = 0
+            connect_args["prepared_statement_cache_size"] = 0
+            connect_args["prepared_statement_name_func"] = lambda: f"__asyncpg_{uuid4()}__"
+    else:
+        options.update(
+            poolclass=InstrumentedAsyncPool if is_async else InstrumentedQueuePool,
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+            pool_recycle=settings.DB_POOL_RECYCLE,
+        )
+        if settings.DB_STATEMENT_TIMEOUT_MS:
+            if is_async:
+                connect_args["server_settings"] = {"statement_timeout": str(settings.DB_STATEMENT_TIMEOUT_MS)}
+            else:
+                connect_args["options"] = f"-c statement_timeout={settings.DB_STATEMENT_TIMEOUT_MS}"
+    if connect_args:
+        options["connect_args"] = connect_args
+    return options
+
+def _instrument(sync_engine, label: str):
+    event.listen(sync_engine, "checkout", lambda *args: POOL_CHECKED_OUT.inc(engine=label))
+    event.listen(sync_engine, "checkin", lambda *args: POOL_CHECKED_OUT.dec(engine=label))
+    if settings.DB_PGBOUNCER and settings.DB_STATEMENT_TIMEOUT_MS and sync_engine.dialect.name == "postgresql":
+        # Session-level settings do not survive transaction pooling; set it per transaction
+        event.listen(
+            sync_engine, "begin",
+            lambda conn: conn.exec_driver_sql(f"SET LOCAL statement_timeout = {int(settings.DB_STATEMENT_TIMEOUT_MS)}")
+        )
+
 # Create engine for PostgreSQL
 engine = create_engine(
-    settings.DATABASE_URL
+    settings.DATABASE_URL,
+    **_engine_options(settings.DATABASE_URL, is_async=False)
 )
+_instrument(engine, "sync")
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async drivers for the same database, used by handlers that must not block the event loop
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+def async_database_url(url: str) -> str:
+    """Swap the sync driver in a database URL for its asyncio counterpart"""
+    parsed = make_url(url)
+    return parsed.set(drivername=ASYNC_DRIVERS.get(parsed.get_backend_name(), parsed.drivername)).render_as_string(hide_password=False)
+
+ASYNC_DATABASE_URL = settings.ASYNC_DATABASE_URL or async_database_url(settings.DATABASE_URL)
+
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    **_engine_options(ASYNC_DATABASE_URL, is_async=True)
+)
+_instrument(async_engine.sync_engine, "async")
+
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 # Dependency
@@ -21,3 +125,16 @@ def get_db():
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def set_statement_timeout(db, timeout_ms: int):
+    """Cap how long statements in the session's current transaction may run (PostgreSQL only)"""
+    if engine.dialect.name == "postgresql":
+        db.execute(statement_timeout_sql(timeout_ms))
+
+async def set_statement_timeout_async(db: AsyncSession, timeout_ms: int):
+    if engine.dialect.name == "postgresql":
+        await db.execute(statement_timeout_sql(timeout_ms))
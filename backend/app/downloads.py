@@ -0,0 +1,329 @@
+"""
+File downloads with byte ranges, validators and cheap transfers.
+
+file_response() is used by the authenticated download routes and by
+CachedStaticFiles for the static mounts. It sends:
+
+- a strong ETag: the content hash when the caller or a content-addressed store
+  knows it, otherwise one derived from the file's mtime and size, plus
+  Last-Modified and Cache-Control;
+- 304 Not Modified for a matching If-None-Match (or If-Modified-Since);
+- 206 Partial Content for a single `Range: bytes=...` (honouring If-Range),
+  so audio and video can be seeked without fetching the whole file, and 416
+  for ranges past the end. Multi-range requests get the whole file, which
+  RFC 9110 allows.
+
+SignedStaticFiles mounts a file store behind HMAC-signed, expiring URLs.
+signed_url() mints them while emails and chat messages are serialized for a
+user who may see them; serving one checks the signature and expiry without
+touching the database, so the responses can sit behind a caching proxy.
+Expiry times are rounded to DOWNLOAD_URL_TTL_SECONDS so the same file keeps
+the same URL, and cache key, across listings.
+
+The body goes out with the ASGI zero-copy extension (sendfile) when the server
+offers it, and otherwise in chunks read on a worker thread. Behind nginx, set
+DOWNLOAD_ACCEL_REDIRECT_PREFIX to an `internal` location aliased to the backend
+directory and the body is handed off with X-Accel-Redirect instead: nginx then
+serves ranges with sendfile and the worker never touches the bytes.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import stat
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from mimetypes import guess_type
+from typing import Dict, Optional, Tuple
+from urllib.parse import quote, urlencode
+import anyio
+from fastapi import HTTPException
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+from . import metrics
+from .config import get_settings
+
+settings = get_settings()
+
+CHUNK_SIZE = 256 * 1024
+
+PRIVATE_CACHE = f"private, max-age={settings.DOWNLOAD_MAX_AGE_SECONDS}"
+PUBLIC_CACHE = f"public, max-age={settings.DOWNLOAD_MAX_AGE_SECONDS}"
+
+SIGNING_KEY = (
+    settings.DOWNLOAD_SIGNING_KEY
+    or hmac.new(settings.SECRET_KEY.encode(), b"download-urls", hashlib.sha256).hexdigest()
+).encode()
+
+# URL prefix -> absolute directory of every store served through SignedStaticFiles
+SIGNED_STORES: Dict[str, str] = {}
+
+RESPONSES = metrics.counter("download_responses_total", "File download responses by status (200, 206, 304, 416, or accel for X-Accel-Redirect)")
+BYTES_SENT = metrics.counter("download_bytes_total", "File bytes sent by download responses, by transfer method")
+REJECTED = metrics.counter("download_signature_rejected_total", "Signed download URLs refused as invalid or expired")
+
+def _etag(stat_result: os.stat_result, content_hash: Optional[str]) -> str:
+    if content_hash:
+        return f'"{content_hash}"'
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+def _opaque(tag: str) -> str:
+    # Weak comparison: W/"x" matches "x"
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+def _not_modified(request_headers: Headers, etag: str, last_modified: str) -> bool:
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [_opaque(tag) for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def _range_applies(request_headers: Headers, etag: str, last_modified: str) -> bool:
+    if_range = request_headers.get("if-range")
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    # If-Range needs a strong match; anything else means "send the whole file"
+    return if_range == etag or if_range == last_modified
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single-range `bytes=` header into inclusive (start, end).
+    Returns None to serve the whole file; raises ValueError if the range is unsatisfiable.
+    """
+    if not header or size == 0:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, dash, last = (part.strip() for part in spec.strip().partition("-"))
+    if not dash or (first and not first.isdigit()) or (last and not last.isdigit()) or not (first or last):
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        if int(last) == 0:
+            raise ValueError("empty suffix range")
+        return max(size - int(last), 0), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError("range starts past the end of the file")
+    return start, min(int(last), size - 1) if last else size - 1
+
+def _content_disposition(filename: str, disposition_type: str) -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"{disposition_type}; filename*=utf-8''{quoted}"
+    return f'{disposition_type}; filename="{filename}"'
+
+def _accel_path(path: str) -> Optional[str]:
+    # Only files under the working directory are reachable through the nginx alias
+    relative = os.path.relpath(os.path.abspath(path))
+    if relative.startswith(".."):
+        return None
+    return settings.DOWNLOAD_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + quote(relative.replace(os.sep, "/"))
+
+class FileRangeResponse(Response):
+    """Sends bytes [start, end] of a file, zero-copy when the ASGI server supports it"""
+
+    def __init__(self, path: str, start: int, end: int, status_code: int, headers: dict, method: str):
+        self.path = path
+        self.start = start
+        self.length = end - start + 1
+        self.status_code = status_code
+        self.send_header_only = method.upper() == "HEAD"
+        self.background = None
+        self.init_headers(headers)
+        self.headers["content-length"] = str(self.length)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if self.send_header_only or self.length == 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            with open(self.path, "rb") as file:
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": file.fileno(),
+                    "offset": self.start,
+                    "count": self.length,
+                    "more_body": False,
+                })
+            BYTES_SENT.inc(self.length, method="zerocopy")
+            return
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            await file.seek(self.start)
+            remaining = self.length
+            while remaining:
+                chunk = await file.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    # The file shrank under us; the client sees a short body
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+                BYTES_SENT.inc(len(chunk), method="stream")
+            if remaining:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+def file_response(
+    request: Request,
+    path: str,
+    media_type: Optional[str] = None,
+    filename: Optional[str] = None,
+    content_hash: Optional[str] = None,
+    cache_control: str = PRIVATE_CACHE,
+    disposition_type: str = "attachment",
+    stat_result: Optional[os.stat_result] = None,
+) -> Response:
+    """Build the response for a GET or HEAD of `path`; 404 if the file is missing"""
+    request_headers = request.headers
+    path = str(path)
+    if stat_result is None:
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            raise HTTPException(status_code=404, detail="File not found")
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise HTTPException(status_code=404, detail="File not found")
+
+    size = stat_result.st_size
+    etag = _etag(stat_result, content_hash)
+    last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+    headers = {
+        "etag": etag,
+        "last-modified": last_modified,
+        "cache-control": cache_control,
+        "accept-ranges": "bytes",
+    }
+
+    if _not_modified(request_headers, etag, last_modified):
+        RESPONSES.inc(status=304)
+        return Response(status_code=304, headers=headers)
+
+    headers["content-type"] = media_type or guess_type(filename or path)[0] or "application/octet-stream"
+    if filename is not None:
+        headers["content-disposition"] = _content_disposition(filename, disposition_type)
+
+    if settings.DOWNLOAD_ACCEL_REDIRECT_PREFIX:
+        accel_path = _accel_path(path)
+        if accel_path is not None:
+            # nginx evaluates Range and conditionals itself against the file it serves
+            headers["x-accel-redirect"] = accel_path
+            RESPONSES.inc(status="accel")
+            return Response(headers=headers)
+
+    requested = None
+    if request_headers.get("range") and _range_applies(request_headers, etag, last_modified):
+        try:
+            requested = parse_range(request_headers["range"], size)
+        except ValueError:
+            RESPONSES.inc(status=416)
+            return Response(status_code=416, headers={"content-range": f"bytes */{size}", "accept-ranges": "bytes"})
+
+    if requested is None:
+        RESPONSES.inc(status=200)
+        return FileRangeResponse(path, 0, size - 1, 200, headers, request.method)
+    start, end = requested
+    headers["content-range"] = f"bytes {start}-{end}/{size}"
+    RESPONSES.inc(status=206)
+    return FileRangeResponse(path, start, end, 206, headers, request.method)
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles serving through file_response(), so the mounts get ranges, ETags and 304s too"""
+
+    def __init__(self, *args, cache_control: str = PRIVATE_CACHE, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_control = cache_control
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        if status_code != 200:
+            # html-mode 404.html pages
+            return super().file_response(full_path, stat_result, scope, status_code)
+        return file_response(
+            Request(scope), full_path,
+            cache_control=self.cache_control, stat_result=stat_result
+        )
+
+def _signature(prefix: str, path: str, expires: int, filename: Optional[str], media_type: Optional[str]) -> str:
+    message = "\n".join([prefix, path, str(expires), filename or "", media_type or ""]).encode()
+    digest = hmac.new(SIGNING_KEY, message, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+def signed_url(file_path: Optional[str], filename: Optional[str] = None, media_type: Optional[str] = None) -> Optional[str]:
+    """A signed, expiring URL for a stored file, or None if it is not in a signed store"""
+    if not file_path:
+        return None
+    absolute = os.path.abspath(file_path)
+    for prefix, directory in SIGNED_STORES.items():
+        if absolute.startswith(directory + os.sep):
+            path = absolute[len(directory) + 1:].replace(os.sep, "/")
+            break
+    else:
+        return None
+    # Valid for one to two TTLs, and identical for every listing within a TTL
+    ttl = settings.DOWNLOAD_URL_TTL_SECONDS
+    expires = (int(time.time()) // ttl + 2) * ttl
+    params = {"expires": expires}
+    if filename:
+        params["name"] = filename
+    if media_type:
+        params["type"] = media_type
+    params["sig"] = _signature(prefix, path, expires, filename, media_type)
+    return f"{prefix}/{quote(path)}?{urlencode(params)}"
+
+class SignedStaticFiles(CachedStaticFiles):
+    """
+    A file store whose files are only served through URLs from signed_url().
+    In a content-addressed store (blobs.py) each file is named after its
+    SHA-256, which is then its ETag, as on the authenticated download routes.
+    """
+
+    def __init__(self, *, directory: str, prefix: str, content_addressed: bool = False, **kwargs):
+        super().__init__(directory=directory, **kwargs)
+        self.prefix = prefix.rstrip("/")
+        self.content_addressed = content_addressed
+        SIGNED_STORES[self.prefix] = os.path.abspath(directory)
+
+    def _verify(self, path: str, params):
+        try:
+            expires = int(params["expires"])
+            signature = params["sig"]
+        except (KeyError, ValueError):
+            expires, signature = 0, ""
+        expected = _signature(self.prefix, path.replace(os.sep, "/"), expires, params.get("name"), params.get("type"))
+        if not hmac.compare_digest(signature, expected) or expires < time.time():
+            REJECTED.inc()
+            raise HTTPException(status_code=403, detail="Invalid or expired download link")
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        # Checked before the file lookup, so unsigned requests learn nothing about what exists
+        self._verify(path, Request(scope).query_params)
+        return await super().get_response(path, scope)
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        if status_code != 200:
+            return super().file_response(full_path, stat_result, scope, status_code)
+        request = Request(scope)
+        params = request.query_params
+        # The URL is the credential: shared caches may keep the response until it expires
+        max_age = max(min(int(params["expires"]) - int(time.time()), settings.DOWNLOAD_MAX_AGE_SECONDS), 0)
+        return file_response(
+            request, full_path,
+            media_type=params.get("type"),
+            filename=params.get("name"),
+            content_hash=os.path.basename(full_path) if self.content_addressed else None,
+            cache_control=f"public, max-age={max_age}",
+            stat_result=stat_result
+        )
@@ -1,110 +1,264 @@
 import smtplib
+from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from email.mime.application import MIMEApplication
-from typing import List, Dict, Tuple
+from email.policy import SMTP as SMTP_POLICY
+from typing import Dict, Iterator, List, Optional, Tuple
+from uuid import uuid4
 from .config import get_settings
-import os
+from . import metrics
+import binascii
 import logging
+import os
+import queue
+import re
 import ssl
+import threading
+import time
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 settings = get_settings()
 
-def send_email(to_email: str, subject: str, content: str, attachments: List[Dict] = None, cc_list: List[str] = None) -> Tuple[bool, str]:
-    server = None
-    try:
-        logger.debug(f"Preparing to send email to {to_email}")
-        logger.debug(f"SMTP Settings - Host: {settings.SMTP_HOST}, Port: {settings.SMTP_PORT}")
-        
-        # Create message container
-        msg = MIMEMultipart()
-        msg['From'] = f"{settings.FROM_NAME} <{settings.FROM_EMAIL}>"
-        msg['To'] = to_email
-        if cc_list:
-            msg['Cc'] = ", ".join(cc_list)
-            logger.debug(f"CC recipients: {cc_list}")
-        msg['Subject'] = subject
-
-        # Add body to email
-        msg.attach(MIMEText(content, 'plain'))
-        logger.debug("Email body attached")
-
-        # Add attachments
-        if attachments:
-            logger.debug(f"Processing {len(attachments)} attachments")
-            for attachment in attachments:
+CONNECTIONS_OPENED = metrics.counter("smtp_connections_opened_total", "SMTP connections opened")
+SEND_SECONDS = metrics.histogram("smtp_send_seconds", "Time to hand one message to the SMTP server")
+
+# base64 turns 57 input bytes into one 76-character line; read whole lines' worth at a time
+BASE64_LINE_BYTES = 57
+BASE64_BLOCK_BYTES = BASE64_LINE_BYTES * 1024
+
+class PermanentDeliveryError(Exception):
+    """Delivery can never succeed (bad attachment, 5xx reply); do not retry"""
+
+class StreamedMessage:
+    """
+    A MIME message whose attachment bodies stay on disk until it is sent.
+
+    The headers and text part are rendered up front with a placeholder token for
+    each attachment body; chunks() swaps every token for the file's base64
+    encoding, read a block at a time, so memory use does not grow with attachment size.
+    """
+
+    def __init__(self, skeleton: bytes, files: Dict[bytes, str]):
+        self.skeleton = skeleton
+        self.files = files
+
+    def _encode_file(self, path: str) -> Iterator[bytes]:
+        with open(path, "rb") as f:
+            separator = b""
+            while True:
+                block = f.read(BASE64_BLOCK_BYTES)
+                if not block:
+                    break
+                yield separator + b"\r\n".join(
+                    binascii.b2a_base64(block[i:i + BASE64_LINE_BYTES], newline=False)
+                    for i in range(0, len(block), BASE64_LINE_BYTES)
+                )
+                separator = b"\r\n"
+
+    def chunks(self) -> Iterator[bytes]:
+        if not self.files:
+            yield self.skeleton
+            return
+        pattern = re.compile(b"|".join(re.escape(token) for token in self.files))
+        position = 0
+        for match in pattern.finditer(self.skeleton):
+            yield self.skeleton[position:match.start()]
+            yield from self._encode_file(self.files[match.group()])
+            position = match.end()
+        yield self.skeleton[position:]
+
+def build_message(to_email: str, subject: str, content: str, attachments: List[Dict] = None, cc_list: List[str] = None) -> StreamedMessage:
+    # Create message container
+    msg = MIMEMultipart()
+    msg['From'] = f"{settings.FROM_NAME} <{settings.FROM_EMAIL}>"
+    msg['To'] = to_email
+    if cc_list:
+        msg['Cc'] = ", ".join(cc_list)
+    msg['Subject'] = subject
+
+    # Add body to email
+    msg.attach(MIMEText(content, 'plain'))
+
+    # Add attachments as placeholders, filled in from disk while sending
+    files = {}
+    for attachment in attachments or []:
+        if not os.access(attachment['path'], os.R_OK):
+            raise PermanentDeliveryError(f"Error attaching file {attachment['filename']}: cannot read {attachment['path']}")
+        token = f"@@attachment-{uuid4().hex}@@"
+        part = MIMEBase("application", "octet-stream")
+        part.set_payload(token)
+        part['Content-Transfer-Encoding'] = "base64"
+        part.add_header('Content-Disposition', 'attachment', filename=attachment['filename'])
+        msg.attach(part)
+        files[token.encode()] = attachment['path']
+    return StreamedMessage(msg.as_bytes(policy=SMTP_POLICY), files)
+
+def _dot_stuff(chunk: bytes) -> bytes:
+    # Chunks always start at a line boundary (base64 lines never start with a dot)
+    return re.sub(rb"(?m)^\.", b"..", chunk)
+
+def send_streamed(server: smtplib.SMTP, from_addr: str, recipients: List[str], message: StreamedMessage) -> Dict:
+    """smtplib.SMTP.sendmail, but writing the DATA section chunk by chunk"""
+    server.ehlo_or_helo_if_needed()
+    code, resp = server.mail(from_addr)
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+    refused = {}
+    for recipient in recipients:
+        code, resp = server.rcpt(recipient)
+        if code not in (250, 251):
+            refused[recipient] = (code, resp)
+    if len(refused) == len(recipients):
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    code, resp = server.docmd("data")
+    if code != 354:
+        server.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    last = b"\n"
+    for chunk in message.chunks():
+        if chunk:
+            server.send(_dot_stuff(chunk))
+            last = chunk[-1:]
+    server.send(b".\r\n" if last == b"\n" else b"\r\n.\r\n")
+    code, resp = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+def is_permanent(error: Exception) -> bool:
+    """5xx replies and unusable messages are final; connection trouble and 4xx replies are retried"""
+    if isinstance(error, PermanentDeliveryError):
+        return True
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, (smtplib.SMTPConnectError, smtplib.SMTPAuthenticationError)):
+        return False
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    return False
+
+class SMTPConnectionPool:
+    """
+    Persistent SMTP connections shared by the delivery workers.
+
+    smtplib is blocking, so connections are used from worker threads. Each one is
+    reused for many messages (checked with NOOP before reuse) and replaced after
+    SMTP_MAX_MESSAGES_PER_CONNECTION messages.
+    """
+
+    def __init__(self, size: int):
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()
+
+    def _connect(self) -> smtplib.SMTP:
+        logger.debug(f"Opening SMTP connection to {settings.SMTP_HOST}:{settings.SMTP_PORT}")
+        if settings.SMTP_SSL:
+            server = smtplib.SMTP_SSL(settings.SMTP_HOST, settings.SMTP_PORT, timeout=settings.SMTP_TIMEOUT,
+                                      context=ssl.create_default_context())
+        else:
+            server = smtplib.SMTP(settings.SMTP_HOST, settings.SMTP_PORT, timeout=settings.SMTP_TIMEOUT)
+            if settings.SMTP_TLS:
+                server.starttls(context=ssl.create_default_context())
+        if settings.SMTP_USERNAME and settings.SMTP_PASSWORD:
+            server.login(settings.SMTP_USERNAME, settings.SMTP_PASSWORD)
+        CONNECTIONS_OPENED.inc()
+        server.messages_sent = 0
+        return server
+
+    def _acquire(self) -> smtplib.SMTP:
+        self._slots.acquire()
+        try:
+            while True:
                 try:
-                    with open(attachment['path'], 'rb') as f:
-                        part = MIMEApplication(f.read(), _subtype="octet-stream")
-                        part.add_header(
-                            'Content-Disposition',
-                            'attachment',
-                            filename=attachment['filename']
-                        )
-                        msg.attach(part)
-                        logger.debug(f"Attached file: {attachment['filename']}")
-                except Exception as e:
-                    error_msg = f"Error attaching file {attachment['filename']}: {str(e)}"
-                    logger.error(error_msg)
-                    return False, error_msg
+                    server = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                try:
+                    if server.noop()[0] == 250:
+                        return server
+                except (smtplib.SMTPException, OSError):
+                    pass
+                self._discard(server)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _release(self, server: smtplib.SMTP, reusable: bool):
+        if reusable and server.messages_sent < settings.SMTP_MAX_MESSAGES_PER_CONNECTION:
+            self._idle.put(server)
+        else:
+            self._discard(server)
+        self._slots.release()
 
+    def _discard(self, server: smtplib.SMTP):
         try:
-            # Create SMTP connection
-            logger.debug("Establishing SMTP connection...")
-            context = ssl.create_default_context()
-            server = smtplib.SMTP(settings.SMTP_HOST, settings.SMTP_PORT, timeout=30)
-            server.set_debuglevel(1)  # Enable SMTP debug output
-            
-            # Start TLS for security
-            if settings.SMTP_TLS:
-                logger.debug("Starting TLS...")
-                server.starttls(context=context)
-            
-            # Login if credentials are provided
-            if settings.SMTP_USERNAME and settings.SMTP_PASSWORD:
-                logger.debug(f"Logging in as {settings.SMTP_USERNAME}...")
-                server.login(settings.SMTP_USERNAME, settings.SMTP_PASSWORD)
-            
-            # Send email
-            all_recipients = [to_email] + (cc_list or [])
-            logger.debug(f"Sending email to recipients: {all_recipients}")
-            server.sendmail(settings.FROM_EMAIL, all_recipients, msg.as_string())
-            logger.debug("Email sent successfully")
-            
-            return True, "Email sent successfully"
-
-        except smtplib.SMTPAuthenticationError as e:
-            error_msg = f"SMTP Authentication failed: {str(e)}"
-            logger.error(error_msg)
-            return False, error_msg
-        
-        except smtplib.SMTPConnectError as e:
-            error_msg = f"Failed to connect to SMTP server: {str(e)}"
-            logger.error(error_msg)
-            return False, error_msg
-        
-        except smtplib.SMTPException as e:
-            error_msg = f"SMTP error occurred: {str(e)}"
-            logger.error(error_msg)
-            return False, error_msg
-        
-        except ssl.SSLError as e:
-            error_msg = f"SSL/TLS error: {str(e)}"
-            logger.error(error_msg)
-            return False, error_msg
-        
-        except Exception as e:
-            error_msg = f"Unexpected error while sending email: {str(e)}"
-            logger.error(error_msg)
-            return False, error_msg
-
-    finally:
-        if server:
+            server.quit()
+        except Exception:
+            server.close()
+
+    def send_many(self, messages: List[Tuple[List[str], StreamedMessage]]) -> List[Optional[Exception]]:
+        """
+        Send messages over one pooled connection; returns None or the error for each.
+        A connection failure fails the remaining messages so they are retried later.
+        """
+        results: List[Optional[Exception]] = []
+        try:
+            server = self._acquire()
+        except (smtplib.SMTPException, OSError) as e:
+            logger.warning(f"Failed to connect to SMTP server: {str(e)}")
+            return [e] * len(messages)
+
+        reusable = True
+        try:
+            for recipients, msg in messages:
+                if not reusable:
+                    results.append(smtplib.SMTPServerDisconnected("Connection lost earlier in the batch"))
+                    continue
+                started = time.perf_counter()
+                try:
+                    send_streamed(server, settings.FROM_EMAIL, recipients, msg)
+                    server.messages_sent += 1
+                    results.append(None)
+                except smtplib.SMTPResponseException as e:
+                    results.append(e)
+                    # The server may still be mid-transaction; reset before the next message
+                    try:
+                        server.rset()
+                    except (smtplib.SMTPException, OSError):
+                        reusable = False
+                except smtplib.SMTPRecipientsRefused as e:
+                    results.append(e)
+                except (smtplib.SMTPException, OSError) as e:
+                    results.append(e)
+                    reusable = False
+                finally:
+                    SEND_SECONDS.observe(time.perf_counter() - started)
+        finally:
+            self._release(server, reusable)
+        return results
+
+    def close(self):
+        while True:
             try:
-                server.quit()
-            except Exception as e:
-                logger.error(f"Error closing SMTP connection: {str(e)}") 
\ No newline at end of file
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+pool = SMTPConnectionPool(settings.SMTP_POOL_SIZE)
+
+def send_email(to_email: str, subject: str, content: str, attachments: List[Dict] = None, cc_list: List[str] = None) -> Tuple[bool, str]:
+    """Send one message right away (blocking). Request handlers enqueue through outbox.py instead."""
+    try:
+        msg = build_message(to_email, subject, content, attachments, cc_list)
+    except PermanentDeliveryError as e:
+        logger.error(str(e))
+        return False, str(e)
+    error, = pool.send_many([([to_email] + (cc_list or []), msg)])
+    if error is not None:
+        logger.error(f"SMTP error occurred: {str(error)}")
+        return False, str(error)
+    return True, "Email sent successfully"
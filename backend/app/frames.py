@@ -0,0 +1,26 @@
+"""
+JSON encoding for websocket frames and broker messages.
+
+Broadcasts encode each event once, here, and hand the same text frame to every
+recipient's send queue; starlette's send_json would encode it again for each
+connection. orjson is used when it is installed, the standard library otherwise;
+both produce compact JSON that clients parse the same way.
+"""
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # Optional; the standard library is several times slower
+    orjson = None
+
+def dumps(message: Any) -> str:
+    if orjson is not None:
+        # Non-string keys are converted like json.dumps does
+        return orjson.dumps(message, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False, default=str)
+
+def loads(data) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -1,9 +1,23 @@
+from pathlib import Path
+from alembic import command
+from alembic.config import Config
 from sqlalchemy.orm import Session
 from . import models, auth
-from .database import engine, SessionLocal
+from .database import SessionLocal
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+def alembic_config() -> Config:
+    config = Config(str(BACKEND_DIR / "alembic.ini"))
+    config.set_main_option("script_location", str(BACKEND_DIR / "migrations"))
+    return config
+
+def run_migrations(revision: str = "head"):
+    """Bring the database schema up to date with the versioned migrations"""
+    command.upgrade(alembic_config(), revision)
 
 def init_db():
-    models.Base.metadata.create_all(bind=engine)
+    run_migrations()
     
     db = SessionLocal()
     try:
@@ -0,0 +1,52 @@
+"""
+Leader leases for periodic jobs.
+
+Every uvicorn worker runs the same background loops; a job that must run in
+only one of them takes a named lease first. A lease is a row in leader_leases
+with an expiry: acquire() succeeds for whoever finds it missing or expired,
+so exactly one worker wins each period, and a worker that dies simply lets
+its lease run out. Long runs call renew() as they make progress.
+
+Leases are plain rows, so they work the same on SQLite, on PostgreSQL and
+behind PgBouncer, where session-level advisory locks cannot be held.
+"""
+import os
+import socket
+from datetime import timedelta
+from sqlalchemy import update
+from sqlalchemy.dialects import postgresql, sqlite
+from . import models
+from .database import engine
+from .outbox import utcnow
+
+HOLDER = f"{socket.gethostname()}:{os.getpid()}"
+
+def acquire(name: str, ttl_seconds: int) -> bool:
+    """Take the lease if nobody holds it or it has expired (blocking)"""
+    now = utcnow()
+    expires_at = now + timedelta(seconds=ttl_seconds)
+    table = models.LeaderLease.__table__
+    dialect = postgresql if engine.dialect.name == "postgresql" else sqlite
+    with engine.begin() as conn:
+        created = conn.execute(
+            dialect.insert(table).values(name=name, holder=HOLDER, expires_at=expires_at).on_conflict_do_nothing()
+        )
+        if created.rowcount == 1:
+            return True
+        taken = conn.execute(
+            update(table)
+            .where(table.c.name == name, table.c.expires_at <= now)
+            .values(holder=HOLDER, expires_at=expires_at)
+        )
+        return taken.rowcount == 1
+
+def renew(name: str, ttl_seconds: int) -> bool:
+    """Extend a lease this worker holds; False if it has lost it"""
+    table = models.LeaderLease.__table__
+    with engine.begin() as conn:
+        renewed = conn.execute(
+            update(table)
+            .where(table.c.name == name, table.c.holder == HOLDER)
+            .values(expires_at=utcnow() + timedelta(seconds=ttl_seconds))
+        )
+        return renewed.rowcount == 1
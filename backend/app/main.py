@@ -1,46 +1,72 @@
-from fastapi import FastAPI, Depends, HTTPException, status, WebSocket, WebSocketDisconnect, Form, File, UploadFile
+from fastapi import FastAPI, BackgroundTasks, Depends, HTTPException, Query, Request, status, WebSocket, WebSocketDisconnect, Form, File, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
-from . import models, schemas, crud
-from .database import SessionLocal, engine, get_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import models, schemas, crud, blobs, downloads, outbox, passwords, scheduler, uploads, search as search_engine
+from .database import AsyncSessionLocal, SessionLocal, get_db, get_async_db, set_statement_timeout
+from . import metrics
+from .config import get_settings
 from .auth import (
     get_current_user,
     create_access_token,
-    get_password_hash,
-    verify_password,
     ACCESS_TOKEN_EXPIRE_MINUTES
 )
 from datetime import timedelta, datetime
-from typing import List, Optional
+from typing import List, Optional, Union
 from .chat import manager as chat_manager
 from .meeting import meeting_manager
-from .tasks import cleanup_old_trash
+from . import counters, frames, notifications, tasks, transfers
 import json
 import os
-from app.email_utils import send_email
-import shutil
 from pathlib import Path
-from fastapi.responses import FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import PlainTextResponse
 import asyncio
-from sqlalchemy import or_, and_, func
+from sqlalchemy import or_, and_, case, func, select, update
 import uuid
 import logging
-from .websocket import room_manager
+from .websocket import InvalidEvent, room_manager
+from .broker import broker
+from .pagination import MAX_PAGE_SIZE
+from .user_cache import CurrentUser
 
 # Configure logging
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-models.Base.metadata.create_all(bind=engine)
-
 app = FastAPI()
 
 @app.on_event("startup")
 async def startup_event():
     # Start the background task for cleaning up trash
-    asyncio.create_task(cleanup_old_trash())
+    asyncio.create_task(tasks.cleanup_old_trash())
+    # Start the SMTP delivery workers and the scheduled-send dispatcher
+    outbox.start()
+    scheduler.start()
+    # Collect stored files nothing references any more
+    blobs.start()
+    # Repair drift in the materialized unread and folder counters
+    counters.start()
+    # Cross-worker pub/sub for rooms and notifications
+    await broker.start()
+    notifications.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await notifications.stop()
+    await broker.stop()
+    await counters.stop()
+    await blobs.stop()
+    await scheduler.stop()
+    await outbox.stop()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus metrics for this worker process"""
+    return metrics.REGISTRY.render()
+
+# Reject oversized request bodies before multipart parsing spools them to disk
+app.add_middleware(uploads.RequestSizeLimitMiddleware, max_bytes=get_settings().UPLOAD_MAX_REQUEST_BYTES)
 
 # CORS middleware configuration
 app.add_middleware(
@@ -71,7 +97,7 @@ async def register_user(user: schemas.UserCreate, db: Session = Depends(get_db))
             detail="Email already registered"
         )
     
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await passwords.hash_password(user.password)
     db_user = models.User(
         email=user.email,
         full_name=user.full_name,
@@ -107,16 +133,21 @@ async def login_for_access_token(
                 headers={"WWW-Authenticate": "Bearer"},
             )
             
-        if not verify_password(password, user.hashed_password):
+        verified, new_hash = await passwords.verify_and_update(password, user.hashed_password)
+        if not verified:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Incorrect password",
                 headers={"WWW-Authenticate": "Bearer"},
             )
+        if new_hash:
+            # Stored hash used an outdated cost factor
+            user.hashed_password = new_hash
+            db.commit()
         
         access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
         access_token = create_access_token(
-            data={"sub": user.email}, expires_delta=access_token_expires
+            data={"sub": user.email, "uid": user.id}, expires_delta=access_token_expires
         )
         
         response_data = {
@@ -145,78 +176,62 @@ CHAT_GIFS_DIR.mkdir(exist_ok=True)
 CHAT_UPLOADS_DIR = Path("/app/chat_uploads")
 CHAT_UPLOADS_DIR.mkdir(exist_ok=True, parents=True)
 
-# Mount static directories
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
-app.mount("/chat_gifs", StaticFiles(directory="chat_gifs"), name="chat_gifs")
-app.mount("/chat_uploads", StaticFiles(directory="chat_uploads"), name="chat_uploads")
+blobs.BLOB_DIR.mkdir(parents=True, exist_ok=True)
+
+# Mount static directories (ranges, ETags and 304s come from downloads.py); user
+# files are only served through signed URLs minted when they are listed
+app.mount("/uploads", downloads.SignedStaticFiles(directory="uploads", prefix="/uploads"), name="uploads")
+app.mount("/chat_gifs", downloads.CachedStaticFiles(directory="chat_gifs", cache_control=downloads.PUBLIC_CACHE), name="chat_gifs")
+app.mount("/chat_uploads", downloads.SignedStaticFiles(directory="chat_uploads", prefix="/chat_uploads"), name="chat_uploads")
+app.mount("/blobs", downloads.SignedStaticFiles(directory=str(blobs.BLOB_DIR), prefix="/blobs", content_addressed=True), name="blobs")
 
 # Email endpoints - Specific routes first
 @app.get("/api/emails/cleanup/trash")
 async def cleanup_trash(
-    db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_user)
 ):
-    # Find emails in trash older than 30 days
-    thirty_days_ago = datetime.now() - timedelta(days=30)
-    old_trash = db.query(models.Email).filter(
-        models.Email.recipient_id == current_user.id,
-        models.Email.status == "trash",
-        models.Email.created_at < thirty_days_ago
-    ).all()
-
-    deleted_count = 0
-    for email in old_trash:
-        # Delete attachments from storage
-        for attachment in email.attachments:
-            try:
-                if os.path.exists(attachment.file_path):
-                    os.remove(attachment.file_path)
-            except Exception as e:
-                print(f"Error deleting attachment file: {str(e)}")
-
-        # Delete email from database
-        db.delete(email)
-        deleted_count += 1
-
-    db.commit()
+    # Delete this user's emails that have been in trash past the retention period
+    deleted_count = await tasks.purge_expired_trash(user_id=current_user.id)
     return {"message": f"Cleaned up {deleted_count} old emails from trash"}
 
-@app.get("/api/emails/inbox", response_model=List[schemas.Email])
+@app.get("/api/emails/counts")
+async def get_folder_counts(
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Total and unread emails per folder and category, from the materialized counters"""
+    return await counters.folder_counts(db, current_user.id)
+
+@app.get("/api/emails/inbox", response_model=Union[schemas.EmailPage, List[schemas.Email]])
 async def read_inbox_emails(
     skip: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db),
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
     current_user: models.User = Depends(get_current_user)
 ):
-    emails = db.query(models.Email).filter(
-        models.Email.recipient_id == current_user.id,
-        models.Email.status == "inbox"
-    ).offset(skip).limit(limit).all()
-    
-    for email in emails:
-        email.sender_email = email.sender_user.email
-        email.recipient_email = email.recipient_user.email
-    return emails
+    stmt = crud.folder_query(current_user.id, "inbox")
+    if cursor is not None:
+        emails, next_cursor = await crud.page_emails(db, stmt, cursor, limit)
+        return schemas.EmailPage(items=emails, next_cursor=next_cursor)
+    return await crud.list_emails(db, stmt, skip, limit)
 
-@app.get("/api/emails/sent", response_model=List[schemas.Email])
+@app.get("/api/emails/sent", response_model=Union[schemas.EmailPage, List[schemas.Email]])
 async def read_sent_emails(
     skip: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db),
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
     current_user: models.User = Depends(get_current_user)
 ):
-    emails = db.query(models.Email).filter(
-        models.Email.sender_id == current_user.id,
-        models.Email.status == "sent"
-    ).offset(skip).limit(limit).all()
-    
-    for email in emails:
-        email.sender_email = email.sender_user.email
-        email.recipient_email = email.recipient_user.email
-    return emails
+    stmt = crud.folder_query(current_user.id, "sent")
+    if cursor is not None:
+        emails, next_cursor = await crud.page_emails(db, stmt, cursor, limit)
+        return schemas.EmailPage(items=emails, next_cursor=next_cursor)
+    return await crud.list_emails(db, stmt, skip, limit)
 
 # Folder routes
-@app.get("/api/folders/{folder}", response_model=List[schemas.Email])
+@app.get("/api/folders/{folder}", response_model=Union[schemas.EmailPage, List[schemas.Email]])
 async def get_folder_emails(
     folder: str,
     category: Optional[str] = None,
@@ -224,98 +239,52 @@ async def get_folder_emails(
     labels: Optional[str] = None,
     search: Optional[str] = None,
     skip: int = 0,
-    limit: int = 100,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     try:
         # Validate folder parameter
-        valid_folders = ["inbox", "sent", "spam", "trash", "draft"]
-        if folder not in valid_folders:
+        if folder not in crud.VALID_FOLDERS:
             raise HTTPException(
                 status_code=422,
-                detail=f"Invalid folder. Must be one of: {', '.join(valid_folders)}"
+                detail=f"Invalid folder. Must be one of: {', '.join(crud.VALID_FOLDERS)}"
             )
 
-        # Build base query
-        query = db.query(models.Email)
-        
-        # Apply folder filter
-        if folder == "sent":
-            query = query.filter(
-                models.Email.sender_id == current_user.id,
-                models.Email.status == "sent"
-            )
-        elif folder == "draft":
-            query = query.filter(
-                models.Email.sender_id == current_user.id,
-                models.Email.is_draft == True
-            )
-        elif folder in ["spam", "trash"]:
-            query = query.filter(
-                or_(
-                    and_(
-                        models.Email.recipient_id == current_user.id,
-                        models.Email.status == folder
-                    ),
-                    and_(
-                        models.Email.sender_id == current_user.id,
-                        models.Email.status == folder
-                    )
-                )
-            )
-        else:  # inbox
-            query = query.filter(
-                models.Email.recipient_id == current_user.id,
-                models.Email.status == "inbox"
-            )
+        # Build base query with the folder filter
+        stmt = select(models.Email).where(crud.folder_filter(current_user.id, folder))
 
         # Apply category filter
         if category:
-            query = query.filter(models.Email.category == category)
+            stmt = stmt.where(models.Email.category == category)
 
         # Apply priority filter
         if priority is not None:
-            query = query.filter(models.Email.priority == priority)
+            stmt = stmt.where(models.Email.priority == priority)
 
         # Apply labels filter
         if labels:
-            label_list = labels.split(",")
-            for label in label_list:
-                query = query.filter(models.Email.labels.like(f"%{label}%"))
+            for label in models.parse_labels(labels):
+                stmt = stmt.where(crud.label_filter(label))
 
         # Apply search filter
         if search:
-            search_term = f"%{search}%"
-            query = query.filter(
-                or_(
-                    models.Email.subject.ilike(search_term),
-                    models.Email.content.ilike(search_term)
-                )
-            )
+            stmt = stmt.where(search_engine.email_match_clause(search))
 
         # Order by priority and created_at
-        query = query.order_by(
-            models.Email.priority.desc(),
-            models.Email.created_at.desc()
-        )
-        
-        # Execute query with pagination
-        emails = query.offset(skip).limit(limit).all()
-        
-        # Add email addresses and ensure attachments are loaded
-        for email in emails:
-            email.sender_email = email.sender_user.email if email.sender_user else None
-            email.recipient_email = email.recipient_user.email if email.recipient_user else None
-            
-            # Load CC and BCC recipients
-            for cc in email.cc_recipients:
-                cc.user_email = cc.user.email if cc.user else None
-            for bcc in email.bcc_recipients:
-                bcc.user_email = bcc.user.email if bcc.user else None
-        
-        return emails
+        stmt = stmt.order_by(*[column.desc() for column in crud.FOLDER_SORT_KEY])
+
+        # Keyset pagination when the client sends a cursor (empty for the first page)
+        if cursor is not None:
+            emails, next_cursor = await crud.page_emails(db, stmt, cursor, limit)
+            return schemas.EmailPage(items=emails, next_cursor=next_cursor)
+
+        # Execute query with pagination; related rows are eager-loaded per page
+        return await crud.list_emails(db, stmt, skip, limit)
 
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error in get_folder_emails: {str(e)}")
         raise HTTPException(
@@ -323,6 +292,163 @@ async def get_folder_emails(
             detail=f"An error occurred while fetching emails: {str(e)}"
         )
 
+# Label routes
+@app.get("/api/labels", response_model=List[schemas.LabelCount])
+async def get_label_counts(
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    return [
+        {"label": label, "total": total, "unread": unread or 0}
+        for label, total, unread in crud.label_counts(db, current_user.id)
+    ]
+
+@app.post("/api/emails/labels")
+async def update_email_labels(
+    update: schemas.BulkLabelUpdate,
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Add and remove labels on many emails at once; the older form of bulk_update_labels"""
+    result = await bulk_update_labels(update, current_user, db)
+    return {"message": "Labels updated successfully", "updated": result.updated}
+
+# Bulk mailbox operations: each is one set-based statement over the selection
+def bulk_selection_filter(selection: schemas.BulkSelection, user_id: int, scope):
+    if selection.email_ids is None and not selection.folder:
+        raise HTTPException(status_code=422, detail="Provide email_ids, a folder, or both")
+    if selection.folder and selection.folder not in crud.VALID_FOLDERS:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Invalid folder. Must be one of: {', '.join(crud.VALID_FOLDERS)}"
+        )
+    if selection.email_ids is not None and len(selection.email_ids) > crud.BULK_MAX_IDS:
+        raise HTTPException(status_code=422, detail=f"At most {crud.BULK_MAX_IDS} email ids per request")
+    return crud.bulk_filter(user_id, selection, scope)
+
+@app.post("/api/emails/bulk/status", response_model=schemas.BulkResult)
+async def bulk_update_email_status(
+    update: schemas.BulkStatusUpdate,
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Move many emails between folders, as update_email_status does for one"""
+    if update.status not in ["inbox", "spam", "trash", "sent"]:
+        raise HTTPException(status_code=400, detail="Invalid status")
+    where = bulk_selection_filter(update, current_user.id, or_(
+        models.Email.recipient_id == current_user.id,
+        models.Email.sender_id == current_user.id
+    ))
+    # Restoring to the inbox puts the user's own emails back in sent
+    new_status = update.status
+    if update.status == "inbox":
+        new_status = case((models.Email.sender_id == current_user.id, "sent"), else_="inbox")
+    try:
+        if update.status in ("spam", "trash"):
+            scheduler.cancel(db, select(models.Email.id).where(where))
+        done = crud.bulk_update(db, where, {"status": new_status})
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    notifications.publish([current_user.id], notifications.counters_event("mailbox"))
+    return crud.bulk_result(update, done, "Email not found")
+
+@app.post("/api/emails/bulk/read", response_model=schemas.BulkResult)
+async def bulk_mark_read(
+    update: schemas.BulkReadUpdate,
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Mark many emails read or unread"""
+    where = bulk_selection_filter(update, current_user.id, crud.mailbox_filter(current_user.id))
+    try:
+        done = crud.bulk_update(db, where, {"is_read": update.is_read})
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    notifications.publish([current_user.id], notifications.counters_event("mailbox"))
+    return crud.bulk_result(update, done, "Email not found")
+
+@app.post("/api/emails/bulk/labels", response_model=schemas.BulkResult)
+async def bulk_update_labels(
+    update: schemas.BulkLabelUpdate,
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Add and remove labels on a selection of emails"""
+    where = bulk_selection_filter(update, current_user.id, crud.mailbox_filter(current_user.id))
+    add = models.parse_labels(",".join(update.add))
+    remove = [label for label in models.parse_labels(",".join(update.remove)) if label not in add]
+    selected = select(models.Email.id).where(where)
+    try:
+        done = db.scalars(selected).all()
+        crud.remove_labels(db, selected, remove)
+        crud.add_labels(db, selected, add)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    return crud.bulk_result(update, done, "Email not found")
+
+@app.post("/api/emails/bulk/delete", response_model=schemas.BulkResult)
+async def bulk_delete_emails(
+    selection: schemas.BulkSelection,
+    background_tasks: BackgroundTasks,
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Permanently delete many emails from trash or spam, as delete_email_permanently does for one"""
+    where = bulk_selection_filter(selection, current_user.id, and_(
+        models.Email.recipient_id == current_user.id,
+        models.Email.status.in_(["trash", "spam"])
+    ))
+    try:
+        done, legacy_paths = crud.bulk_delete(db, where)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    notifications.publish([current_user.id], notifications.counters_event("mailbox"))
+    background_tasks.add_task(blobs.remove_unreferenced_files, legacy_paths)
+    return crud.bulk_result(selection, done, "Email not found in trash or spam")
+
+# Search routes
+@app.get("/api/search/emails", response_model=List[schemas.EmailSearchHit])
+async def search_emails(
+    q: str,
+    folder: Optional[str] = None,
+    limit: int = 20,
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    if folder and folder not in crud.VALID_FOLDERS:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Invalid folder. Must be one of: {', '.join(crud.VALID_FOLDERS)}"
+        )
+    set_statement_timeout(db, get_settings().DB_SEARCH_STATEMENT_TIMEOUT_MS)
+    hits = search_engine.search_emails(db, current_user.id, q, folder=folder, limit=min(limit, 100))
+    return [
+        {"email": email, "rank": rank, "snippet": snippet}
+        for email, rank, snippet in hits
+    ]
+
+@app.get("/api/search/chat", response_model=List[schemas.ChatMessageSearchHit])
+async def search_chat_messages(
+    q: str,
+    limit: int = 20,
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    set_statement_timeout(db, get_settings().DB_SEARCH_STATEMENT_TIMEOUT_MS)
+    hits = search_engine.search_chat_messages(db, current_user.id, q, limit=min(limit, 100))
+    return [
+        {"message": message, "rank": rank, "snippet": snippet}
+        for message, rank, snippet in hits
+    ]
+
 # Email CRUD routes with ID parameter
 @app.post("/api/emails", response_model=schemas.Email)
 async def create_email(
@@ -370,6 +496,21 @@ async def create_email(
         if not thread_id:
             thread_id = str(uuid.uuid4())
 
+        send_at = datetime.fromisoformat(scheduled_for) if scheduled_for else None
+
+        # Store attachments before writing any rows: the blob store registers each
+        # file in its own short transaction, which must not wait on ours
+        stored_attachments = []
+        if attachments:
+            for attachment in attachments:
+                try:
+                    stored_attachments.append((attachment, await blobs.store_upload(attachment)))
+                except HTTPException:
+                    raise
+                except Exception as e:
+                    logger.error(f"Error processing attachment {attachment.filename}: {str(e)}")
+                    continue
+
         try:
             # Create sent email for sender
             sent_email = models.Email(
@@ -378,7 +519,7 @@ async def create_email(
                 sender_id=current_user.id,
                 recipient_id=recipient.id,
                 status="sent" if not is_draft else "draft",
-                scheduled_for=datetime.fromisoformat(scheduled_for) if scheduled_for else None,
+                scheduled_for=send_at,
                 category=category,
                 priority=priority,
                 thread_id=thread_id,
@@ -389,8 +530,10 @@ async def create_email(
             db.add(sent_email)
             db.flush()  # Get the ID without committing
 
-            # Create inbox email for recipient (only if not draft)
-            if not is_draft:
+            # Create inbox email for recipient (only if not draft; scheduled emails
+            # reach the inbox when the scheduler dispatches them)
+            inbox_email = None
+            if not is_draft and not send_at:
                 inbox_email = models.Email(
                     subject=subject,
                     content=content,
@@ -406,39 +549,44 @@ async def create_email(
                 db.add(inbox_email)
                 db.flush()
 
-            # Save attachments
-            if attachments:
-                for attachment in attachments:
-                    try:
-                        # Create unique filename
-                        file_path = UPLOAD_DIR / f"{sent_email.id}_{attachment.filename}"
-                        
-                        # Save file
-                        with file_path.open("wb") as buffer:
-                            shutil.copyfileobj(attachment.file, buffer)
-                        
-                        # Create attachment records
-                        sent_attachment = models.Attachment(
-                            filename=attachment.filename,
-                            content_type=attachment.content_type,
-                            file_path=str(file_path),
-                            size=os.path.getsize(file_path),
-                            email_id=sent_email.id
-                        )
-                        db.add(sent_attachment)
-
-                        if not is_draft:
-                            inbox_attachment = models.Attachment(
-                                filename=attachment.filename,
-                                content_type=attachment.content_type,
-                                file_path=str(file_path),
-                                size=os.path.getsize(file_path),
-                                email_id=inbox_email.id
-                            )
-                            db.add(inbox_attachment)
-                    except Exception as e:
-                        logger.error(f"Error processing attachment {attachment.filename}: {str(e)}")
-                        continue
+            # Reference the stored files from both copies
+            saved_attachments = []
+            for attachment, stored in stored_attachments:
+                sent_attachment = models.Attachment(
+                    filename=attachment.filename,
+                    content_type=attachment.content_type,
+                    file_path=str(stored.path),
+                    size=stored.size,
+                    content_hash=stored.sha256,
+                    email_id=sent_email.id
+                )
+                db.add(sent_attachment)
+                saved_attachments.append({"filename": attachment.filename, "path": str(stored.path)})
+
+                if inbox_email is not None:
+                    inbox_attachment = models.Attachment(
+                        filename=attachment.filename,
+                        content_type=attachment.content_type,
+                        file_path=str(stored.path),
+                        size=stored.size,
+                        content_hash=stored.sha256,
+                        email_id=inbox_email.id
+                    )
+                    db.add(inbox_attachment)
+
+            # Queue SMTP delivery in the same transaction (only if not draft); a scheduled
+            # email's job is held until the scheduler releases it
+            if not is_draft:
+                outbox.enqueue(
+                    db,
+                    to_email=recipient.email,
+                    subject=subject,
+                    content=content,
+                    cc_list=cc_list,
+                    attachments=saved_attachments,
+                    email_id=sent_email.id,
+                    scheduled_for=send_at
+                )
 
             # Commit all changes
             db.commit()
@@ -448,34 +596,20 @@ async def create_email(
             sent_email.sender_email = current_user.email
             sent_email.recipient_email = recipient.email
 
-            # Send actual email using SMTP (only if not draft and not scheduled)
-            if not is_draft and not scheduled_for:
-                try:
-                    success, error_msg = send_email(
-                        to_email=recipient.email,
-                        subject=subject,
-                        content=content,
-                        attachments=[
-                            {
-                                "filename": attachment.filename,
-                                "path": str(UPLOAD_DIR / f"{sent_email.id}_{attachment.filename}")
-                            }
-                            for attachment in (attachments or [])
-                        ],
-                        cc_list=cc_list
-                    )
-                    
-                    if not success:
-                        logger.warning(f"Email saved to database but SMTP delivery failed: {error_msg}")
-                        # Don't raise an exception, just log the warning
-                        # The email is still saved in the database
-                except Exception as smtp_error:
-                    logger.warning(f"Email saved to database but SMTP delivery failed: {str(smtp_error)}")
-                    # Don't raise an exception, just log the warning
-                    # The email is still saved in the database
-            
+            outbox.notify()
+
+            if inbox_email is not None:
+                notifications.publish([recipient.id], notifications.email_event(inbox_email, "inbox", current_user.email))
+            notifications.publish(
+                [current_user.id],
+                notifications.email_event(sent_email, "draft" if is_draft else "sent", current_user.email)
+            )
+
             return sent_email
 
+        except HTTPException:
+            db.rollback()
+            raise
         except Exception as db_error:
             db.rollback()
             raise HTTPException(
@@ -517,6 +651,23 @@ async def read_email(
             detail="Invalid email ID format. Must be an integer."
         )
 
+@app.get("/api/emails/{email_id}/delivery", response_model=List[schemas.DeliveryStatus])
+async def get_email_delivery_status(
+    email_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    """SMTP delivery status of a sent email"""
+    email = await db.get(models.Email, email_id)
+    if email is None or email.sender_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Email not found")
+    result = await db.execute(
+        select(models.OutboundEmail)
+        .where(models.OutboundEmail.email_id == email_id)
+        .order_by(models.OutboundEmail.id)
+    )
+    return result.scalars().all()
+
 @app.put("/api/emails/{email_id}/status")
 async def update_email_status(
     email_id: int,
@@ -543,14 +694,19 @@ async def update_email_status(
         email.status = "sent"  # Restore to sent folder if user was the sender
     else:
         email.status = status_update["status"]
+    if email.status in ("spam", "trash"):
+        scheduler.cancel(db, [email.id])
 
     db.commit()
+    # Both sides of an email share its row, so both folders may have changed
+    notifications.publish([email.sender_id, email.recipient_id], notifications.counters_event("mailbox"))
 
     return {"message": "Email status updated successfully"}
 
 @app.delete("/api/emails/{email_id}")
 async def delete_email_permanently(
     email_id: int,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_user)
 ):
@@ -564,106 +720,98 @@ async def delete_email_permanently(
     if not email:
         raise HTTPException(status_code=404, detail="Email not found in trash or spam")
 
-    # Delete attachments from storage
-    for attachment in email.attachments:
-        try:
-            # Delete the file from storage
-            if os.path.exists(attachment.file_path):
-                os.remove(attachment.file_path)
-        except Exception as e:
-            print(f"Error deleting attachment file: {str(e)}")
+    # The recipient's or sender's copy may still use the files; the blob
+    # collector removes them once nothing references them
+    legacy_paths = blobs.legacy_paths(email.attachments)
 
     # Delete email from database (this will cascade delete attachments)
+    outbox.cancel_scheduled(db, [email.id])
     db.delete(email)
     db.commit()
+    notifications.publish([current_user.id], notifications.counters_event("mailbox"))
+    background_tasks.add_task(blobs.remove_unreferenced_files, legacy_paths)
 
     return {"message": "Email permanently deleted"}
 
-@app.get("/api/emails/inbox", response_model=List[schemas.Email])
-async def read_inbox_emails(
-    skip: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
-):
-    emails = db.query(models.Email).filter(
-        models.Email.recipient_id == current_user.id,
-        models.Email.status == "inbox"
-    ).offset(skip).limit(limit).all()
-    
-    for email in emails:
-        email.sender_email = email.sender_user.email
-        email.recipient_email = email.recipient_user.email
-    return emails
-
-@app.get("/api/emails/sent", response_model=List[schemas.Email])
-async def read_sent_emails(
-    skip: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
-):
-    emails = db.query(models.Email).filter(
-        models.Email.sender_id == current_user.id,
-        models.Email.status == "sent"
-    ).offset(skip).limit(limit).all()
-    
-    for email in emails:
-        email.sender_email = email.sender_user.email
-        email.recipient_email = email.recipient_user.email
-    return emails
-
-@app.get("/api/emails/sent")
-async def get_sent_emails(
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
-    emails = (
-        db.query(models.Email)
-        .filter(models.Email.sender_id == current_user.id)
-        .order_by(models.Email.created_at.desc())
-        .all()
-    )
-    
-    return [
-        {
-            "id": email.id,
-            "subject": email.subject,
-            "content": email.content,
-            "recipient_email": email.recipient_user.email,
-            "created_at": email.created_at,
-            "is_read": email.is_read
-        }
-        for email in emails
-    ]
+WS_AUTH_SUBPROTOCOL = "bearer"
+WS_QUERY_TOKENS = metrics.counter("ws_query_token_logins_total", "Websocket logins with the deprecated ?token= parameter")
+
+async def authenticate_websocket(websocket: WebSocket, query_token: Optional[str] = None) -> Optional[CurrentUser]:
+    """
+    Accept a websocket and return its user, or close it with 4401 and return None.
+
+    Browsers cannot set headers on websockets, so the JWT comes as the value
+    after "bearer" in Sec-WebSocket-Protocol (new WebSocket(url, ["bearer", token]))
+    or, failing that, in a first {"type": "auth", "token": ...} message. A token
+    in the query string still works but ends up in proxy and access logs; it is
+    deprecated.
+    """
+    protocols = websocket.scope.get("subprotocols") or []
+    token = subprotocol = None
+    if WS_AUTH_SUBPROTOCOL in protocols[:-1]:
+        token = protocols[protocols.index(WS_AUTH_SUBPROTOCOL) + 1]
+        subprotocol = WS_AUTH_SUBPROTOCOL
+    elif query_token:
+        WS_QUERY_TOKENS.inc()
+        token = query_token
+
+    if token is not None:
+        try:
+            async with AsyncSessionLocal() as db:
+                user = await get_current_user(token, db)
+        except HTTPException:
+            await websocket.close(code=4401)
+            return None
+        await websocket.accept(subprotocol=subprotocol)
+        return user
+
+    await websocket.accept()
+    try:
+        message = await asyncio.wait_for(websocket.receive_json(), timeout=get_settings().WS_AUTH_TIMEOUT_SECONDS)
+        if isinstance(message, dict) and message.get("type") == "auth" and isinstance(message.get("token"), str):
+            async with AsyncSessionLocal() as db:
+                return await get_current_user(message["token"], db)
+    except WebSocketDisconnect:
+        return None
+    except (HTTPException, asyncio.TimeoutError, KeyError, ValueError):
+        pass
+    await websocket.close(code=4401)
+    return None
+
+# Per-user notification channel
+@app.websocket("/ws/user")
+async def user_websocket(websocket: WebSocket, token: str = None):
+    user = await authenticate_websocket(websocket, token)
+    if user is None:
+        return
+    await notifications.hub.serve(websocket, user.id)
 
 # Chat WebSocket endpoint
 @app.websocket("/ws/chat/{room_id}")
 async def chat_websocket(
     websocket: WebSocket,
     room_id: str,
-    user_id: str = None,
-    user_name: str = None
+    token: str = None,
+    last_seq: Optional[int] = None
 ):
-    if not user_id or not user_name:
-        await websocket.close(code=4000)
+    # Uploads are stored and handed out as signed URLs, so only logged-in users
+    # may connect, under the id in their token
+    user = await authenticate_websocket(websocket, token)
+    if user is None:
         return
+    user_id = str(user.id)
 
-    room = room_manager.create_room(room_id)
+    room = await room_manager.create_room(room_id)
     user_data = {
         "id": user_id,
-        "name": user_name,
+        "name": user.full_name or user.email,
         "joined_at": datetime.now().isoformat()
     }
 
+    outbound = None
     try:
-        await room.connect(websocket, user_id, user_data)
-        
-        # Send room state to the new user
-        await websocket.send_json({
-            "type": "room_state",
-            "data": room.get_room_state()
-        })
+        # Queues the room state, or only what was missed for a client resuming from last_seq
+        outbound = await room.connect(websocket, user_id, user_data, last_seq)
         
         # Notify others about the new user
         await room.broadcast(
@@ -674,38 +822,56 @@ async def chat_websocket(
             exclude_user=user_id
         )
 
-        while True:
-            try:
-                data = await websocket.receive_json()
-                await room.broadcast(data)
-            except WebSocketDisconnect:
-                break
+        # Text frames are JSON events; binary frames carry file chunks (see transfers.py)
+        file_transfers = transfers.Transfers(room, user_id, outbound)
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("bytes") is not None:
+                    await file_transfers.receive(message["bytes"])
+                    continue
+                data = frames.loads(message["text"])
+                if data.get("type") == "file_start":
+                    await file_transfers.start(data)
+                else:
+                    try:
+                        await room.receive(data, user_id)
+                    except InvalidEvent as e:
+                        outbound.send(frames.dumps({"type": "error", "message": str(e)}))
+        finally:
+            await file_transfers.close()
 
     except WebSocketDisconnect:
-        room.disconnect(user_id)
-        await room.broadcast(
-            {
-                "type": "user_left",
-                "user_id": user_id
-            },
-            exclude_user=user_id
-        )
-        
-        if len(room.connections) == 0:
-            room_manager.delete_room(room_id)
+        pass
+    finally:
+        # Leave the room however the connection ended, or its presence outlives us;
+        # unless the user already reconnected and replaced this connection
+        if await room.disconnect(user_id, outbound):
+            await room.broadcast(
+                {
+                    "type": "user_left",
+                    "user_id": user_id
+                },
+                exclude_user=user_id
+            )
+        await room_manager.release_room(room_id)
 
 @app.get("/api/chat/files/{room_id}/{filename}")
 async def get_chat_file(
     room_id: str,
     filename: str,
+    request: Request,
     current_user: models.User = Depends(get_current_user)
 ):
     file_path = UPLOAD_DIR / f"{room_id}_{filename}"
     if not file_path.exists():
         raise HTTPException(status_code=404, detail="File not found")
     
-    return FileResponse(
-        str(file_path),
+    return downloads.file_response(
+        request,
+        file_path,
         filename=filename,
         media_type="application/octet-stream"
     )
@@ -716,27 +882,24 @@ async def meeting_websocket(
     websocket: WebSocket,
     room_id: str,
     user_id: str = None,
-    user_name: str = None
+    user_name: str = None,
+    last_seq: Optional[int] = None
 ):
     if not user_id or not user_name:
         await websocket.close(code=4000)
         return
 
-    room = room_manager.create_room(room_id)
+    room = await room_manager.create_room(room_id)
     user_data = {
         "id": user_id,
         "name": user_name,
         "joined_at": datetime.now().isoformat()
     }
 
+    outbound = None
     try:
-        await room.connect(websocket, user_id, user_data)
-        
-        # Send room state to the new user
-        await websocket.send_json({
-            "type": "room_state",
-            "data": room.get_room_state()
-        })
+        # Queues the room state, or only what was missed for a client resuming from last_seq
+        outbound = await room.connect(websocket, user_id, user_data, last_seq)
         
         # Notify others about the new user
         await room.broadcast(
@@ -756,28 +919,30 @@ async def meeting_websocket(
                     target_user_id = data.get("target_user_id")
                     if target_user_id:
                         await room.send_to_user(target_user_id, data)
-                # Handle media state updates
-                elif data["type"] == "media_state":
-                    await room.broadcast(data)
-                # Handle chat messages and other updates
+                # Handle media state updates, chat messages and other updates
                 else:
-                    await room.broadcast(data)
+                    try:
+                        await room.receive(data, user_id)
+                    except InvalidEvent as e:
+                        outbound.send(frames.dumps({"type": "error", "message": str(e)}))
                     
             except WebSocketDisconnect:
                 break
 
     except WebSocketDisconnect:
-        room.disconnect(user_id)
-        await room.broadcast(
-            {
-                "type": "user_left",
-                "user_id": user_id
-            },
-            exclude_user=user_id
-        )
-        
-        if len(room.connections) == 0:
-            room_manager.delete_room(room_id)
+        pass
+    finally:
+        # Leave the room however the connection ended, or its presence outlives us;
+        # unless the user already reconnected and replaced this connection
+        if await room.disconnect(user_id, outbound):
+            await room.broadcast(
+                {
+                    "type": "user_left",
+                    "user_id": user_id
+                },
+                exclude_user=user_id
+            )
+        await room_manager.release_room(room_id)
 
 # Meeting management endpoints
 @app.post("/api/meetings", response_model=schemas.Meeting)
@@ -1004,6 +1169,14 @@ async def get_user_chat_groups(
     
     return groups
 
+def chat_participants(db: Session, message: models.ChatMessage) -> List[int]:
+    """Users who see a chat message: both sides of a private chat, or every group member"""
+    if message.group_id:
+        return db.scalars(
+            select(models.ChatGroupMember.user_id).where(models.ChatGroupMember.group_id == message.group_id)
+        ).all()
+    return [message.sender_id, message.recipient_id]
+
 @app.post("/api/chat/messages", response_model=schemas.ChatMessage)
 async def create_chat_message(
     content: str = Form(""),  # Make content optional with empty string as default
@@ -1038,6 +1211,7 @@ async def create_chat_message(
     file_name = None
     file_type = None
     file_size = None
+    file_hash = None
     voice_message_path = None
 
     try:
@@ -1048,32 +1222,27 @@ async def create_chat_message(
             # Generate safe filename with timestamp and user ID
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             original_filename = file.filename
-            safe_filename = f"{current_user.id}_{timestamp}_{original_filename}"
-            
-            # Determine the full file path
-            full_path = CHAT_UPLOADS_DIR / safe_filename
+            safe_filename = f"{current_user.id}_{timestamp}_{uploads.safe_filename(original_filename)}"
             
             try:
-                # Save the file using a buffer to handle large files efficiently
-                with open(full_path, "wb") as buffer:
-                    shutil.copyfileobj(file.file, buffer)
-                
-                # Get file size after saving
-                file_size = os.path.getsize(full_path)
+                # Stream the file into the blob store off the event loop
+                stored = await blobs.store_upload(file)
+                file_size = stored.size
+                file_hash = stored.sha256
                 
                 if is_voice_message:
-                    voice_message_path = str(full_path)
+                    voice_message_path = str(stored.path)
                 else:
-                    file_path = str(full_path)
+                    file_path = str(stored.path)
                 
                 file_name = safe_filename
                 file_type = file.content_type
 
+            except HTTPException:
+                raise
             except Exception as e:
-                # If file saving fails, log the error and clean up
+                # If file saving fails, log the error (the blob store cleans up after itself)
                 logger.error(f"Error saving file {safe_filename}: {str(e)}")
-                if os.path.exists(full_path):
-                    os.remove(full_path)
                 raise HTTPException(
                     status_code=500,
                     detail="Failed to save file"
@@ -1092,6 +1261,7 @@ async def create_chat_message(
             file_name=file_name,
             file_type=file_type,
             file_size=file_size,
+            file_hash=file_hash,
             is_voice_message=is_voice_message,
             voice_message_path=voice_message_path,
             voice_duration=voice_duration
@@ -1106,15 +1276,18 @@ async def create_chat_message(
         if recipient_id:
             chat_message.recipient_email = recipient.email
 
+        notifications.publish(chat_participants(db, chat_message), {
+            "type": "chat_message",
+            "message": schemas.ChatMessage.model_validate(chat_message).model_dump(mode="json")
+        })
+
         return chat_message
 
+    except HTTPException:
+        db.rollback()
+        raise
     except Exception as e:
-        # If anything fails, clean up any saved files
-        if file_path and os.path.exists(file_path):
-            os.remove(file_path)
-        if voice_message_path and os.path.exists(voice_message_path):
-            os.remove(voice_message_path)
-            
+        # A stored file nothing ends up referencing is removed by the blob collector
         logger.error(f"Error creating chat message: {str(e)}")
         db.rollback()
         raise HTTPException(
@@ -1150,11 +1323,16 @@ async def add_reaction(
     # Save reactions
     message.reactions = json.dumps(reactions)
     db.commit()
+    notifications.publish(chat_participants(db, message), {
+        "type": "chat_reaction",
+        "message_id": message_id,
+        "reactions": reactions
+    })
     
     return {"message": "Reaction updated successfully"}
 
 @app.get("/api/chat/files/{filename}")
-async def get_chat_file(filename: str, current_user: models.User = Depends(get_current_user)):
+async def get_chat_file(filename: str, request: Request, current_user: models.User = Depends(get_current_user)):
     try:
         # Determine content type based on file extension
         content_type = "application/octet-stream"
@@ -1173,23 +1351,28 @@ async def get_chat_file(filename: str, current_user: models.User = Depends(get_c
         if not os.path.exists(file_path):
             raise HTTPException(status_code=404, detail="File not found")
 
-        return FileResponse(
+        return downloads.file_response(
+            request,
             file_path,
             media_type=content_type,
             filename=filename
         )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error serving file {filename}: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/chat/messages/{user_id}", response_model=List[schemas.ChatMessage])
+@app.get("/api/chat/messages/{user_id}", response_model=Union[schemas.ChatMessagePage, List[schemas.ChatMessage]])
 async def get_private_chat_messages(
     user_id: int,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     # Get messages between current user and specified user
-    messages = db.query(models.ChatMessage).filter(
+    stmt = select(models.ChatMessage).where(
         or_(
             and_(
                 models.ChatMessage.sender_id == current_user.id,
@@ -1200,41 +1383,59 @@ async def get_private_chat_messages(
                 models.ChatMessage.recipient_id == current_user.id
             )
         )
-    ).order_by(models.ChatMessage.created_at.asc()).all()
-
-    # Add sender and recipient emails
-    for msg in messages:
-        msg.sender_email = msg.sender.email
-        if msg.recipient_id:
-            msg.recipient_email = msg.recipient.email
+    )
 
+    messages, next_cursor = await crud.list_chat_messages(db, stmt, cursor, limit)
+    if cursor is not None:
+        return schemas.ChatMessagePage(items=messages, next_cursor=next_cursor)
     return messages
 
-@app.get("/api/chat/groups/{group_id}/messages", response_model=List[schemas.ChatMessage])
+@app.get("/api/chat/groups/{group_id}/messages", response_model=Union[schemas.ChatMessagePage, List[schemas.ChatMessage]])
 async def get_group_chat_messages(
     group_id: int,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     # Check if user is member of the group
-    is_member = db.query(models.ChatGroupMember).filter(
+    is_member = (await db.execute(select(models.ChatGroupMember.id).where(
         models.ChatGroupMember.group_id == group_id,
         models.ChatGroupMember.user_id == current_user.id
-    ).first()
+    ))).first()
     if not is_member:
         raise HTTPException(status_code=403, detail="You are not a member of this group")
 
-    # Get all messages in the group
-    messages = db.query(models.ChatMessage).filter(
+    # Get messages in the group
+    stmt = select(models.ChatMessage).where(
         models.ChatMessage.group_id == group_id
-    ).order_by(models.ChatMessage.created_at.asc()).all()
-
-    # Add sender emails
-    for msg in messages:
-        msg.sender_email = msg.sender.email
+    )
 
+    messages, next_cursor = await crud.list_chat_messages(db, stmt, cursor, limit)
+    if cursor is not None:
+        return schemas.ChatMessagePage(items=messages, next_cursor=next_cursor)
     return messages
 
+@app.get("/api/chat/groups/unread-counts")
+async def get_group_unread_counts(
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Get unread message counts for each group"""
+    return await counters.chat_unread_counts(db, current_user.id, "group")
+
+@app.put("/api/chat/groups/{group_id}/read")
+async def mark_group_read(
+    group_id: int,
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    if not counters.mark_group_read(db, current_user.id, group_id):
+        raise HTTPException(status_code=403, detail="Not a member of this group")
+    db.commit()
+    notifications.publish([current_user.id], notifications.counters_event("chat"))
+    return {"message": "Group marked as read"}
+
 @app.post("/api/chat/groups/{group_id}/members")
 async def add_group_members(
     group_id: int,
@@ -1285,6 +1486,7 @@ async def get_users(
 async def get_email_attachment(
     email_id: int,
     filename: str,
+    request: Request,
     current_user: models.User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -1307,10 +1509,12 @@ async def get_email_attachment(
     if not os.path.exists(attachment.file_path):
         raise HTTPException(status_code=404, detail="Attachment file not found")
 
-    return FileResponse(
+    return downloads.file_response(
+        request,
         attachment.file_path,
         filename=attachment.filename,
-        media_type=attachment.content_type or "application/octet-stream"
+        media_type=attachment.content_type or "application/octet-stream",
+        content_hash=attachment.content_hash
     )
 
 @app.get("/api/users/me", response_model=schemas.User)
@@ -1328,12 +1532,26 @@ async def mark_messages_as_read(
     """Mark multiple messages as read"""
     try:
         # Update messages where the current user is the recipient
-        db.query(models.ChatMessage).filter(
-            models.ChatMessage.id.in_(message_ids),
-            models.ChatMessage.recipient_id == current_user.id
-        ).update({"is_read": True}, synchronize_session=False)
+        read = db.execute(
+            update(models.ChatMessage)
+            .where(
+                models.ChatMessage.id.in_(message_ids),
+                models.ChatMessage.recipient_id == current_user.id
+            )
+            .values(is_read=True)
+            .returning(models.ChatMessage.id, models.ChatMessage.sender_id)
+            .execution_options(synchronize_session=False)
+        ).all()
         
         db.commit()
+
+        # Read receipts for the senders, fresh counts for the reader's other tabs
+        read_by_sender = {}
+        for message_id, sender_id in read:
+            read_by_sender.setdefault(sender_id, []).append(message_id)
+        for sender_id, ids in read_by_sender.items():
+            notifications.publish([sender_id], {"type": "chat_read", "reader_id": current_user.id, "message_ids": ids})
+        notifications.publish([current_user.id], notifications.counters_event("chat"))
         return {"message": "Messages marked as read"}
     except Exception as e:
         db.rollback()
@@ -1342,24 +1560,10 @@ async def mark_messages_as_read(
 @app.get("/api/chat/unread-counts")
 async def get_unread_counts(
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get unread message counts for each sender"""
     try:
-        # Get all unread messages where current user is recipient
-        unread_messages = db.query(
-            models.ChatMessage.sender_id,
-            func.count(models.ChatMessage.id).label('count')
-        ).filter(
-            models.ChatMessage.recipient_id == current_user.id,
-            models.ChatMessage.is_read == False
-        ).group_by(
-            models.ChatMessage.sender_id
-        ).all()
-        
-        # Convert to dictionary with sender_id as key
-        unread_counts = {str(sender_id): count for sender_id, count in unread_messages}
-        
-        return unread_counts
+        return await counters.chat_unread_counts(db, current_user.id, "user")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
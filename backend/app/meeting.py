@@ -1,8 +1,9 @@
 from fastapi import WebSocket
 from typing import Dict, Set, Optional
-import json
 import uuid
 from datetime import datetime
+from . import frames
+from .outbound import Outbound
 
 class Participant:
     def __init__(self, user_id: str, name: str, websocket: WebSocket):
@@ -31,7 +32,7 @@ class MeetingRoom:
 
 class MeetingManager:
     def __init__(self):
-        self.active_connections: Dict[str, Dict[str, WebSocket]] = {}
+        self.active_connections: Dict[str, Dict[str, Outbound]] = {}
         self.user_names: Dict[str, Dict[str, str]] = {}
 
     def create_meeting(self, host_id: str, title: str) -> str:
@@ -44,11 +45,14 @@ class MeetingManager:
             self.active_connections[room_id] = {}
             self.user_names[room_id] = {}
         
-        self.active_connections[room_id][user_id] = websocket
+        previous = self.active_connections[room_id].get(user_id)
+        if previous is not None:
+            previous.cancel()
+        outbound = self.active_connections[room_id][user_id] = Outbound(websocket)
         self.user_names[room_id][user_id] = name
 
         # Send current participants to the new user
-        await websocket.send_json({
+        outbound.send({
             "type": "participants",
             "participants": [
                 {"id": uid, "name": uname}
@@ -60,7 +64,7 @@ class MeetingManager:
     def disconnect(self, websocket: WebSocket, room_id: str, user_id: str):
         if room_id in self.active_connections:
             if user_id in self.active_connections[room_id]:
-                del self.active_connections[room_id][user_id]
+                self.active_connections[room_id].pop(user_id).cancel()
             if user_id in self.user_names[room_id]:
                 del self.user_names[room_id][user_id]
             
@@ -68,11 +72,13 @@ class MeetingManager:
                 del self.active_connections[room_id]
                 del self.user_names[room_id]
 
-    async def broadcast_signal(self, message: dict, room_id: str, sender_socket: WebSocket):
+    async def broadcast_signal(self, message: dict, room_id: str, sender_socket: WebSocket, key=None):
         if room_id in self.active_connections:
-            for user_id, connection in self.active_connections[room_id].items():
-                if connection != sender_socket:  # Don't send back to sender
-                    await connection.send_json(message)
+            # Encoded once and queued per connection; a slow peer never holds up the others
+            frame = frames.dumps(message)
+            for user_id, outbound in self.active_connections[room_id].items():
+                if outbound.websocket != sender_socket:  # Don't send back to sender
+                    outbound.send(frame, key)
 
     async def handle_offer(self, offer: dict, room_id: str, sender_socket: WebSocket, sender_id: str):
         message = {
@@ -104,6 +110,6 @@ class MeetingManager:
             "status": status,
             "userId": sender_id
         }
-        await self.broadcast_signal(message, room_id, sender_socket)
+        await self.broadcast_signal(message, room_id, sender_socket, key=("media-status", sender_id))
 
 meeting_manager = MeetingManager()
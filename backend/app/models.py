@@ -1,5 +1,5 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime, Text
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime, Text, Index, text
+from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
 
@@ -21,6 +21,27 @@ class User(Base):
     sent_messages = relationship("ChatMessage", back_populates="sender", foreign_keys="[ChatMessage.sender_id]")
     received_messages = relationship("ChatMessage", back_populates="recipient", foreign_keys="[ChatMessage.recipient_id]")
 
+class Blob(Base):
+    """
+    A stored file, addressed by its SHA-256. refcount counts the attachments and
+    chat messages pointing at it and is kept up to date by database triggers
+    (migration 0008); blobs.py collects the ones nothing references any more.
+    """
+    __tablename__ = "blobs"
+
+    sha256 = Column(String(64), primary_key=True)
+    size = Column(Integer, nullable=False)
+    refcount = Column(Integer, nullable=False, default=0, server_default="0")
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    orphaned_at = Column(DateTime(timezone=True))  # When refcount last dropped to 0
+
+    __table_args__ = (
+        Index(
+            "ix_blobs_orphaned", "orphaned_at",
+            postgresql_where=text("refcount = 0"), sqlite_where=text("refcount = 0")
+        ),
+    )
+
 class Attachment(Base):
     __tablename__ = "attachments"
 
@@ -29,7 +50,8 @@ class Attachment(Base):
     content_type = Column(String)
     file_path = Column(String)
     size = Column(Integer)
-    email_id = Column(Integer, ForeignKey("emails.id"))
+    content_hash = Column(String(64), nullable=True)  # SHA-256 of the content; the Blob holding it
+    email_id = Column(Integer, ForeignKey("emails.id"), index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     # Relationship
@@ -48,25 +70,80 @@ class Email(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     scheduled_for = Column(DateTime(timezone=True), nullable=True)
     category = Column(String, default="primary")  # Values: primary, social, promotions, updates
-    priority = Column(Integer, default=0)  # 0: normal, 1: important, 2: urgent
+    priority = Column(Integer, nullable=False, default=0, server_default="0")  # 0: normal, 1: important, 2: urgent
     thread_id = Column(String, index=True)  # For grouping conversations
-    in_reply_to = Column(Integer, ForeignKey("emails.id"), nullable=True)  # For threading
+    in_reply_to = Column(Integer, ForeignKey("emails.id"), nullable=True, index=True)  # For threading
     is_draft = Column(Boolean, default=False)
-    labels = Column(String)  # Comma-separated list of labels
+    dispatched_at = Column(DateTime(timezone=True), nullable=True)  # When the scheduler delivered (or cancelled) a scheduled email
 
     # Relationships
     sender_user = relationship("User", back_populates="sent_emails", foreign_keys=[sender_id])
     recipient_user = relationship("User", back_populates="received_emails", foreign_keys=[recipient_id])
     attachments = relationship("Attachment", back_populates="email", cascade="all, delete-orphan")
-    parent = relationship("Email", remote_side=[id], backref=backref("replies", lazy="dynamic"), foreign_keys=[in_reply_to])
+    parent = relationship("Email", remote_side=[id], backref="replies", foreign_keys=[in_reply_to])
     cc_recipients = relationship("EmailRecipient", back_populates="email", foreign_keys="[EmailRecipient.email_id]", cascade="all, delete-orphan")
     bcc_recipients = relationship("EmailRecipient", back_populates="email", foreign_keys="[EmailRecipient.email_id]", cascade="all, delete-orphan")
+    label_rows = relationship("EmailLabel", cascade="all, delete-orphan", order_by="EmailLabel.label")
+
+    @property
+    def labels(self):
+        """Comma-separated label names, as exposed by the API"""
+        return ",".join(row.label for row in self.label_rows) or None
+
+    @labels.setter
+    def labels(self, value):
+        self.label_rows = [EmailLabel(label=label) for label in parse_labels(value)]
+
+    # Indexes matching the folder listing shapes: filter on owner + status,
+    # order by (priority desc, created_at desc, id desc)
+    __table_args__ = (
+        Index("ix_emails_recipient_folder", "recipient_id", "status", priority.desc(), created_at.desc(), id.desc()),
+        Index("ix_emails_sender_folder", "sender_id", "status", priority.desc(), created_at.desc(), id.desc()),
+        Index(
+            "ix_emails_sender_drafts", "sender_id", priority.desc(), created_at.desc(), id.desc(),
+            postgresql_where=text("is_draft"), sqlite_where=text("is_draft = 1")
+        ),
+        Index(
+            "ix_emails_recipient_unread", "recipient_id", "status", "category",
+            postgresql_where=text("NOT is_read"), sqlite_where=text("is_read = 0")
+        ),
+        Index(
+            "ix_emails_trash_created_at", "created_at",
+            postgresql_where=text("status = 'trash'"), sqlite_where=text("status = 'trash'")
+        ),
+        # Only scheduled emails still waiting to go out, so the scheduler never scans sent mail
+        Index(
+            "ix_emails_scheduled_due", "scheduled_for", "id",
+            postgresql_where=text("scheduled_for IS NOT NULL AND dispatched_at IS NULL"),
+            sqlite_where=text("scheduled_for IS NOT NULL AND dispatched_at IS NULL")
+        ),
+    )
+
+def parse_labels(value):
+    """Split a comma-separated label string into unique, trimmed names"""
+    labels = []
+    for label in (value or "").split(","):
+        label = label.strip()
+        if label and label not in labels:
+            labels.append(label)
+    return labels
+
+class EmailLabel(Base):
+    __tablename__ = "email_labels"
+
+    email_id = Column(Integer, ForeignKey("emails.id", ondelete="CASCADE"), primary_key=True)
+    label = Column(String, primary_key=True)
+
+    # Label filters look up emails by label; the primary key serves per-email lookups
+    __table_args__ = (
+        Index("ix_email_labels_label_email", "label", "email_id"),
+    )
 
 class EmailRecipient(Base):
     __tablename__ = "email_recipients"
 
     id = Column(Integer, primary_key=True, index=True)
-    email_id = Column(Integer, ForeignKey("emails.id"))
+    email_id = Column(Integer, ForeignKey("emails.id"), index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     type = Column(String)  # cc or bcc
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -75,6 +152,64 @@ class EmailRecipient(Base):
     email = relationship("Email", foreign_keys=[email_id])
     user = relationship("User")
 
+class OutboundEmail(Base):
+    """SMTP delivery job, drained by the workers in outbox.py"""
+    __tablename__ = "outbound_emails"
+
+    id = Column(Integer, primary_key=True, index=True)
+    email_id = Column(Integer, ForeignKey("emails.id", ondelete="SET NULL"), nullable=True, index=True)
+    to_email = Column(String, nullable=False)
+    cc = Column(Text)  # JSON list of addresses
+    subject = Column(String)
+    content = Column(Text)
+    attachments = Column(Text)  # JSON list of {"filename", "path"}
+    status = Column(String, default="queued", nullable=False)  # Values: scheduled, queued, sending, sent, failed
+    attempts = Column(Integer, default=0, nullable=False)
+    # When the job is next due; while sending, when the worker's claim expires
+    next_attempt_at = Column(DateTime(timezone=True), nullable=False)
+    last_error = Column(Text)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    sent_at = Column(DateTime(timezone=True))
+
+    # Workers claim due jobs by next_attempt_at; finished jobs stay out of the index
+    __table_args__ = (
+        Index(
+            "ix_outbound_emails_due", "next_attempt_at",
+            postgresql_where=text("status IN ('queued', 'sending')"),
+            sqlite_where=text("status IN ('queued', 'sending')")
+        ),
+    )
+
+class LeaderLease(Base):
+    """Which worker runs a periodic job until expires_at (see leases.py)"""
+    __tablename__ = "leader_leases"
+
+    name = Column(String, primary_key=True)
+    holder = Column(String, nullable=False)  # host:pid of the worker holding the lease
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+
+class MailboxCounter(Base):
+    """
+    Total and unread emails in one user's folder and category. Maintained by
+    triggers on emails (migration 0010) and reconciled by counters.py.
+    """
+    __tablename__ = "mailbox_counters"
+
+    user_id = Column(Integer, primary_key=True)
+    folder = Column(String, primary_key=True)
+    category = Column(String, primary_key=True)
+    total = Column(Integer, nullable=False, default=0, server_default="0")
+    unread = Column(Integer, nullable=False, default=0, server_default="0")
+
+class ChatUnreadCounter(Base):
+    """Unread chat messages for a user from one sender (kind "user") or in one group (kind "group")"""
+    __tablename__ = "chat_unread_counters"
+
+    user_id = Column(Integer, primary_key=True)
+    kind = Column(String, primary_key=True)
+    peer_id = Column(Integer, primary_key=True)  # Sender's user id or group id
+    unread = Column(Integer, nullable=False, default=0, server_default="0")
+
 class Meeting(Base):
     __tablename__ = "meetings"
 
@@ -95,8 +230,8 @@ class MeetingInvite(Base):
     __tablename__ = "meeting_invites"
 
     id = Column(Integer, primary_key=True, index=True)
-    meeting_id = Column(Integer, ForeignKey("meetings.id"))
-    user_id = Column(Integer, ForeignKey("users.id"))
+    meeting_id = Column(Integer, ForeignKey("meetings.id"), index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     email = Column(String)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
@@ -122,11 +257,17 @@ class ChatGroupMember(Base):
     user_id = Column(Integer, ForeignKey("users.id"))
     joined_at = Column(DateTime(timezone=True), server_default=func.now())
     is_admin = Column(Boolean, default=False)
+    last_read_message_id = Column(Integer, nullable=True)  # Group messages up to this id have been read
 
     # Relationships
     group = relationship("ChatGroup", back_populates="members")
     user = relationship("User", back_populates="group_memberships")
 
+    __table_args__ = (
+        Index("ix_chat_group_members_group_user", "group_id", "user_id"),
+        Index("ix_chat_group_members_user_id", "user_id"),
+    )
+
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
 
@@ -146,6 +287,7 @@ class ChatMessage(Base):
     file_type = Column(String, nullable=True)  # mime type
     file_name = Column(String, nullable=True)
     file_size = Column(Integer, nullable=True)  # in bytes
+    file_hash = Column(String(64), nullable=True)  # Blob holding the file or voice message
     
     # Voice messages
     voice_message_path = Column(String, nullable=True)
@@ -157,3 +299,14 @@ class ChatMessage(Base):
     recipient = relationship("User", foreign_keys=[recipient_id])
     group = relationship("ChatGroup", back_populates="messages")
     reply_to = relationship("ChatMessage", remote_side=[id], backref="replies")
+
+    # Indexes for conversation history, group history and unread counts
+    __table_args__ = (
+        Index("ix_chat_messages_private", "sender_id", "recipient_id", "created_at", "id"),
+        Index("ix_chat_messages_group", "group_id", "created_at", "id"),
+        Index(
+            "ix_chat_messages_recipient_unread", "recipient_id", "sender_id",
+            postgresql_where=text("NOT is_read"), sqlite_where=text("is_read = 0")
+        ),
+        Index("ix_chat_messages_reply_to_id", "reply_to_id"),
+    )
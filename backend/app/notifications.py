@@ -0,0 +1,150 @@
+"""
+Per-user notification channel.
+
+Each browser tab holds one websocket on /ws/user, authenticated with the same
+JWT as the REST API, and the write paths publish small events to it after
+their transaction commits, so clients no longer poll folders, chat
+conversations or unread counts:
+
+    {"type": "email", "folder": "inbox", "email": {id, thread_id, subject, ...}}
+    {"type": "chat_message", "message": <schemas.ChatMessage>}
+    {"type": "chat_reaction", "message_id": 7, "reactions": {...}}
+    {"type": "chat_read", "reader_id": 2, "message_ids": [7, 8]}
+    {"type": "counters", "scope": "mailbox" | "chat"}
+
+"counters" only says that the user's counts changed in a way the other events
+do not describe (a move, a read); the client refetches /api/emails/counts or
+the unread-count endpoints.
+
+Events travel through the broker (broker.py) on a "user:<id>" channel, which
+each worker subscribes to while it holds a connection of that user, so a write
+handled by one worker reaches tabs connected to any other. publish() only
+queues the event, from the event loop or a worker thread (the scheduler
+dispatches on one); a single task hands queued events to the broker in order.
+
+Delivery is best effort. Every connection sends through an Outbound queue
+(outbound.py); a client that falls NOTIFY_QUEUE_SIZE events behind is
+disconnected with code 1013 and resynchronises over REST when it reconnects,
+like any client coming back from a network drop.
+"""
+import asyncio
+import logging
+from typing import Dict, Iterable, Optional, Set
+from fastapi import WebSocket, WebSocketDisconnect
+from . import frames, metrics, models
+from .broker import broker
+from .outbound import DISCONNECT, Outbound
+from .config import get_settings
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+CONNECTIONS = metrics.gauge("notify_connections", "Open /ws/user connections")
+PUBLISHED = metrics.counter("notify_events_total", "Notification events queued for delivery, by type")
+
+def email_event(email: models.Email, folder: str, sender_email: Optional[str] = None) -> Dict:
+    return {
+        "type": "email",
+        "folder": folder,
+        "email": {
+            "id": email.id,
+            "thread_id": email.thread_id,
+            "subject": email.subject,
+            "sender_id": email.sender_id,
+            "sender_email": sender_email,
+            "category": email.category,
+            "priority": email.priority,
+        }
+    }
+
+def counters_event(scope: str) -> Dict:
+    return {"type": "counters", "scope": scope}
+
+class NotificationHub:
+    def __init__(self):
+        self.subscribers: Dict[int, Set[Outbound]] = {}  # user_id -> open connections
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._outgoing: Optional[asyncio.Queue] = None
+        self._publisher: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._outgoing = asyncio.Queue()
+        self._publisher = asyncio.create_task(self._publish_queued())
+
+    async def stop(self):
+        if self._publisher is not None:
+            self._publisher.cancel()
+            await asyncio.gather(self._publisher, return_exceptions=True)
+            self._publisher = None
+        self._loop = None
+
+    def publish(self, user_ids: Iterable[int], event: Dict):
+        """Queue an event for every connection of the given users; safe to call from any thread"""
+        user_ids = {user_id for user_id in user_ids if user_id is not None}
+        if not user_ids or self._loop is None:
+            return
+        # Encoded once for all recipients
+        item = (user_ids, frames.dumps(event))
+        PUBLISHED.inc(event_type=event["type"])
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._outgoing.put_nowait(item)
+        else:
+            self._loop.call_soon_threadsafe(self._outgoing.put_nowait, item)
+
+    async def _publish_queued(self):
+        while True:
+            user_ids, frame = await self._outgoing.get()
+            for user_id in user_ids:
+                try:
+                    await broker.publish(f"user:{user_id}", {"frame": frame})
+                except Exception as e:
+                    logger.error(f"Error publishing notification for user {user_id}: {str(e)}")
+
+    async def _on_message(self, user_id: int, message: Dict):
+        for subscriber in self.subscribers.get(user_id, ()):
+            subscriber.send(message["frame"])
+
+    async def _read(self, subscriber: Outbound):
+        # Clients only send keepalives
+        while True:
+            if await subscriber.websocket.receive_text() == "ping":
+                subscriber.send('{"type": "pong"}')
+
+    async def serve(self, websocket: WebSocket, user_id: int):
+        """Run an accepted connection until either side closes it"""
+        # Every event matters here, so a client that falls behind is always disconnected
+        subscriber = Outbound(websocket, settings.NOTIFY_QUEUE_SIZE, DISCONNECT)
+        connections = self.subscribers.get(user_id)
+        if connections is None:
+            connections = self.subscribers[user_id] = set()
+            await broker.subscribe(f"user:{user_id}", lambda message: self._on_message(user_id, message))
+        connections.add(subscriber)
+        CONNECTIONS.inc()
+        tasks = [asyncio.create_task(subscriber.wait_closed()), asyncio.create_task(self._read(subscriber))]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                error = None if task.cancelled() else task.exception()
+                if error is not None and not isinstance(error, WebSocketDisconnect):
+                    logger.warning(f"Notification connection for user {user_id} failed: {str(error)}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await subscriber.close()
+            connections.discard(subscriber)
+            if not connections and self.subscribers.get(user_id) is connections:
+                del self.subscribers[user_id]
+                await broker.unsubscribe(f"user:{user_id}")
+            CONNECTIONS.dec()
+
+hub = NotificationHub()
+publish = hub.publish
+start = hub.start
+stop = hub.stop
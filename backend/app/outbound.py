@@ -0,0 +1,151 @@
+"""
+Per-connection send queues for websockets.
+
+Broadcasting used to await each recipient's send in turn, so one slow or
+half-dead client held up a whole room. Instead every connection gets an
+Outbound: a bounded queue drained by its own writer task. Broadcasting only
+appends to the queues, which never blocks, and the writers send concurrently;
+a room is updated as fast as its fastest clients, whatever the slowest does.
+
+Messages that only matter in their latest version (media states, typing
+indicators, poll tallies) are queued with a coalescing key; a newer message
+with the same key replaces the queued one in place instead of adding another.
+When a queue is full anyway, WS_SLOW_CONSUMER_POLICY decides:
+- "disconnect": close the connection with 1013; the client reconnects and gets
+  a fresh room state;
+- "drop": discard the new message and keep the connection.
+A send that takes longer than WS_SEND_TIMEOUT_SECONDS closes the connection
+under either policy, since the client is most likely gone.
+"""
+import asyncio
+import logging
+import weakref
+from collections import deque
+from typing import Any, Deque, Dict, Hashable, List, Optional
+from fastapi import WebSocket
+from . import frames, metrics
+from .config import get_settings
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+DISCONNECT, DROP = "disconnect", "drop"
+
+COALESCED = metrics.counter("ws_messages_coalesced_total", "Queued websocket messages replaced by a newer version")
+DROPPED = metrics.counter("ws_messages_dropped_total", "Websocket messages dropped for a full send queue")
+SLOW_CLOSED = metrics.counter("ws_slow_consumers_closed_total", "Websocket connections closed for falling behind, by reason")
+
+# Send timeouts are enforced by one watchdog over all connections rather than
+# wrapping every send in wait_for, which would cost a task per message
+_live: "weakref.WeakSet[Outbound]" = weakref.WeakSet()
+_watchdog: Optional[asyncio.Task] = None
+
+async def _watch():
+    loop = asyncio.get_running_loop()
+    while _live:
+        await asyncio.sleep(min(settings.WS_SEND_TIMEOUT_SECONDS / 4, 1))
+        deadline = loop.time() - settings.WS_SEND_TIMEOUT_SECONDS
+        for outbound in list(_live):
+            if outbound._send_started is not None and outbound._send_started < deadline:
+                outbound._time_out()
+
+class Outbound:
+    """Bounded send queue and writer task for one websocket"""
+
+    def __init__(self, websocket: WebSocket, max_queue: Optional[int] = None, policy: Optional[str] = None):
+        self.websocket = websocket
+        self.max_queue = max_queue or settings.WS_SEND_QUEUE_SIZE
+        self.policy = policy or settings.WS_SLOW_CONSUMER_POLICY
+        self.closed = False
+        # Entries are [key, payload] so a coalesced message can be replaced in place
+        self._queue: Deque[List[Any]] = deque()
+        self._pending: Dict[Hashable, List[Any]] = {}
+        self._ready = asyncio.Event()
+        self._send_started: Optional[float] = None
+        self._writer = asyncio.create_task(self._write())
+        _live.add(self)
+        global _watchdog
+        if _watchdog is None or _watchdog.done():
+            _watchdog = asyncio.create_task(_watch())
+
+    def send(self, payload: Any, key: Optional[Hashable] = None) -> bool:
+        """
+        Queue a frame without waiting; False if it was not queued. Broadcasts
+        pass a str encoded once for everyone; a dict is encoded when it is sent.
+        """
+        if self.closed:
+            return False
+        if key is not None:
+            entry = self._pending.get(key)
+            if entry is not None:
+                entry[1] = payload
+                COALESCED.inc()
+                return True
+        if len(self._queue) >= self.max_queue:
+            if self.policy == DROP:
+                DROPPED.inc()
+                return False
+            self._fail("overflow", 1013)
+            return False
+        entry = [key, payload]
+        self._queue.append(entry)
+        if key is not None:
+            self._pending[key] = entry
+        self._ready.set()
+        return True
+
+    async def _write(self):
+        loop = asyncio.get_running_loop()
+        while not self.closed:
+            if not self._queue:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            key, payload = self._queue.popleft()
+            if key is not None:
+                self._pending.pop(key, None)
+            self._send_started = loop.time()
+            try:
+                await self.websocket.send_text(payload if isinstance(payload, str) else frames.dumps(payload))
+            except Exception:
+                # The receive loop of the endpoint sees the disconnect and cleans up
+                self._fail(None, None)
+                return
+            finally:
+                self._send_started = None
+
+    def _time_out(self):
+        self._fail("timeout", 1013)
+        self._writer.cancel()
+
+    def _fail(self, reason: Optional[str], code: Optional[int]):
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.clear()
+        self._pending.clear()
+        self._ready.set()
+        if reason is not None:
+            SLOW_CLOSED.inc(reason=reason)
+            asyncio.ensure_future(self._close_socket(code))
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    async def wait_closed(self):
+        """Wait until the writer stops (the connection failed or fell behind)"""
+        await asyncio.gather(self._writer, return_exceptions=True)
+
+    def cancel(self):
+        """Stop the writer without waiting; anything still queued is discarded"""
+        self.closed = True
+        self._writer.cancel()
+        _live.discard(self)
+
+    async def close(self):
+        self.cancel()
+        await asyncio.gather(self._writer, return_exceptions=True)
@@ -0,0 +1,222 @@
+"""
+Durable outbound email queue.
+
+Request handlers add an OutboundEmail row in the same transaction as the email
+itself and return; background workers claim due rows, deliver them over the
+pooled SMTP connections in email_utils and record the outcome on each row.
+
+A claimed row moves to "sending" with next_attempt_at pushed out by
+OUTBOX_CLAIM_SECONDS. If the worker dies before recording a result, the claim
+expires and another worker picks the row up again, so delivery is at-least-once.
+The claim itself is a compare-and-set UPDATE ... RETURNING on each row's status
+and attempts, and a worker sends only the rows it returned, so concurrent
+workers never claim the same row even on SQLite. On PostgreSQL the candidate
+rows are also read with FOR UPDATE SKIP LOCKED so workers skip each other's
+rows instead of losing the race.
+
+Jobs for scheduled emails are enqueued "scheduled" and left alone until the
+scheduler releases them at their send time (see scheduler.py), or fail when
+the email is trashed or deleted first.
+
+Each batch (claim, send, record) runs in a thread on the sync engine, so no
+transaction is ever left open across an await on the event loop.
+"""
+import asyncio
+import json
+import logging
+import random
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.orm import Session
+from . import models, metrics
+from .config import get_settings
+from .database import SessionLocal
+from .email_utils import build_message, is_permanent, pool as smtp_pool, PermanentDeliveryError
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+SCHEDULED, QUEUED, SENDING, SENT, FAILED = "scheduled", "queued", "sending", "sent", "failed"
+
+DELIVERIES = metrics.counter("outbox_deliveries_total", "Delivery attempts by outcome (sent, retry, failed)")
+BATCH_SIZE = metrics.histogram("outbox_batch_size", "Messages claimed per worker batch", buckets=(1, 2, 5, 10, 20, 50, 100))
+
+_wakeup: Optional[asyncio.Event] = None
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_workers: List[asyncio.Task] = []
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+def enqueue(db: Session, to_email: str, subject: str, content: str, cc_list: List[str] = None,
+            attachments: List[dict] = None, email_id: Optional[int] = None,
+            scheduled_for: Optional[datetime] = None) -> models.OutboundEmail:
+    """Add a delivery job to the caller's transaction; call notify() after committing"""
+    job = models.OutboundEmail(
+        email_id=email_id,
+        to_email=to_email,
+        cc=json.dumps(cc_list or []),
+        subject=subject,
+        content=content,
+        attachments=json.dumps(attachments or []),
+        status=SCHEDULED if scheduled_for else QUEUED,
+        attempts=0,
+        next_attempt_at=scheduled_for or utcnow(),
+    )
+    db.add(job)
+    return job
+
+def release_scheduled(db: Session, email_ids: List[int]):
+    """Make the held jobs of dispatched scheduled emails due now"""
+    db.execute(
+        update(models.OutboundEmail)
+        .where(models.OutboundEmail.email_id.in_(email_ids), models.OutboundEmail.status == SCHEDULED)
+        .values(status=QUEUED, next_attempt_at=utcnow())
+    )
+
+def cancel_scheduled(db: Session, email_ids):
+    """Fail the held jobs of scheduled emails that will not be dispatched (trashed or deleted first)"""
+    db.execute(
+        update(models.OutboundEmail)
+        .where(models.OutboundEmail.email_id.in_(email_ids), models.OutboundEmail.status == SCHEDULED)
+        .values(status=FAILED, last_error="Cancelled before its send time")
+        .execution_options(synchronize_session=False)
+    )
+
+def notify():
+    """Wake idle workers instead of waiting for the next poll (callable from any thread)"""
+    if _wakeup is not None:
+        _loop.call_soon_threadsafe(_wakeup.set)
+
+def backoff(attempts: int) -> timedelta:
+    delay = min(settings.OUTBOX_RETRY_BASE_SECONDS * 2 ** max(attempts - 1, 0), settings.OUTBOX_RETRY_MAX_SECONDS)
+    # Jitter spreads retries out when the SMTP server comes back after an outage
+    return timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+def claim_batch(db: Session, limit: int) -> List[models.OutboundEmail]:
+    now = utcnow()
+    candidates = db.execute(
+        select(models.OutboundEmail.id, models.OutboundEmail.status, models.OutboundEmail.attempts)
+        .where(
+            models.OutboundEmail.status.in_([QUEUED, SENDING]),
+            models.OutboundEmail.next_attempt_at <= now
+        )
+        .order_by(models.OutboundEmail.next_attempt_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    ).all()
+    if not candidates:
+        db.commit()
+        return []
+    # Only rows still in the state they were read in are claimed, so two workers
+    # that read the same row (SQLite ignores FOR UPDATE) never both send it
+    claimed = set(db.execute(
+        update(models.OutboundEmail)
+        .where(or_(*(
+            and_(models.OutboundEmail.id == row.id, models.OutboundEmail.status == row.status,
+                 models.OutboundEmail.attempts == row.attempts)
+            for row in candidates
+        )))
+        .values(
+            status=SENDING,
+            attempts=models.OutboundEmail.attempts + 1,
+            next_attempt_at=now + timedelta(seconds=settings.OUTBOX_CLAIM_SECONDS)
+        )
+        .returning(models.OutboundEmail.id)
+        .execution_options(synchronize_session=False)
+    ).scalars())
+    db.commit()
+    for row in candidates:
+        if row.id in claimed and row.status == SENDING:
+            logger.warning(f"Reclaiming outbound email {row.id} after an expired claim")
+    if not claimed:
+        return []
+    return db.execute(
+        select(models.OutboundEmail)
+        .where(models.OutboundEmail.id.in_(claimed))
+        .order_by(models.OutboundEmail.next_attempt_at, models.OutboundEmail.id)
+    ).scalars().all()
+
+def _deliver(jobs: List[models.OutboundEmail]) -> List[Optional[Exception]]:
+    """Build and send a batch on one SMTP connection"""
+    errors: List[Optional[Exception]] = [None] * len(jobs)
+    messages, positions = [], []
+    for i, job in enumerate(jobs):
+        cc_list = json.loads(job.cc or "[]")
+        try:
+            msg = build_message(job.to_email, job.subject, job.content, json.loads(job.attachments or "[]"), cc_list)
+        except PermanentDeliveryError as e:
+            errors[i] = e
+            continue
+        messages.append(([job.to_email] + cc_list, msg))
+        positions.append(i)
+    if messages:
+        for i, error in zip(positions, smtp_pool.send_many(messages)):
+            errors[i] = error
+    return errors
+
+def record_results(db: Session, jobs: List[models.OutboundEmail], errors: List[Optional[Exception]]):
+    now = utcnow()
+    for job, error in zip(jobs, errors):
+        if error is None:
+            values = {"status": SENT, "sent_at": now, "last_error": None}
+            outcome = "sent"
+        elif is_permanent(error) or job.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+            values = {"status": FAILED, "last_error": str(error)}
+            outcome = "failed"
+            logger.warning(f"Giving up on outbound email {job.id} after {job.attempts} attempt(s): {error}")
+        else:
+            values = {"status": QUEUED, "next_attempt_at": now + backoff(job.attempts), "last_error": str(error)}
+            outcome = "retry"
+        DELIVERIES.inc(result=outcome)
+        # Only touch rows this worker still owns; an expired claim may have been taken over
+        db.execute(
+            update(models.OutboundEmail)
+            .where(models.OutboundEmail.id == job.id, models.OutboundEmail.status == SENDING,
+                   models.OutboundEmail.attempts == job.attempts)
+            .values(**values)
+        )
+    db.commit()
+
+def process_batch() -> int:
+    """Claim, deliver and record one batch; returns how many jobs it handled"""
+    db = SessionLocal()
+    try:
+        jobs = claim_batch(db, settings.OUTBOX_BATCH_SIZE)
+        if jobs:
+            BATCH_SIZE.observe(len(jobs))
+            record_results(db, jobs, _deliver(jobs))
+        return len(jobs)
+    finally:
+        db.close()
+
+async def _worker(number: int):
+    while True:
+        try:
+            _wakeup.clear()
+            if not await asyncio.to_thread(process_batch):
+                try:
+                    await asyncio.wait_for(_wakeup.wait(), timeout=settings.OUTBOX_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error in outbox worker {number}: {str(e)}")
+            await asyncio.sleep(settings.OUTBOX_POLL_SECONDS)
+
+def start():
+    global _wakeup, _loop
+    _loop = asyncio.get_running_loop()
+    _wakeup = asyncio.Event()
+    for number in range(settings.OUTBOX_WORKERS):
+        _workers.append(asyncio.create_task(_worker(number)))
+
+async def stop():
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    await asyncio.to_thread(smtp_pool.close)
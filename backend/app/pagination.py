@@ -0,0 +1,64 @@
+import base64
+import json
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
+from fastapi import HTTPException
+from sqlalchemy import DateTime, literal, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from .database import engine
+
+# Largest page a client may ask for
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(values: Sequence) -> str:
+    """Pack the sort key of the last row on a page into an opaque URL-safe token"""
+    payload = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str, columns: Sequence) -> List:
+    """Unpack a cursor token into values typed for the given key columns"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError("cursor does not match sort key")
+        return [
+            datetime.fromisoformat(value) if isinstance(column.type, DateTime) and value is not None else value
+            for column, value in zip(columns, values)
+        ]
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _sqlite_timestamp(value):
+    # SQLite stores server_default=func.now() as 'YYYY-MM-DD HH:MM:SS' text, while a bound
+    # datetime is rendered with microseconds; compare in the stored form or ties never match
+    if isinstance(value, datetime):
+        return literal(value.strftime("%Y-%m-%d %H:%M:%S" if not value.microsecond else "%Y-%m-%d %H:%M:%S.%f"))
+    return value
+
+async def keyset_page(db: AsyncSession, stmt, columns: Sequence, cursor: Optional[str], limit: int, descending: bool = True) -> Tuple[List, Optional[str]]:
+    """
+    Fetch one page of the `stmt` select ordered by `columns`, starting after `cursor`.
+
+    The window is a row-value comparison on the sort key, so every page is an
+    index range scan no matter how deep the client has paged.
+    """
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be at least 1")
+    if cursor:
+        key = tuple_(*columns)
+        values = decode_cursor(cursor, columns)
+        if engine.dialect.name == "sqlite":
+            values = [_sqlite_timestamp(value) for value in values]
+        values = tuple_(*values)
+        stmt = stmt.where(key < values if descending else key > values)
+
+    order = [column.desc() if descending else column.asc() for column in columns]
+    rows = list((await db.scalars(stmt.order_by(None).order_by(*order).limit(limit + 1))).all())
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([getattr(rows[-1], column.key) for column in columns])
+    return rows, next_cursor
@@ -0,0 +1,63 @@
+"""
+Password hashing off the event loop.
+
+bcrypt costs 100-300 ms of CPU per call, which would stall every websocket on
+the worker if it ran inside an async handler. Hashes are computed on a small
+dedicated thread pool (bcrypt releases the GIL); callers beyond the pool size
+queue up to PASSWORD_HASH_MAX_QUEUE and are then turned away with a 503.
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+from . import metrics
+from .config import get_settings
+
+settings = get_settings()
+
+# Hashes made with a different cost are flagged by verify_and_update and
+# replaced on the user's next login
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.BCRYPT_ROUNDS)
+
+HASH_SECONDS = metrics.histogram("password_hash_seconds", "Time spent computing a password hash, by operation")
+QUEUE_WAIT = metrics.histogram("password_hash_queue_wait_seconds", "Time a hash job waited for a pool thread")
+QUEUE_DEPTH = metrics.gauge("password_hash_queue_depth", "Hash jobs submitted and not yet finished")
+REJECTED = metrics.counter("password_hash_rejected_total", "Hash jobs turned away because the queue was full")
+
+_executor = ThreadPoolExecutor(max_workers=settings.PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+_in_flight = 0
+
+def _timed(operation: str, submitted: float, func, *args):
+    started = time.perf_counter()
+    QUEUE_WAIT.observe(started - submitted)
+    try:
+        return func(*args)
+    finally:
+        HASH_SECONDS.observe(time.perf_counter() - started, op=operation)
+
+async def _run(operation: str, func, *args):
+    global _in_flight
+    if _in_flight >= settings.PASSWORD_HASH_WORKERS + settings.PASSWORD_HASH_MAX_QUEUE:
+        REJECTED.inc(op=operation)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many login attempts in progress, please retry",
+            headers={"Retry-After": "1"},
+        )
+    _in_flight += 1
+    QUEUE_DEPTH.set(_in_flight)
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, _timed, operation, time.perf_counter(), func, *args)
+    finally:
+        _in_flight -= 1
+        QUEUE_DEPTH.set(_in_flight)
+
+async def hash_password(password: str) -> str:
+    return await _run("hash", pwd_context.hash, password)
+
+async def verify_and_update(password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """Check a password; the second item is a fresh hash when the stored one uses an outdated cost"""
+    return await _run("verify", pwd_context.verify_and_update, password, hashed_password)
@@ -0,0 +1,172 @@
+"""
+Dispatcher for scheduled emails.
+
+create_email stores a scheduled email as the sender's "sent" copy with
+`scheduled_for` set, and holds its SMTP job in the outbox. When the time comes,
+a dispatcher worker claims the email, creates the recipient's inbox copy,
+releases the outbox job and stamps `dispatched_at`, all in one transaction,
+then tells the recipient over their notification channel.
+
+Due emails are found through the partial index ix_emails_scheduled_due, which
+only holds undispatched scheduled emails, and claimed in batches with
+FOR UPDATE SKIP LOCKED so any number of workers and processes can drain a
+burst of emails scheduled for the same minute. A worker that dies mid-batch
+rolls its transaction back and the emails are claimed again. An email trashed
+before its send time is never dispatched: cancel() fails its held job and
+stamps `dispatched_at`, so restoring it later does not send it after all.
+"""
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import List
+from sqlalchemy import and_, func, select, update
+from sqlalchemy.orm import Session, selectinload
+from . import models, metrics, notifications, outbox
+from .config import get_settings
+from .database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+LAG = metrics.histogram(
+    "scheduler_lag_seconds", "Delay between an email's scheduled time and its dispatch",
+    buckets=(0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+)
+OLDEST_DUE = metrics.gauge("scheduler_oldest_due_seconds", "Age of the oldest scheduled email still waiting for dispatch")
+DISPATCHED = metrics.counter("scheduler_dispatched_total", "Scheduled emails dispatched")
+
+_workers: List[asyncio.Task] = []
+
+def _as_utc(value: datetime) -> datetime:
+    # SQLite hands back naive datetimes; scheduled times are stored in UTC
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+def _due(now: datetime):
+    return and_(
+        models.Email.scheduled_for <= now,
+        models.Email.dispatched_at.is_(None),
+        models.Email.status == "sent",
+    )
+
+def _inbox_copy(email: models.Email) -> models.Email:
+    return models.Email(
+        subject=email.subject,
+        content=email.content,
+        sender_id=email.sender_id,
+        recipient_id=email.recipient_id,
+        status="inbox",
+        category=email.category,
+        priority=email.priority,
+        thread_id=email.thread_id,
+        in_reply_to=email.in_reply_to,
+        labels=email.labels,
+        attachments=[
+            models.Attachment(
+                filename=attachment.filename,
+                content_type=attachment.content_type,
+                file_path=attachment.file_path,
+                size=attachment.size,
+                content_hash=attachment.content_hash
+            )
+            for attachment in email.attachments
+        ]
+    )
+
+def dispatch_batch(db: Session, limit: int) -> int:
+    """Dispatch up to `limit` due emails in one transaction; returns how many were dispatched"""
+    now = outbox.utcnow()
+    emails = db.execute(
+        select(models.Email)
+        .where(_due(now))
+        .order_by(models.Email.scheduled_for, models.Email.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .options(
+            selectinload(models.Email.attachments),
+            selectinload(models.Email.label_rows),
+            selectinload(models.Email.sender_user)
+        )
+    ).scalars().all()
+    if not emails:
+        return 0
+
+    ids = [email.id for email in emails]
+    lags = [max((now - _as_utc(email.scheduled_for)).total_seconds(), 0) for email in emails]
+    copies = [_inbox_copy(email) for email in emails]
+    db.add_all(copies)
+    outbox.release_scheduled(db, ids)
+    db.execute(
+        update(models.Email)
+        .where(models.Email.id.in_(ids))
+        .values(dispatched_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    db.flush()
+    events = [
+        (copy.recipient_id, notifications.email_event(copy, "inbox", email.sender_user.email))
+        for copy, email in zip(copies, emails)
+    ]
+    db.commit()
+
+    for recipient_id, event in events:
+        notifications.publish([recipient_id], event)
+
+    for lag in lags:
+        LAG.observe(lag)
+    DISPATCHED.inc(len(emails))
+    return len(emails)
+
+def cancel(db: Session, email_ids):
+    """Give up on the scheduled emails among `email_ids` not dispatched yet"""
+    pending = and_(
+        models.Email.id.in_(email_ids),
+        models.Email.scheduled_for.isnot(None),
+        models.Email.dispatched_at.is_(None)
+    )
+    outbox.cancel_scheduled(db, select(models.Email.id).where(pending))
+    db.execute(
+        update(models.Email)
+        .where(pending)
+        .values(dispatched_at=outbox.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+
+def update_oldest_due(db: Session):
+    now = outbox.utcnow()
+    oldest = db.execute(select(func.min(models.Email.scheduled_for)).where(_due(now))).scalar()
+    OLDEST_DUE.set((now - _as_utc(oldest)).total_seconds() if oldest else 0)
+
+def run_once() -> int:
+    db = SessionLocal()
+    try:
+        dispatched = dispatch_batch(db, settings.SCHEDULER_BATCH_SIZE)
+        update_oldest_due(db)
+        return dispatched
+    finally:
+        db.close()
+
+async def _worker(number: int):
+    while True:
+        try:
+            dispatched = await asyncio.to_thread(run_once)
+            if dispatched:
+                outbox.notify()
+            # A full batch means more are due; keep going without sleeping
+            if dispatched < settings.SCHEDULER_BATCH_SIZE:
+                await asyncio.sleep(settings.SCHEDULER_POLL_SECONDS)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error in scheduler worker {number}: {str(e)}")
+            await asyncio.sleep(settings.SCHEDULER_POLL_SECONDS)
+
+def start():
+    for number in range(settings.SCHEDULER_WORKERS):
+        _workers.append(asyncio.create_task(_worker(number)))
+
+async def stop():
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
@@ -1,8 +1,9 @@
-from pydantic import BaseModel, EmailStr, Field
+from pydantic import BaseModel, EmailStr, Field, computed_field
 from typing import Optional, List
 from pydantic import validator
 from datetime import datetime
 from fastapi import UploadFile
+from . import downloads
 
 # User schemas
 class UserBase(BaseModel):
@@ -40,8 +41,14 @@ class Attachment(AttachmentBase):
     id: int
     email_id: int
     file_path: str
+    content_hash: Optional[str] = None
     created_at: Optional[str] = None
 
+    @computed_field
+    @property
+    def download_url(self) -> Optional[str]:
+        return downloads.signed_url(self.file_path, self.filename, self.content_type)
+
     @validator("created_at", pre=True)
     def parse_datetime(cls, v):
         if isinstance(v, datetime):
@@ -127,6 +134,56 @@ class Email(EmailBase):
             }
         }
 
+class EmailPage(BaseModel):
+    items: List[Email] = []
+    next_cursor: Optional[str] = None
+
+class DeliveryStatus(BaseModel):
+    id: int
+    to_email: str
+    status: str
+    attempts: int
+    last_error: Optional[str] = None
+    created_at: Optional[datetime] = None
+    sent_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+class BulkSelection(BaseModel):
+    """Emails a bulk operation acts on: a list of ids, a whole folder, or ids within a folder"""
+    email_ids: Optional[List[int]] = None
+    folder: Optional[str] = None
+
+class BulkStatusUpdate(BulkSelection):
+    status: str
+
+class BulkReadUpdate(BulkSelection):
+    is_read: bool = True
+
+class BulkLabelUpdate(BulkSelection):
+    add: List[str] = []
+    remove: List[str] = []
+
+class BulkItemResult(BaseModel):
+    id: int
+    ok: bool
+    error: Optional[str] = None
+
+class BulkResult(BaseModel):
+    updated: int
+    results: List[BulkItemResult]
+
+class LabelCount(BaseModel):
+    label: str
+    total: int
+    unread: int
+
+class EmailSearchHit(BaseModel):
+    email: Email
+    rank: float
+    snippet: Optional[str] = None
+
 # Meeting schemas
 class MeetingBase(BaseModel):
     title: str
@@ -208,6 +265,16 @@ class ChatMessage(ChatMessageBase):
     voice_duration: Optional[int] = None
     replies: List["ChatMessage"] = []
 
+    @computed_field
+    @property
+    def file_url(self) -> Optional[str]:
+        return downloads.signed_url(self.file_path, self.file_name, self.file_type)
+
+    @computed_field
+    @property
+    def voice_message_url(self) -> Optional[str]:
+        return downloads.signed_url(self.voice_message_path, self.file_name, self.file_type)
+
     @validator("created_at", pre=True)
     def parse_datetime(cls, v):
         if isinstance(v, datetime):
@@ -234,6 +301,15 @@ class ChatMessage(ChatMessageBase):
             }
         }
 
+class ChatMessagePage(BaseModel):
+    items: List[ChatMessage] = []
+    next_cursor: Optional[str] = None
+
+class ChatMessageSearchHit(BaseModel):
+    message: ChatMessage
+    rank: float
+    snippet: Optional[str] = None
+
 class ChatGroupBase(BaseModel):
     name: str
     description: Optional[str] = None
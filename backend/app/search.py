@@ -0,0 +1,114 @@
+import html
+import re
+from typing import List, Optional, Tuple
+from sqlalchemy import func, literal_column, or_, select, table, column
+from sqlalchemy.orm import Session
+from . import models, crud
+from .database import engine
+
+# PostgreSQL keeps a generated tsvector column with a GIN index on each searchable
+# table; SQLite (local development) keeps an FTS5 table synced by triggers. Both
+# are created by migration 0003.
+TEXT_SEARCH_CONFIG = "english"
+# Matches are marked with private-use characters rather than <mark>, so the
+# snippet can be HTML-escaped before the markers become tags (see highlight())
+START_SEL, STOP_SEL = "\ue000", "\ue001"
+HEADLINE_OPTIONS = f"StartSel={START_SEL}, StopSel={STOP_SEL}, MaxWords=24, MinWords=8, MaxFragments=2"
+
+_TERM_RE = re.compile(r"\w+", re.UNICODE)
+
+def search_terms(text: str) -> List[str]:
+    """Split user input into plain word terms; everything else is dropped so it cannot inject query syntax"""
+    return _TERM_RE.findall(text or "")[:16]
+
+def highlight(snippet: Optional[str]) -> Optional[str]:
+    """Turn a marked snippet of stored text into HTML: escaped, with matches in <mark>"""
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(START_SEL, "<mark>").replace(STOP_SEL, "</mark>")
+
+def _dialect() -> str:
+    return engine.dialect.name
+
+def _pg_query(terms: List[str]):
+    # Every term is a prefix match so results update while the user is still typing
+    return func.to_tsquery(TEXT_SEARCH_CONFIG, " & ".join(f"{term}:*" for term in terms))
+
+def _fts_query(terms: List[str]) -> str:
+    return " ".join('"{}"*'.format(term) for term in terms)
+
+def _fts_table(name: str):
+    return table(name, column("rowid"))
+
+def _match_clause(model, fts_name: str, terms: List[str]):
+    if _dialect() == "postgresql":
+        vector = literal_column(f"{model.__tablename__}.search_vector")
+        return vector.op("@@")(_pg_query(terms))
+    fts = _fts_table(fts_name)
+    matching = select(fts.c.rowid).where(literal_column(fts_name).op("MATCH")(_fts_query(terms)))
+    return model.id.in_(matching)
+
+def email_match_clause(text: str):
+    """WHERE clause restricting an Email query to rows matching `text`"""
+    terms = search_terms(text)
+    if not terms:
+        pattern = f"%{text}%"
+        return or_(models.Email.subject.ilike(pattern), models.Email.content.ilike(pattern))
+    return _match_clause(models.Email, "emails_fts", terms)
+
+def _ranked(db: Session, model, fts_name: str, text_column, terms: List[str], scope, limit: int):
+    """Return (row, rank, snippet) tuples for the best `limit` matches, highest rank first"""
+    if _dialect() == "postgresql":
+        vector = literal_column(f"{model.__tablename__}.search_vector")
+        tsquery = _pg_query(terms)
+        rank = func.ts_rank_cd(vector, tsquery).label("rank")
+        best = (
+            db.query(model.id.label("id"), rank)
+            .filter(scope, vector.op("@@")(tsquery))
+            .order_by(rank.desc(), model.id.desc())
+            .limit(limit)
+            .subquery()
+        )
+        # Headlines are costly, so only compute them for the rows that made the cut
+        snippet = func.ts_headline(TEXT_SEARCH_CONFIG, func.coalesce(text_column, ""), tsquery, HEADLINE_OPTIONS)
+        query = db.query(model, best.c.rank, snippet).join(best, best.c.id == model.id)
+        return query, best.c.rank.desc()
+
+    fts = _fts_table(fts_name)
+    fts_column = literal_column(fts_name)
+    # bm25() is lower-is-better; negate it so callers always sort by rank descending
+    rank = (-func.bm25(fts_column)).label("rank")
+    snippet = func.snippet(fts_column, -1, START_SEL, STOP_SEL, "…", 24)
+    query = (
+        db.query(model, rank, snippet)
+        .join(fts, fts.c.rowid == model.id)
+        .filter(scope, fts_column.op("MATCH")(_fts_query(terms)))
+    )
+    return query, rank.desc()
+
+def search_emails(db: Session, user_id: int, text: str, folder: Optional[str] = None, limit: int = 20) -> List[Tuple]:
+    """Full-text search over a user's mailbox; returns (email, rank, snippet) tuples"""
+    terms = search_terms(text)
+    if not terms:
+        return []
+    scope = crud.folder_filter(user_id, folder) if folder else crud.mailbox_filter(user_id)
+    query, order = _ranked(db, models.Email, "emails_fts", models.Email.content, terms, scope, limit)
+    rows = query.options(*crud.email_listing_options()).order_by(order, models.Email.id.desc()).limit(limit).all()
+    crud.fill_email_addresses([email for email, _, _ in rows])
+    return [(email, rank, highlight(snippet)) for email, rank, snippet in rows]
+
+def search_chat_messages(db: Session, user_id: int, text: str, limit: int = 20) -> List[Tuple]:
+    """Full-text search over the chats a user takes part in; returns (message, rank, snippet) tuples"""
+    terms = search_terms(text)
+    if not terms:
+        return []
+    member_groups = select(models.ChatGroupMember.group_id).where(models.ChatGroupMember.user_id == user_id)
+    scope = or_(
+        models.ChatMessage.sender_id == user_id,
+        models.ChatMessage.recipient_id == user_id,
+        models.ChatMessage.group_id.in_(member_groups)
+    )
+    query, order = _ranked(db, models.ChatMessage, "chat_messages_fts", models.ChatMessage.content, terms, scope, limit)
+    rows = query.options(*crud.chat_listing_options()).order_by(order, models.ChatMessage.id.desc()).limit(limit).all()
+    crud.fill_chat_addresses([message for message, _, _ in rows])
+    return [(message, rank, highlight(snippet)) for message, rank, snippet in rows]
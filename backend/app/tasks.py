@@ -1,50 +1,120 @@
-from datetime import datetime, timedelta
+"""
+Trash retention.
+
+Emails left in trash for TRASH_RETENTION_DAYS are deleted in chunks of
+TRASH_PURGE_CHUNK_SIZE. Each chunk is claimed with FOR UPDATE SKIP LOCKED and
+deleted set-based through crud.bulk_delete in its own short transaction on a
+worker thread, so the event loop never waits on the database and no
+transaction grows with the size of the backlog. Files from before the blob
+store are unlinked on a thread after each chunk commits; blob files are left
+to the blob collector.
+
+The daily job runs in every worker process, but only the one holding the
+"trash-retention" lease (leases.py) does the work in a given period.
+/api/emails/cleanup/trash runs the same engine for a single user.
+"""
+from datetime import timedelta
 import asyncio
-from sqlalchemy.orm import Session
-from . import models
+import logging
+import time
+from typing import List, Optional, Tuple
+from sqlalchemy import and_, select
+from . import blobs, crud, leases, metrics, models
+from .config import get_settings
 from .database import SessionLocal
-import os
+from .outbox import utcnow
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+LEASE = "trash-retention"
+
+PURGED = metrics.counter("trash_retention_deleted_total", "Emails deleted by trash retention")
+CHUNKS = metrics.counter("trash_retention_chunks_total", "Trash retention chunks committed")
+RUNS = metrics.counter("trash_retention_runs_total", "Scheduled trash retention runs by outcome (completed, failed)")
+RUN_SECONDS = metrics.histogram(
+    "trash_retention_run_seconds", "Duration of a scheduled trash retention run",
+    buckets=(1, 5, 15, 60, 300, 900, 3600)
+)
+LAST_SUCCESS = metrics.gauge("trash_retention_last_success_timestamp_seconds", "When trash retention last completed")
+
+def retention_filter(user_id: Optional[int] = None):
+    """Trashed emails past the retention period, optionally only one user's"""
+    cutoff = utcnow() - timedelta(days=settings.TRASH_RETENTION_DAYS)
+    where = and_(models.Email.status == "trash", models.Email.created_at < cutoff)
+    if user_id is not None:
+        where = and_(where, models.Email.recipient_id == user_id)
+    return where
+
+def purge_chunk(where, limit: int) -> Tuple[int, int, List[str]]:
+    """
+    Delete up to `limit` emails matching `where` in one transaction (blocking).
+    Returns how many were claimed and deleted, and the legacy files to unlink.
+    """
+    db = SessionLocal()
+    try:
+        # Oldest first, through the partial index on trashed emails
+        ids = db.scalars(
+            select(models.Email.id)
+            .where(where)
+            .order_by(models.Email.created_at)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        ).all()
+        if not ids:
+            return 0, 0, []
+        deleted, paths = crud.bulk_delete(db, and_(models.Email.id.in_(ids), where))
+        db.commit()
+        return len(ids), len(deleted), paths
+    finally:
+        db.close()
+
+async def purge_expired_trash(user_id: Optional[int] = None, lease: Optional[str] = None) -> int:
+    """Delete expired trash chunk by chunk; returns how many emails were deleted"""
+    where = retention_filter(user_id)
+    chunk_size = settings.TRASH_PURGE_CHUNK_SIZE
+    total = 0
+    while True:
+        claimed, deleted, paths = await asyncio.to_thread(purge_chunk, where, chunk_size)
+        if claimed == 0:
+            break
+        total += deleted
+        PURGED.inc(deleted)
+        CHUNKS.inc()
+        if paths:
+            await asyncio.to_thread(blobs.remove_unreferenced_files, paths)
+        if claimed < chunk_size:
+            break
+        if lease and not await asyncio.to_thread(leases.renew, lease, settings.TRASH_RETENTION_INTERVAL_SECONDS):
+            logger.warning("Lost the trash retention lease; stopping this run")
+            break
+        if settings.TRASH_PURGE_PAUSE_SECONDS:
+            await asyncio.sleep(settings.TRASH_PURGE_PAUSE_SECONDS)
+    return total
 
 async def cleanup_old_trash():
     """
-    Periodically clean up emails that have been in trash for more than 30 days
+    Periodically delete emails that have been in trash past the retention period
     """
     while True:
         try:
-            db = SessionLocal()
-            try:
-                # Find emails in trash older than 30 days
-                thirty_days_ago = datetime.now() - timedelta(days=30)
-                old_trash = db.query(models.Email).filter(
-                    models.Email.status == "trash",
-                    models.Email.created_at < thirty_days_ago
-                ).all()
-
-                deleted_count = 0
-                for email in old_trash:
-                    # Delete attachments from storage
-                    for attachment in email.attachments:
-                        try:
-                            if os.path.exists(attachment.file_path):
-                                os.remove(attachment.file_path)
-                        except Exception as e:
-                            print(f"Error deleting attachment file: {str(e)}")
-
-                    # Delete email from database
-                    db.delete(email)
-                    deleted_count += 1
-
-                db.commit()
-                if deleted_count > 0:
-                    print(f"Cleaned up {deleted_count} old emails from trash")
-
-            finally:
-                db.close()
-
-            # Run every 24 hours
-            await asyncio.sleep(24 * 60 * 60)
-
+            if await asyncio.to_thread(leases.acquire, LEASE, settings.TRASH_RETENTION_INTERVAL_SECONDS):
+                started = time.perf_counter()
+                try:
+                    deleted = await purge_expired_trash(lease=LEASE)
+                except Exception:
+                    RUNS.inc(outcome="failed")
+                    raise
+                RUNS.inc(outcome="completed")
+                RUN_SECONDS.observe(time.perf_counter() - started)
+                LAST_SUCCESS.set(time.time())
+                if deleted > 0:
+                    logger.info(f"Cleaned up {deleted} old emails from trash")
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            print(f"Error in cleanup_old_trash task: {str(e)}")
-            # If there's an error, wait 1 hour before retrying
-            await asyncio.sleep(60 * 60) 
\ No newline at end of file
+            logger.error(f"Error in cleanup_old_trash task: {str(e)}")
+
+        # Every worker checks; only an expired lease lets one of them run again
+        await asyncio.sleep(settings.TRASH_RETENTION_POLL_SECONDS)
@@ -0,0 +1,270 @@
+"""
+Chunked binary file transfer over the chat room websocket (/ws/chat), which
+only logged-in users can open; uploads belong to the user id in their token.
+
+Files used to travel as base64 inside a JSON frame (ChatManager.broadcast):
+a third bigger on the wire, decoded whole in memory and written to disk on the
+event loop. Instead a client announces a file in a text frame and sends it in
+binary frames, each written to disk on a worker thread as it arrives:
+
+    -> {"type": "file_start", "filename": "a.pdf", "content_type": "application/pdf", "size": 5242880}
+    <- {"type": "file_ready", "upload_id": "<32 hex digits>", "offset": 0, "chunk_size": 262144}
+    -> binary frame: upload id (16 bytes) + offset (8 bytes, big-endian) + up to chunk_size bytes
+       ...
+    room <- {"type": "file_progress", "upload_id": ..., "user_id": ..., "filename": ..., "received": ..., "size": ...}
+    room <- {"type": "file", "upload_id": ..., "user_id": ..., "file_data": {"filename", "content_type", "size", "url"}}
+
+The room, sender included, only ever gets the file's signed URL
+(downloads.signed_url), never its bytes. A chunk at any other offset than the
+next expected one is not written; the sender gets file_ready again with the
+right offset. After a dropped connection the client sends file_start with its
+upload_id and continues from the offset in file_ready; unfinished files are
+kept for CHAT_FILE_PARTIAL_TTL_SECONDS. A connection may have at most
+CHAT_FILE_MAX_ACTIVE_UPLOADS unfinished uploads, and a user at most
+CHAT_FILE_MAX_PENDING_BYTES of them across connections, counted by the size
+given in file_start. Failures are reported to the sender as
+{"type": "file_error", "upload_id": ..., "detail": ...}.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, Optional
+from . import downloads, frames, metrics, uploads
+from .chat import CHAT_UPLOAD_DIR
+from .config import get_settings
+from .outbound import Outbound
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+PARTIAL_DIR = CHAT_UPLOAD_DIR / "partial"
+PARTIAL_DIR.mkdir(exist_ok=True)
+
+HEADER_SIZE = 16 + 8
+
+BYTES_RECEIVED = metrics.counter("chat_file_bytes_total", "File bytes received over chat websockets")
+COMPLETED = metrics.counter("chat_files_completed_total", "Files uploaded over chat websockets")
+RESUMED = metrics.counter("chat_file_resumes_total", "Uploads continued from an earlier connection")
+
+_last_sweep = 0.0
+
+# user_id -> total size of the user's unfinished uploads on this worker
+_pending_bytes: Dict[str, int] = {}
+
+def _sweep_partials():
+    """Delete unfinished uploads nobody resumed in time (blocking)"""
+    cutoff = time.time() - settings.CHAT_FILE_PARTIAL_TTL_SECONDS
+    for entry in os.scandir(PARTIAL_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+        except FileNotFoundError:
+            pass
+
+def _open_partial(path: Path):
+    """Open an upload's partial file for appending; returns it and the bytes already in it (blocking)"""
+    file = open(path, "ab")
+    return file, file.tell()
+
+class Upload:
+    __slots__ = ("id", "filename", "content_type", "size", "partial", "file", "received", "reported_at")
+
+    def __init__(self, upload_id: str, filename: str, content_type: str, size: int, partial: Path):
+        self.id = upload_id
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size
+        self.partial = partial
+        self.file = None
+        self.received = 0
+        self.reported_at = 0.0
+
+class Transfers:
+    """The uploads of one chat room connection"""
+
+    def __init__(self, room, user_id: str, outbound: Outbound):
+        self.room = room
+        self.user_id = user_id
+        self.outbound = outbound
+        self.uploads: Dict[str, Upload] = {}
+
+    def _reply(self, message: Dict):
+        self.outbound.send(frames.dumps(message))
+
+    def _error(self, upload_id: Optional[str], detail: str):
+        self._reply({"type": "file_error", "upload_id": upload_id, "detail": detail})
+
+    def _ready(self, upload: Upload):
+        self._reply({
+            "type": "file_ready",
+            "upload_id": upload.id,
+            "offset": upload.received,
+            "chunk_size": settings.CHAT_FILE_CHUNK_BYTES
+        })
+
+    def _partial_path(self, upload_id: str) -> Path:
+        # Named after who may resume it, so nobody else's upload_id can
+        key = f"{self.room.room_id}\0{self.user_id}\0{upload_id}".encode()
+        return PARTIAL_DIR / hashlib.sha256(key).hexdigest()
+
+    async def start(self, data: Dict):
+        """Handle file_start: begin an upload, or continue one from an earlier connection"""
+        global _last_sweep
+        upload_id = data.get("upload_id")
+        try:
+            size = int(data.get("size"))
+            if upload_id is not None:
+                upload_id = uuid.UUID(hex=upload_id).hex
+        except (TypeError, ValueError):
+            self._error(upload_id, "file_start needs a size and, to resume, the upload_id from file_ready")
+            return
+        if size <= 0 or (settings.UPLOAD_MAX_FILE_BYTES and size > settings.UPLOAD_MAX_FILE_BYTES):
+            self._error(upload_id, f"File size must be between 1 byte and {settings.UPLOAD_MAX_FILE_BYTES} bytes")
+            return
+
+        previous = self.uploads.get(upload_id) if upload_id else None
+        limit = settings.CHAT_FILE_MAX_ACTIVE_UPLOADS
+        if limit and len(self.uploads) - (previous is not None) >= limit:
+            self._error(upload_id, f"At most {limit} unfinished uploads per connection; finish one first")
+            return
+        limit = settings.CHAT_FILE_MAX_PENDING_BYTES
+        pending = _pending_bytes.get(self.user_id, 0) - (previous.size if previous is not None else 0)
+        if limit and pending + size > limit:
+            self._error(upload_id, f"Unfinished uploads may total at most {limit} bytes; finish one first")
+            return
+
+        upload_id = upload_id or uuid.uuid4().hex
+        if previous is not None:
+            self._forget(previous)
+            if previous.file is not None:
+                await asyncio.to_thread(previous.file.close)
+        upload = Upload(
+            upload_id,
+            uploads.safe_filename(data.get("filename")),
+            data.get("content_type") or "application/octet-stream",
+            size,
+            self._partial_path(upload_id)
+        )
+        # Counted before the first await, so concurrent starts see each other
+        self.uploads[upload_id] = upload
+        _pending_bytes[self.user_id] = _pending_bytes.get(self.user_id, 0) + size
+
+        if time.time() - _last_sweep > settings.CHAT_FILE_PARTIAL_TTL_SECONDS / 4:
+            _last_sweep = time.time()
+            await asyncio.to_thread(_sweep_partials)
+        try:
+            upload.file, upload.received = await asyncio.to_thread(_open_partial, upload.partial)
+        except OSError as e:
+            self._forget(upload)
+            logger.error(f"Error opening upload {upload_id}: {str(e)}")
+            self._error(upload_id, "Could not store the upload; try again later")
+            return
+        if upload.received > upload.size:
+            # Not the file the partial one was started for; start over
+            await asyncio.to_thread(upload.file.truncate, 0)
+            upload.received = 0
+        elif upload.received:
+            RESUMED.inc()
+
+        self._ready(upload)
+        if upload.received == upload.size:
+            await self._finish(upload)
+
+    async def receive(self, frame: bytes):
+        """Handle a binary frame: write the chunk if it continues its upload"""
+        if len(frame) < HEADER_SIZE:
+            self._error(None, "Binary frames start with the upload id and offset")
+            return
+        upload_id = frame[:16].hex()
+        offset = int.from_bytes(frame[16:HEADER_SIZE], "big")
+        chunk = memoryview(frame)[HEADER_SIZE:]
+
+        upload = self.uploads.get(upload_id)
+        if upload is None:
+            self._error(upload_id, "Unknown upload; send file_start first")
+            return
+        if len(chunk) > settings.CHAT_FILE_CHUNK_BYTES:
+            self._error(upload_id, f"Chunks are at most {settings.CHAT_FILE_CHUNK_BYTES} bytes")
+            return
+        if offset != upload.received:
+            self._ready(upload)
+            return
+        if upload.received + len(chunk) > upload.size:
+            self._error(upload_id, "More data than the size given in file_start")
+            await self._discard(upload)
+            return
+
+        # Awaiting the write before reading the next frame applies backpressure
+        # to the sender, and nothing is buffered beyond one chunk
+        await asyncio.to_thread(upload.file.write, chunk)
+        upload.received += len(chunk)
+        BYTES_RECEIVED.inc(len(chunk))
+
+        if upload.received == upload.size:
+            await self._finish(upload)
+            return
+        now = time.monotonic()
+        if now - upload.reported_at >= settings.CHAT_FILE_PROGRESS_INTERVAL_SECONDS:
+            upload.reported_at = now
+            await self.room.broadcast({
+                "type": "file_progress",
+                "upload_id": upload.id,
+                "user_id": self.user_id,
+                "filename": upload.filename,
+                "received": upload.received,
+                "size": upload.size
+            })
+
+    def _forget(self, upload: Upload):
+        """Stop tracking an upload and release its share of the user's pending bytes"""
+        if self.uploads.get(upload.id) is not upload:
+            return
+        del self.uploads[upload.id]
+        pending = _pending_bytes.get(self.user_id, 0) - upload.size
+        if pending > 0:
+            _pending_bytes[self.user_id] = pending
+        else:
+            _pending_bytes.pop(self.user_id, None)
+
+    def _store(self, upload: Upload) -> Path:
+        """Move a complete upload into the served directory (blocking)"""
+        upload.file.close()
+        destination = CHAT_UPLOAD_DIR / uploads.safe_filename(f"{self.room.room_id}_{upload.id[:8]}_{upload.filename}")
+        os.replace(upload.partial, destination)
+        return destination
+
+    async def _finish(self, upload: Upload):
+        self._forget(upload)
+        path = await asyncio.to_thread(self._store, upload)
+        COMPLETED.inc()
+        await self.room.broadcast({
+            "type": "file",
+            "upload_id": upload.id,
+            "user_id": self.user_id,
+            "file_data": {
+                "filename": upload.filename,
+                "content_type": upload.content_type,
+                "size": upload.size,
+                "url": downloads.signed_url(str(path), upload.filename, upload.content_type)
+            }
+        })
+
+    async def _discard(self, upload: Upload):
+        self._forget(upload)
+        await asyncio.to_thread(upload.file.close)
+        await asyncio.to_thread(upload.partial.unlink, True)
+
+    async def close(self):
+        """Release the files of unfinished uploads; they stay on disk to be resumed"""
+        for upload in list(self.uploads.values()):
+            self._forget(upload)
+            try:
+                if upload.file is not None:
+                    await asyncio.to_thread(upload.file.close)
+            except Exception as e:
+                logger.error(f"Error closing upload {upload.id}: {str(e)}")
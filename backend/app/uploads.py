@@ -0,0 +1,126 @@
+"""
+Upload handling that never holds a whole file in memory or blocks the event loop.
+
+Request bodies are capped by RequestSizeLimitMiddleware before multipart parsing
+spools them to disk; each file is then copied to its destination in fixed-size
+chunks on a worker thread, computing its size and SHA-256 on the way and giving
+up as soon as it passes the per-file limit.
+"""
+import asyncio
+import hashlib
+import json
+from pathlib import Path
+from typing import NamedTuple, Optional
+from fastapi import HTTPException, UploadFile, status
+from .config import get_settings
+
+settings = get_settings()
+
+CHUNK_SIZE = 1024 * 1024
+
+class StoredFile(NamedTuple):
+    path: Path
+    size: int
+    sha256: str
+
+def _too_large(limit: int) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"File exceeds the {limit // (1024 * 1024)} MB upload limit"
+    )
+
+def safe_filename(filename: str) -> str:
+    """Strip any directory part a client put in the filename"""
+    return Path(filename or "").name or "upload"
+
+def copy_stream(source, destination: Path, max_bytes: Optional[int] = None) -> StoredFile:
+    """Copy a binary file object to `destination` chunk by chunk (blocking)"""
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(destination, "wb") as out:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise _too_large(max_bytes)
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        destination.unlink(missing_ok=True)
+        raise
+    return StoredFile(destination, size, digest.hexdigest())
+
+def check_upload(upload: UploadFile, max_bytes: Optional[int] = None) -> int:
+    """Resolve the per-file limit and rewind the upload, rejecting it early if it is already known to be too big"""
+    max_bytes = settings.UPLOAD_MAX_FILE_BYTES if max_bytes is None else max_bytes
+    # The multipart parser already knows the size; reject before copying anything
+    if max_bytes and upload.size is not None and upload.size > max_bytes:
+        raise _too_large(max_bytes)
+    upload.file.seek(0)
+    return max_bytes
+
+async def save_upload(upload: UploadFile, destination: Path, max_bytes: Optional[int] = None) -> StoredFile:
+    """Stream an uploaded file to disk on a worker thread, returning its size and hash"""
+    max_bytes = check_upload(upload, max_bytes)
+    return await asyncio.to_thread(copy_stream, upload.file, destination, max_bytes)
+
+class _BodyTooLarge(HTTPException):
+    # An HTTPException so FastAPI's body parsing passes it through as a 413
+    def __init__(self):
+        super().__init__(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Request body too large")
+
+class RequestSizeLimitMiddleware:
+    """
+    Reject request bodies over `max_bytes` with 413 before they are parsed: up front
+    from Content-Length, or mid-stream for chunked bodies.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def _reject(self, send):
+        body = json.dumps({"detail": "Request body too large"}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.max_bytes:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+            await self._reject(send)
+            return
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise _BodyTooLarge()
+            return message
+
+        async def tracking_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except _BodyTooLarge:
+            if not response_started:
+                await self._reject(send)
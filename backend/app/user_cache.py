@@ -0,0 +1,218 @@
+"""
+Cache of authenticated users keyed by token subject.
+
+`get_current_user` runs on every authenticated request, so the resolved user is
+kept in a per-process TTL/LRU cache, optionally backed by a shared Redis cache
+(AUTH_CACHE_REDIS_URL) so multi-worker deployments fill it once per user.
+
+Entries are dropped when a User row is updated or deleted through a session
+(see the session hooks at the bottom). With a shared cache, other workers
+still hold their local copy for at most AUTH_CACHE_LOCAL_TTL_SECONDS.
+Bulk UPDATE statements bypass the session hooks; call `invalidate_user` after them.
+
+The shared cache is only an optimisation: when Redis fails or times out the
+error is logged and counted, lookups fall back to the local cache and the
+database, and the worker leaves Redis alone for AUTH_CACHE_REDIS_RETRY_SECONDS.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Set
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from . import models, metrics
+from .config import get_settings
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+CACHE_LOOKUPS = metrics.counter("auth_user_cache_lookups_total", "Current-user cache lookups by result")
+SHARED_ERRORS = metrics.counter("auth_user_cache_shared_errors_total", "Shared user cache operations that failed, by operation")
+
+class CurrentUser(NamedTuple):
+    """Read-only snapshot of the authenticated user, safe to share between requests"""
+    id: int
+    email: str
+    full_name: Optional[str]
+    is_active: bool
+
+    @classmethod
+    def from_model(cls, user: models.User) -> "CurrentUser":
+        return cls(user.id, user.email, user.full_name, bool(user.is_active))
+
+def cache_key(user_id: Optional[int] = None, email: Optional[str] = None) -> str:
+    # Tokens carrying a uid claim are keyed by id, older tokens by their email subject
+    return f"uid:{user_id}" if user_id is not None else f"sub:{email}"
+
+class LocalCache:
+    """Thread-safe LRU with a per-entry expiry"""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class SharedCache:
+    """Redis-backed tier shared by every worker; failures are logged, never raised"""
+    prefix = "auth:user:"
+
+    def __init__(self, url: str, ttl: int):
+        import redis
+        import redis.asyncio as aioredis
+        self.ttl = ttl
+        timeout = settings.AUTH_CACHE_REDIS_TIMEOUT_SECONDS
+        self._async = aioredis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        # For invalidations from session hooks running outside the event loop
+        self._sync = redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        self._down_until = 0.0
+        self._deletes: Set[asyncio.Task] = set()
+
+    def _available(self) -> bool:
+        return time.monotonic() >= self._down_until
+
+    def _failed(self, operation: str, error: Exception):
+        SHARED_ERRORS.inc(operation=operation)
+        self._down_until = time.monotonic() + settings.AUTH_CACHE_REDIS_RETRY_SECONDS
+        logger.warning(f"Shared user cache {operation} failed, using the local cache and database: {str(error)}")
+
+    async def get(self, key: str) -> Optional[CurrentUser]:
+        if not self._available():
+            return None
+        try:
+            raw = await self._async.get(self.prefix + key)
+            return CurrentUser(**json.loads(raw)) if raw else None
+        except Exception as e:
+            self._failed("get", e)
+            return None
+
+    async def set(self, key: str, user: CurrentUser):
+        if not self._available():
+            return
+        try:
+            await self._async.set(self.prefix + key, json.dumps(user._asdict()), ex=self.ttl)
+        except Exception as e:
+            self._failed("set", e)
+
+    async def _delete_async(self, keys):
+        try:
+            await self._async.delete(*keys)
+        except Exception as e:
+            self._failed("delete", e)
+
+    def delete(self, *keys: str):
+        """Drop keys without blocking: on the event loop in a task, elsewhere with the sync client"""
+        # Deletes are attempted even while the cache counts as down, so a stale
+        # entry is not left behind once it comes back
+        keys = [self.prefix + key for key in keys]
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is not None:
+            # Session hooks of async handlers run on the loop; a blocking call
+            # there would stall it, and an error would fail an already committed request
+            task = loop.create_task(self._delete_async(keys))
+            self._deletes.add(task)
+            task.add_done_callback(self._deletes.discard)
+            return
+        try:
+            self._sync.delete(*keys)
+        except Exception as e:
+            self._failed("delete", e)
+
+shared = SharedCache(settings.AUTH_CACHE_REDIS_URL, settings.AUTH_CACHE_TTL_SECONDS) if settings.AUTH_CACHE_REDIS_URL else None
+local = LocalCache(
+    settings.AUTH_CACHE_MAX_ENTRIES,
+    min(settings.AUTH_CACHE_TTL_SECONDS, settings.AUTH_CACHE_LOCAL_TTL_SECONDS) if shared else settings.AUTH_CACHE_TTL_SECONDS
+)
+
+async def get_user(key: str) -> Optional[CurrentUser]:
+    if settings.AUTH_CACHE_TTL_SECONDS <= 0:
+        return None
+    user = local.get(key)
+    if user is not None:
+        CACHE_LOOKUPS.inc(result="local_hit")
+        return user
+    if shared is not None:
+        user = await shared.get(key)
+        if user is not None:
+            CACHE_LOOKUPS.inc(result="shared_hit")
+            local.set(key, user)
+            return user
+    CACHE_LOOKUPS.inc(result="miss")
+    return None
+
+async def set_user(key: str, user: CurrentUser):
+    if settings.AUTH_CACHE_TTL_SECONDS <= 0:
+        return
+    local.set(key, user)
+    if shared is not None:
+        await shared.set(key, user)
+
+def invalidate_user(user_id: int, *emails: str):
+    """Drop every cached entry for a user (pass the old email too if it changed)"""
+    keys = [cache_key(user_id=user_id)] + [cache_key(email=email) for email in emails if email]
+    local.delete(*keys)
+    if shared is not None:
+        shared.delete(*keys)
+
+# Collect changed users at flush time and invalidate once the transaction commits,
+# so a concurrent request cannot re-cache the old row in between. Flushed users are
+# also dropped right away, which covers sessions that never commit.
+_PENDING = "user_cache_invalidate"
+
+def _user_keys(user: models.User):
+    # The email history still holds the old address if this flush changed it
+    return user.id, [user.email, *inspect(user).attrs.email.history.deleted]
+
+@event.listens_for(Session, "after_flush")
+def _collect_changed_users(session, flush_context):
+    changed = [obj for obj in list(session.dirty) + list(session.deleted) if isinstance(obj, models.User)]
+    for user in changed:
+        if user.id is None:
+            continue
+        user_id, emails = _user_keys(user)
+        session.info.setdefault(_PENDING, []).append((user_id, emails))
+        invalidate_user(user_id, *emails)
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed_users(session):
+    for user_id, emails in session.info.pop(_PENDING, []):
+        invalidate_user(user_id, *emails)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending(session):
+    session.info.pop(_PENDING, None)
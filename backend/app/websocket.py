@@ -1,117 +1,405 @@
-from typing import Set, List, Dict
-import json
+from typing import Deque, Hashable, Set, List, Dict, Optional, Tuple
+import asyncio
+import logging
 import uuid
-from fastapi import WebSocket, WebSocketDisconnect
+from array import array
+from collections import deque
+from fastapi import WebSocket
+from fastapi.websockets import WebSocketState
 from datetime import datetime
+from . import frames
+from .broker import broker
+from .config import get_settings
+from .outbound import Outbound
 
-class Room:
-    def __init__(self):
-        self.connections: Dict[str, WebSocket] = {}  # user_id -> websocket
-        self.messages: List[Dict] = []
-        self.polls: Dict[str, Dict] = {}
-        self.media_states: Dict[str, Dict] = {}  # user_id -> media state
-        self.room_metadata: Dict = {
-            "created_at": datetime.now().isoformat(),
-            "participants": {}
-        }
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+# Events that change room history or polls; they go into the broker's room log
+# so a worker opening the room later can rebuild its state
+LOGGED_EVENTS = ("chat", "system", "file", "poll", "vote")
+
+# Events where only the latest version matters, and the field that tells
+# versions apart; a queued one is replaced rather than followed by another
+COALESCED_EVENTS = {
+    "media_state": "user_id",
+    "typing": "user_id",
+    "poll_update": "poll_id",
+    "file_progress": "upload_id"
+}
+
+# Messages kept for clients joining the room, and how many
+HISTORY_EVENTS = ("chat", "system", "file")
+HISTORY_SIZE = 100
+
+# Sent by the server only; Room.receive refuses them from clients
+SERVER_EVENTS = (
+    "system", "file", "file_progress", "file_ready", "file_error", "poll_update",
+    "user_joined", "user_left", "room_state", "resumed", "error"
+)
+
+class InvalidEvent(ValueError):
+    """A client event that cannot be applied; it is refused before it reaches the broker"""
+
+def coalesce_key(message: Dict):
+    field = COALESCED_EVENTS.get(message.get("type"))
+    return None if field is None else (message["type"], message.get(field))
+
+# Workers host thousands of mostly idle rooms, so the per-room records below
+# use __slots__ instead of a dict per instance
+
+class MediaState:
+    __slots__ = ("video", "audio", "screen")
+
+    def __init__(self, video: bool = True, audio: bool = True, screen: bool = False):
+        self.video = video
+        self.audio = audio
+        self.screen = screen
+
+    def update(self, state: Dict):
+        for name in self.__slots__:
+            if name in state:
+                setattr(self, name, bool(state[name]))
+
+    def to_dict(self) -> Dict:
+        return {"video": self.video, "audio": self.audio, "screen": self.screen}
 
-    async def connect(self, websocket: WebSocket, user_id: str, user_data: Dict):
-        await websocket.accept()
-        self.connections[user_id] = websocket
-        self.room_metadata["participants"][user_id] = user_data
-        self.media_states[user_id] = {
-            "video": True,
-            "audio": True,
-            "screen": False
+class Participant:
+    """A user connected to the room through this worker"""
+    __slots__ = ("id", "name", "joined_at", "media")
+
+    def __init__(self, user_id: str, name: str, joined_at: str):
+        self.id = user_id
+        self.name = name
+        self.joined_at = joined_at
+        self.media = MediaState()
+
+    def to_dict(self) -> Dict:
+        return {"id": self.id, "name": self.name, "joined_at": self.joined_at}
+
+    def presence(self) -> Dict:
+        return {"user": self.to_dict(), "media": self.media.to_dict()}
+
+class Poll:
+    """Tallies are a C array of counts; voters maps each user to an option index"""
+    __slots__ = ("question", "options", "votes", "voters")
+
+    def __init__(self, question: str, options: List[str]):
+        self.question = question
+        self.options: Tuple[str, ...] = tuple(options)
+        self.votes = array("l", [0]) * len(self.options)
+        self.voters: Dict[str, int] = {}
+
+    def vote(self, user_id: str, option_index: int):
+        if not 0 <= option_index < len(self.votes):
+            raise IndexError(f"Poll has no option {option_index}")
+        previous = self.voters.get(user_id)
+        if previous is not None:
+            self.votes[previous] -= 1
+        self.votes[option_index] += 1
+        self.voters[user_id] = option_index
+
+    def to_dict(self) -> Dict:
+        return {
+            "question": self.question,
+            "options": list(self.options),
+            "votes": self.votes.tolist(),
+            "voters": dict(self.voters)
         }
 
-    def disconnect(self, user_id: str):
-        if user_id in self.connections:
-            del self.connections[user_id]
-        if user_id in self.room_metadata["participants"]:
-            del self.room_metadata["participants"][user_id]
-        if user_id in self.media_states:
-            del self.media_states[user_id]
+class Room:
+    """
+    One worker's replica of a room. Broadcasts go through the broker and every
+    replica applies them in the order the broker delivers them, so history and
+    polls agree across workers; participants and media states come from the
+    broker's presence records.
+
+    Every broadcast carries the room's next sequence number as "seq", and the
+    replica keeps the last ROOM_REPLAY_SIZE frames it sent. A client that
+    reconnects with ?last_seq=N gets only the events after N followed by
+    {"type": "resumed", "seq": ...}, or a room_state (which has its own "seq")
+    when some of them are no longer kept. Coalesced events (media_state,
+    typing, poll_update, file_progress) can overtake others in a send queue, so clients take
+    N from the last event of any other type.
+    """
+
+    __slots__ = (
+        "room_id", "channel", "created_at", "connections", "participants", "messages", "polls",
+        "seq", "recent", "_backlog"
+    )
+
+    def __init__(self, room_id: str):
+        self.room_id = room_id
+        self.channel = f"room:{room_id}"
+        self.created_at = datetime.now().isoformat()
+        self.connections: Dict[str, Outbound] = {}  # user_id -> send queue, on this worker
+        self.participants: Dict[str, Participant] = {}  # connected through this worker
+        # Kept as the encoded frames sent to clients, a fraction of the size of the dicts
+        self.messages: Deque[str] = deque(maxlen=HISTORY_SIZE)
+        self.polls: Dict[str, Poll] = {}
+        self.seq = 0  # Of the last event applied
+        # (seq, frame, coalescing key, excluded user) of the last events sent
+        self.recent: Deque[Tuple[int, str, Optional[Hashable], Optional[str]]] = deque(maxlen=settings.ROOM_REPLAY_SIZE)
+        self._backlog: Optional[List[Dict]] = None  # Events received while opening
+
+    async def open(self):
+        """Subscribe to the room's channel and rebuild its state from the broker's logs"""
+        self._backlog = []
+        await broker.subscribe(self.channel, self._on_event)
+        seq, history, replay = await broker.snapshot(self.channel)
+        for event in history:
+            try:
+                self._apply(self._stamped(event))
+            except Exception as e:
+                # Skipped rather than failing every join until the log expires
+                logger.error(f"Skipping room {self.room_id} history entry {event.get('seq')}: {str(e)}")
+        # Votes replay as the current tallies, which is all a client needs
+        for event in replay:
+            try:
+                message = self._outgoing(self._stamped(event))
+            except Exception as e:
+                logger.error(f"Skipping room {self.room_id} replay entry {event.get('seq')}: {str(e)}")
+                continue
+            self.recent.append((event["seq"], frames.dumps(message), coalesce_key(message), event.get("exclude")))
+        self.seq = seq
+        backlog, self._backlog = self._backlog, None
+        for event in backlog:
+            await self._on_event(event)
+
+    async def close(self):
+        await broker.unsubscribe(self.channel)
+        # The last one out anywhere drops the history, as a single worker always did
+        if not await broker.members(self.channel):
+            await broker.forget(self.channel)
+
+    async def connect(self, websocket: WebSocket, user_id: str, user_data: Dict, last_seq: Optional[int] = None) -> Outbound:
+        """
+        Join a user and queue what they are missing: the events since last_seq
+        if it is given and they are all kept, the room state otherwise. The
+        websocket is accepted here unless logging in already did
+        """
+        if websocket.application_state == WebSocketState.CONNECTING:
+            await websocket.accept()
+        previous = self.connections.pop(user_id, None)
+        if previous is not None:
+            # A reconnect; the old socket is most likely half-dead already
+            await previous.close()
+            try:
+                await previous.websocket.close()
+            except Exception:
+                pass
+        participant = self.participants[user_id] = Participant(user_id, user_data.get("name"), user_data.get("joined_at"))
+        await broker.join(self.channel, user_id, participant.presence())
+
+        missed = None if last_seq is None else self._missed(last_seq)
+        state = await self.get_room_state() if missed is None else None
+        # Nothing is awaited from here on, so no live event can slip in between
+        # what is missed and the connection being added
+        outbound = self.connections[user_id] = Outbound(websocket)
+        if state is not None:
+            outbound.send(frames.dumps({"type": "room_state", "seq": self.seq, "data": state}))
+        else:
+            for seq, frame, key, exclude_user in missed:
+                if exclude_user != user_id:
+                    outbound.send(frame, key)
+            outbound.send(frames.dumps({"type": "resumed", "seq": self.seq}))
+        return outbound
+
+    async def disconnect(self, user_id: str, outbound: Optional[Outbound]) -> bool:
+        """Remove the connection connect() returned, unless a reconnect replaced it; True if the user left"""
+        current = self.connections.get(user_id)
+        if current is None or current is not outbound:
+            return False
+        del self.connections[user_id]
+        await current.close()
+        await broker.leave(self.channel, user_id)
+        self.participants.pop(user_id, None)
+        return True
+
+    def _check(self, message: Dict):
+        """
+        Refuse events the replicas could not apply. Polls and votes go into the
+        history every replica opening the room replays, so one bad one there
+        would break the room for later joins until the log expires
+        """
+        if not isinstance(message, dict) or not isinstance(message.get("type"), str):
+            raise InvalidEvent("Events are JSON objects with a type")
+        if message["type"] == "poll":
+            content = message.get("content")
+            if not (
+                isinstance(content, dict)
+                and isinstance(content.get("question"), str)
+                and isinstance(content.get("options"), list)
+                and content["options"]
+                and all(isinstance(option, str) for option in content["options"])
+            ):
+                raise InvalidEvent("A poll needs content with a question and a list of options")
+        elif message["type"] == "vote":
+            poll = self.polls.get(message.get("poll_id"))
+            if poll is None:
+                raise InvalidEvent("Unknown poll")
+            option_index = message.get("option_index")
+            if isinstance(option_index, bool) or not isinstance(option_index, int) or not 0 <= option_index < len(poll.options):
+                raise InvalidEvent(f"option_index must be between 0 and {len(poll.options) - 1}")
+            if not isinstance(message.get("user_id"), str):
+                raise InvalidEvent("A vote needs the voter's user_id")
+        elif message["type"] == "media_state" and not isinstance(message.get("state"), dict):
+            raise InvalidEvent("media_state needs a state object")
+
+    async def receive(self, message: Dict, user_id: str):
+        """Broadcast an event a client sent; raises InvalidEvent for one it may not send"""
+        if isinstance(message, dict) and message.get("type") in SERVER_EVENTS:
+            raise InvalidEvent(f"{message['type']} is sent by the server only")
+        if isinstance(message, dict) and message.get("type") in ("media_state", "vote"):
+            # Clients only send their own state and votes
+            message["user_id"] = user_id
+        await self.broadcast(message)
 
     async def broadcast(self, message: Dict, exclude_user: str = None):
+        """Publish an event to the room; raises InvalidEvent for one it could not apply"""
+        self._check(message)
         message["timestamp"] = datetime.now().isoformat()
-        
-        if message["type"] in ["chat", "system"]:
-            self.messages.append(message)
-            if len(self.messages) > 100:  # Keep last 100 messages
-                self.messages.pop(0)
-        
+
+        if message["type"] == "poll":
+            # Chosen here so every replica files the poll under the same id
+            message["poll_id"] = str(uuid.uuid4())
+
         elif message["type"] == "media_state":
-            user_id = message["user_id"]
-            self.media_states[user_id].update(message["state"])
-            
+            participant = self.participants.get(message.get("user_id"))
+            if participant is not None:
+                participant.media.update(message["state"])
+                await broker.join(self.channel, participant.id, participant.presence())
+
+        await broker.publish_event(
+            self.channel,
+            {"message": message, "exclude": exclude_user},
+            settings.ROOM_LOG_SIZE if message["type"] in LOGGED_EVENTS else 0,
+            settings.ROOM_REPLAY_SIZE
+        )
+
+    async def send_to_user(self, user_id: str, message: Dict):
+        await broker.publish(self.channel, {"message": message, "to": user_id})
+
+    @staticmethod
+    def _stamped(event: Dict) -> Dict:
+        return {**event["message"], "seq": event["seq"]}
+
+    def _apply(self, message: Dict) -> Dict:
+        """Apply an event to the room state; returns what to send to clients"""
+        if message["type"] in HISTORY_EVENTS:
+            self.messages.append(frames.dumps(message))  # The deque drops the oldest past HISTORY_SIZE
+
         elif message["type"] == "poll":
-            poll_id = str(uuid.uuid4())
             poll_data = message["content"]
-            self.polls[poll_id] = {
-                "question": poll_data["question"],
-                "options": poll_data["options"],
-                "votes": [0] * len(poll_data["options"]),
-                "voters": {}
-            }
-            message["poll_id"] = poll_id
-            
+            self.polls[message["poll_id"]] = Poll(poll_data["question"], poll_data["options"])
+
         elif message["type"] == "vote":
-            poll_id = message["poll_id"]
-            if poll_id in self.polls:
-                user_id = message["user_id"]
-                option_index = message["option_index"]
-                
-                if user_id in self.polls[poll_id]["voters"]:
-                    prev_vote = self.polls[poll_id]["voters"][user_id]
-                    self.polls[poll_id]["votes"][prev_vote] -= 1
-                
-                self.polls[poll_id]["votes"][option_index] += 1
-                self.polls[poll_id]["voters"][user_id] = option_index
-                
-                message = {
+            poll = self.polls.get(message["poll_id"])
+            if poll is not None:
+                poll.vote(message["user_id"], message["option_index"])
+
+        return self._outgoing(message)
+
+    def _outgoing(self, message: Dict) -> Dict:
+        if message["type"] == "vote":
+            poll = self.polls.get(message["poll_id"])
+            if poll is not None:
+                return {
                     "type": "poll_update",
-                    "poll_id": poll_id,
-                    "votes": self.polls[poll_id]["votes"]
+                    "poll_id": message["poll_id"],
+                    "votes": poll.votes.tolist(),
+                    "seq": message.get("seq")
                 }
+        return message
 
-        for user_id, connection in self.connections.items():
+    async def _on_event(self, event: Dict):
+        target = event.get("to")
+        if target is not None:
+            self._send(target, event["message"])
+            return
+
+        if self._backlog is not None:
+            self._backlog.append(event)
+            return
+        if event["seq"] <= self.seq:
+            return  # Already in the logs the room was opened from
+        self.seq = event["seq"]
+
+        message = self._apply(self._stamped(event))
+        key = coalesce_key(message)
+        # Encoded once; every connection's writer sends the same frame. History
+        # messages were encoded when they were added to it
+        frame = self.messages[-1] if message["type"] in HISTORY_EVENTS else frames.dumps(message)
+        exclude_user = event.get("exclude")
+        self.recent.append((self.seq, frame, key, exclude_user))
+        for user_id, outbound in self.connections.items():
             if exclude_user and user_id == exclude_user:
                 continue
-            try:
-                await connection.send_json(message)
-            except WebSocketDisconnect:
-                self.disconnect(user_id)
+            outbound.send(frame, key)
 
-    async def send_to_user(self, user_id: str, message: Dict):
-        if user_id in self.connections:
-            try:
-                await self.connections[user_id].send_json(message)
-            except WebSocketDisconnect:
-                self.disconnect(user_id)
+    def _send(self, user_id: str, message: Dict):
+        outbound = self.connections.get(user_id)
+        if outbound is not None:
+            outbound.send(frames.dumps(message), coalesce_key(message))
+
+    def _missed(self, last_seq: int) -> Optional[List[Tuple[int, str, Optional[Hashable], Optional[str]]]]:
+        """The events after last_seq, or None when they are not all kept"""
+        if last_seq == self.seq:
+            return []
+        if last_seq > self.seq or not self.recent or self.recent[0][0] > last_seq + 1:
+            return None
+        return [entry for entry in self.recent if entry[0] > last_seq]
 
-    def get_room_state(self) -> Dict:
+    async def get_room_state(self) -> Dict:
+        # Everyone in the room, whichever worker they are connected to
+        members = await broker.members(self.channel)
         return {
-            "participants": self.room_metadata["participants"],
-            "media_states": self.media_states,
-            "messages": self.messages[-100:],  # Last 100 messages
-            "polls": self.polls
+            "participants": {user_id: member["user"] for user_id, member in members.items()},
+            "media_states": {user_id: member["media"] for user_id, member in members.items()},
+            "messages": [frames.loads(frame) for frame in self.messages],
+            "polls": {poll_id: poll.to_dict() for poll_id, poll in self.polls.items()}
         }
 
 class RoomManager:
     def __init__(self):
         self.rooms: Dict[str, Room] = {}
+        self._opening: Dict[str, asyncio.Task] = {}
+        # Connections that got a room from create_room and have not released it;
+        # counted from the start, since joining awaits before it adds the connection
+        self._holds: Dict[str, int] = {}
 
-    def create_room(self, room_id: str) -> Room:
+    async def create_room(self, room_id: str) -> Room:
+        """Get a room, opening it if needed; every call must be paired with release_room"""
         if room_id not in self.rooms:
-            self.rooms[room_id] = Room()
-        return self.rooms[room_id]
+            self.rooms[room_id] = Room(room_id)
+            self._opening[room_id] = asyncio.ensure_future(self.rooms[room_id].open())
+        room = self.rooms[room_id]
+        self._holds[room_id] = self._holds.get(room_id, 0) + 1
+        # Concurrent joins of a new room all wait for it to be opened once
+        try:
+            await self._opening[room_id]
+        except BaseException:
+            await self.release_room(room_id)
+            raise
+        return room
+
+    async def release_room(self, room_id: str):
+        """Close the room once nobody who got it from create_room still holds it"""
+        holds = self._holds.get(room_id, 0) - 1
+        if holds > 0:
+            self._holds[room_id] = holds
+            return
+        self._holds.pop(room_id, None)
+        await self.delete_room(room_id)
 
     def get_room(self, room_id: str) -> Room:
         return self.rooms.get(room_id)
 
-    def delete_room(self, room_id: str):
+    async def delete_room(self, room_id: str):
         if room_id in self.rooms:
-            del self.rooms[room_id]
+            room = self.rooms.pop(room_id)
+            self._opening.pop(room_id, None)
+            await room.close()
 
-room_manager = RoomManager() 
\ No newline at end of file
+room_manager = RoomManager()
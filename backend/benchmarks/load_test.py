@@ -0,0 +1,88 @@
+"""
+Concurrent load test for the hot read endpoints of a running backend.
+
+Fires `--concurrency` parallel clients at the folder, chat history and unread
+count endpoints for `--duration` seconds while a probe task measures how long a
+trivial request (the OpenAPI schema) waits, which tracks event-loop stalls.
+Run it against a build before and after a change and compare the summaries.
+Needs httpx, which is not a runtime dependency.
+
+    python -m benchmarks.load_test --base-url http://localhost:8000 \\
+        --email test@example.com --password password123 --concurrency 64
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import httpx
+
+ENDPOINTS = [
+    "/api/folders/inbox",
+    "/api/folders/sent",
+    "/api/chat/unread-counts",
+    "/api/users/me",
+]
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+async def worker(client, headers, deadline, latencies, errors, offset):
+    i = offset
+    while time.perf_counter() < deadline:
+        path = ENDPOINTS[i % len(ENDPOINTS)]
+        i += 1
+        started = time.perf_counter()
+        try:
+            response = await client.get(path, headers=headers)
+            if response.status_code >= 400:
+                errors.append(response.status_code)
+        except httpx.HTTPError as e:
+            errors.append(type(e).__name__)
+        latencies.append((time.perf_counter() - started) * 1000)
+
+async def probe(client, deadline, samples):
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        await client.get("/openapi.json")
+        samples.append((time.perf_counter() - started) * 1000)
+        await asyncio.sleep(0.1)
+
+async def run(args):
+    limits = httpx.Limits(max_connections=args.concurrency + 1)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=60) as client:
+        login = await client.post("/api/token", json={"username": args.email, "password": args.password})
+        login.raise_for_status()
+        headers = {"Authorization": f"Bearer {login.json()['access_token']}"}
+        user_id = login.json()["user"]["id"]
+        ENDPOINTS.append(f"/api/chat/messages/{user_id}?cursor=&limit=50")
+
+        latencies, errors, probe_samples = [], [], []
+        deadline = time.perf_counter() + args.duration
+        started = time.perf_counter()
+        await asyncio.gather(
+            probe(client, deadline, probe_samples),
+            *[worker(client, headers, deadline, latencies, errors, n) for n in range(args.concurrency)]
+        )
+        elapsed = time.perf_counter() - started
+
+    print(f"requests:     {len(latencies)} in {elapsed:.1f}s ({len(latencies) / elapsed:.1f} req/s)")
+    print(f"errors:       {len(errors)}")
+    print(f"latency ms:   p50 {percentile(latencies, 50):.1f}  p95 {percentile(latencies, 95):.1f}  "
+          f"p99 {percentile(latencies, 99):.1f}")
+    if probe_samples:
+        print(f"probe ms:     median {statistics.median(probe_samples):.1f}  max {max(probe_samples):.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--email", default="test@example.com")
+    parser.add_argument("--password", default="password123")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=30.0)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Memory held per idle websocket room.
+
+Opens `--rooms` meeting rooms (websocket.Room) on the in-memory broker, each
+with `--participants` connected clients, `--messages` chat messages and a poll
+every participant voted in, then as many chat.ChatRoom rooms with the same
+history, and reports what each room costs according to tracemalloc. Nothing is
+sent anywhere: the clients are stand-ins that discard their frames. Run it
+before and after a change to the room state and compare the summaries.
+
+    python -m benchmarks.room_memory --rooms 2000 --participants 4 --messages 100
+"""
+import argparse
+import asyncio
+import gc
+import tracemalloc
+from datetime import datetime
+from fastapi.websockets import WebSocketState
+from app import chat, websocket
+from app.broker import broker
+
+class IdleClient:
+    """Just enough of a starlette WebSocket for Room.connect and Outbound"""
+
+    application_state = WebSocketState.CONNECTING
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, data: str):
+        pass
+
+    async def close(self, code: int = 1000):
+        pass
+
+def chat_message(room: int, n: int) -> dict:
+    return {
+        "type": "chat",
+        "user_id": f"user-{n % 7}",
+        "content": f"Message {n} in room {room}, about as long as a short chat line",
+        "timestamp": datetime.now().isoformat()
+    }
+
+async def fill_meeting_room(room_id: int, args) -> websocket.Room:
+    room = await websocket.room_manager.create_room(f"bench-{room_id}")
+    for n in range(args.participants):
+        user_id = f"user-{n}"
+        await room.connect(IdleClient(), user_id, {
+            "id": user_id,
+            "name": f"Participant {n}",
+            "joined_at": datetime.now().isoformat()
+        })
+    for n in range(args.messages):
+        room._apply(chat_message(room_id, n))
+    room._apply({
+        "type": "poll",
+        "poll_id": f"poll-{room_id}",
+        "content": {"question": "Which day works?", "options": ["Mon", "Tue", "Wed", "Thu"]}
+    })
+    for n in range(args.participants):
+        room._apply({"type": "vote", "poll_id": f"poll-{room_id}", "user_id": f"user-{n}", "option_index": n % 4})
+    return room
+
+def fill_chat_room(room_id: int, args) -> chat.ChatRoom:
+    room = chat.manager.get_room(f"bench-{room_id}")
+    for n in range(args.messages):
+        message = chat_message(room_id, n)
+        room.add_message(chat.ChatMessage(message.pop("type"), **message))
+    return room
+
+def measure(label: str, rooms: int, before: int):
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    print(f"{label:<14} {used / 1024 / 1024:8.1f} MiB total  {used / rooms / 1024:8.1f} KiB per room")
+    return tracemalloc.get_traced_memory()[0]
+
+async def run(args):
+    await broker.start()
+    tracemalloc.start()
+    gc.collect()
+    before = tracemalloc.get_traced_memory()[0]
+
+    for room_id in range(args.rooms):
+        await fill_meeting_room(room_id, args)
+    # Let the writer tasks settle into waiting for their next frame
+    await asyncio.sleep(0.1)
+    before = measure("meeting rooms", args.rooms, before)
+
+    for room_id in range(args.rooms):
+        fill_chat_room(room_id, args)
+    measure("chat rooms", args.rooms, before)
+
+    tracemalloc.stop()
+    for room_id in list(websocket.room_manager.rooms):
+        room = websocket.room_manager.get_room(room_id)
+        for user_id, outbound in list(room.connections.items()):
+            await room.disconnect(user_id, outbound)
+        await websocket.room_manager.release_room(room_id)
+    await broker.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", type=int, default=2000)
+    parser.add_argument("--participants", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=100)
+    args = parser.parse_args()
+    print(f"{args.rooms} rooms, {args.participants} participants and {args.messages} messages each")
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
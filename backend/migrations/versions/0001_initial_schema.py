@@ -0,0 +1,140 @@
+"""initial schema
+
+Mirrors the tables previously created by Base.metadata.create_all. Tables that
+already exist are left alone so databases created that way adopt this history
+without a manual stamp.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+def _create_table(name, *columns):
+    if not sa.inspect(op.get_bind()).has_table(name):
+        op.create_table(name, *columns)
+    _create_index(f"ix_{name}_id", name, ["id"])
+
+def _create_index(name, table, columns, unique=False):
+    if not any(ix["name"] == name for ix in sa.inspect(op.get_bind()).get_indexes(table)):
+        op.create_index(name, table, columns, unique=unique)
+
+def upgrade():
+    _create_table(
+        "users",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("email", sa.String()),
+        sa.Column("full_name", sa.String()),
+        sa.Column("hashed_password", sa.String()),
+        sa.Column("is_active", sa.Boolean()),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+    )
+    _create_index("ix_users_email", "users", ["email"], unique=True)
+
+    _create_table(
+        "emails",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("subject", sa.String()),
+        sa.Column("content", sa.Text()),
+        sa.Column("sender_id", sa.Integer(), sa.ForeignKey("users.id")),
+        sa.Column("recipient_id", sa.Integer(), sa.ForeignKey("users.id")),
+        sa.Column("is_read", sa.Boolean()),
+        sa.Column("status", sa.String()),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+        sa.Column("scheduled_for", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("category", sa.String()),
+        sa.Column("priority", sa.Integer()),
+        sa.Column("thread_id", sa.String()),
+        sa.Column("in_reply_to", sa.Integer(), sa.ForeignKey("emails.id"), nullable=True),
+        sa.Column("is_draft", sa.Boolean()),
+        sa.Column("labels", sa.String()),
+    )
+    _create_index("ix_emails_thread_id", "emails", ["thread_id"])
+
+    _create_table(
+        "attachments",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("filename", sa.String()),
+        sa.Column("content_type", sa.String()),
+        sa.Column("file_path", sa.String()),
+        sa.Column("size", sa.Integer()),
+        sa.Column("email_id", sa.Integer(), sa.ForeignKey("emails.id")),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+    )
+    _create_table(
+        "email_recipients",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("email_id", sa.Integer(), sa.ForeignKey("emails.id")),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id")),
+        sa.Column("type", sa.String()),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+    )
+    _create_table(
+        "meetings",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("room_id", sa.String()),
+        sa.Column("host_id", sa.Integer(), sa.ForeignKey("users.id")),
+        sa.Column("title", sa.String()),
+        sa.Column("scheduled_time", sa.DateTime(timezone=True)),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+        sa.Column("is_active", sa.Boolean()),
+    )
+    _create_index("ix_meetings_room_id", "meetings", ["room_id"], unique=True)
+
+    _create_table(
+        "meeting_invites",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("meeting_id", sa.Integer(), sa.ForeignKey("meetings.id")),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id")),
+        sa.Column("email", sa.String()),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+    )
+    _create_table(
+        "chat_groups",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("description", sa.String()),
+        sa.Column("created_by", sa.Integer(), sa.ForeignKey("users.id")),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+    )
+    _create_table(
+        "chat_group_members",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("group_id", sa.Integer(), sa.ForeignKey("chat_groups.id")),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id")),
+        sa.Column("joined_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+        sa.Column("is_admin", sa.Boolean()),
+    )
+    _create_table(
+        "chat_messages",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("content", sa.Text(), nullable=False),
+        sa.Column("sender_id", sa.Integer(), sa.ForeignKey("users.id")),
+        sa.Column("recipient_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=True),
+        sa.Column("group_id", sa.Integer(), sa.ForeignKey("chat_groups.id"), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+        sa.Column("is_read", sa.Boolean()),
+        sa.Column("is_rich_text", sa.Boolean()),
+        sa.Column("reactions", sa.String()),
+        sa.Column("reply_to_id", sa.Integer(), sa.ForeignKey("chat_messages.id"), nullable=True),
+        sa.Column("file_path", sa.String(), nullable=True),
+        sa.Column("file_type", sa.String(), nullable=True),
+        sa.Column("file_name", sa.String(), nullable=True),
+        sa.Column("file_size", sa.Integer(), nullable=True),
+        sa.Column("voice_message_path", sa.String(), nullable=True),
+        sa.Column("voice_duration", sa.Integer(), nullable=True),
+        sa.Column("is_voice_message", sa.Boolean()),
+    )
+
+def downgrade():
+    for table in [
+        "chat_messages", "chat_group_members", "chat_groups", "meeting_invites",
+        "meetings", "email_recipients", "attachments", "emails", "users",
+    ]:
+        op.drop_table(table)
@@ -0,0 +1,57 @@
+"""indexes for folder, chat history and unread-count queries
+
+On PostgreSQL the indexes are built CONCURRENTLY so the upgrade does not block
+writes on a live mailbox table.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+def _indexes():
+    # (name, table, columns, options); partial predicates are given per dialect
+    return [
+        ("ix_emails_recipient_folder", "emails",
+         ["recipient_id", "status", sa.text("priority DESC"), sa.text("created_at DESC"), sa.text("id DESC")], {}),
+        ("ix_emails_sender_folder", "emails",
+         ["sender_id", "status", sa.text("priority DESC"), sa.text("created_at DESC"), sa.text("id DESC")], {}),
+        ("ix_emails_sender_drafts", "emails",
+         ["sender_id", sa.text("priority DESC"), sa.text("created_at DESC"), sa.text("id DESC")],
+         {"postgresql_where": sa.text("is_draft"), "sqlite_where": sa.text("is_draft = 1")}),
+        ("ix_emails_recipient_unread", "emails", ["recipient_id", "status", "category"],
+         {"postgresql_where": sa.text("NOT is_read"), "sqlite_where": sa.text("is_read = 0")}),
+        ("ix_emails_trash_created_at", "emails", ["created_at"],
+         {"postgresql_where": sa.text("status = 'trash'"), "sqlite_where": sa.text("status = 'trash'")}),
+        ("ix_emails_in_reply_to", "emails", ["in_reply_to"], {}),
+        ("ix_attachments_email_id", "attachments", ["email_id"], {}),
+        ("ix_email_recipients_email_id", "email_recipients", ["email_id"], {}),
+        ("ix_chat_messages_private", "chat_messages", ["sender_id", "recipient_id", "created_at", "id"], {}),
+        ("ix_chat_messages_group", "chat_messages", ["group_id", "created_at", "id"], {}),
+        ("ix_chat_messages_recipient_unread", "chat_messages", ["recipient_id", "sender_id"],
+         {"postgresql_where": sa.text("NOT is_read"), "sqlite_where": sa.text("is_read = 0")}),
+        ("ix_chat_messages_reply_to_id", "chat_messages", ["reply_to_id"], {}),
+        ("ix_chat_group_members_group_user", "chat_group_members", ["group_id", "user_id"], {}),
+        ("ix_chat_group_members_user_id", "chat_group_members", ["user_id"], {}),
+        ("ix_meeting_invites_meeting_id", "meeting_invites", ["meeting_id"], {}),
+        ("ix_meeting_invites_user_id", "meeting_invites", ["user_id"], {}),
+    ]
+
+def upgrade():
+    if op.get_bind().dialect.name == "postgresql":
+        with op.get_context().autocommit_block():
+            for name, table, columns, options in _indexes():
+                op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True, **options)
+    else:
+        for name, table, columns, options in _indexes():
+            op.create_index(name, table, columns, if_not_exists=True, **options)
+
+def downgrade():
+    for name, table, _, _ in reversed(_indexes()):
+        op.drop_index(name, table_name=table, if_exists=True)
@@ -0,0 +1,76 @@
+"""move comma-separated Email.labels into an email_labels table
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 5000
+
+def _split(value):
+    labels = []
+    for label in (value or "").split(","):
+        label = label.strip()
+        if label and label not in labels:
+            labels.append(label)
+    return labels
+
+def upgrade():
+    op.create_table(
+        "email_labels",
+        sa.Column("email_id", sa.Integer(), sa.ForeignKey("emails.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("label", sa.String(), primary_key=True),
+    )
+    op.create_index("ix_email_labels_label_email", "email_labels", ["label", "email_id"])
+
+    conn = op.get_bind()
+    if conn.dialect.name == "postgresql":
+        op.execute(
+            "INSERT INTO email_labels (email_id, label) "
+            "SELECT DISTINCT e.id, btrim(l) FROM emails e, unnest(string_to_array(e.labels, ',')) AS l "
+            "WHERE e.labels IS NOT NULL AND btrim(l) <> ''"
+        )
+    else:
+        labels = sa.table("email_labels", sa.column("email_id"), sa.column("label"))
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                sa.text(
+                    "SELECT id, labels FROM emails WHERE id > :last_id AND labels IS NOT NULL "
+                    "ORDER BY id LIMIT :batch"
+                ),
+                {"last_id": last_id, "batch": BATCH_SIZE}
+            ).all()
+            if not rows:
+                break
+            values = [{"email_id": row.id, "label": label} for row in rows for label in _split(row.labels)]
+            if values:
+                conn.execute(labels.insert(), values)
+            last_id = rows[-1].id
+
+    # Plain ALTER so SQLite does not rebuild the table (which would drop its FTS triggers)
+    op.execute("ALTER TABLE emails DROP COLUMN labels")
+
+def downgrade():
+    op.add_column("emails", sa.Column("labels", sa.String()))
+    conn = op.get_bind()
+    if conn.dialect.name == "postgresql":
+        op.execute(
+            "UPDATE emails SET labels = l.labels FROM ("
+            "SELECT email_id, string_agg(label, ',' ORDER BY label) AS labels FROM email_labels GROUP BY email_id"
+            ") l WHERE l.email_id = emails.id"
+        )
+    else:
+        op.execute(
+            "UPDATE emails SET labels = (SELECT group_concat(label, ',') FROM email_labels "
+            "WHERE email_labels.email_id = emails.id)"
+        )
+    op.drop_index("ix_email_labels_label_email", table_name="email_labels")
+    op.drop_table("email_labels")
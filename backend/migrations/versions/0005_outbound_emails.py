@@ -0,0 +1,44 @@
+"""durable SMTP delivery queue
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table(
+        "outbound_emails",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("email_id", sa.Integer(), sa.ForeignKey("emails.id", ondelete="SET NULL"), nullable=True),
+        sa.Column("to_email", sa.String(), nullable=False),
+        sa.Column("cc", sa.Text()),
+        sa.Column("subject", sa.String()),
+        sa.Column("content", sa.Text()),
+        sa.Column("attachments", sa.Text()),
+        sa.Column("status", sa.String(), nullable=False),
+        sa.Column("attempts", sa.Integer(), nullable=False),
+        sa.Column("next_attempt_at", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("last_error", sa.Text()),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+        sa.Column("sent_at", sa.DateTime(timezone=True)),
+    )
+    op.create_index("ix_outbound_emails_id", "outbound_emails", ["id"])
+    op.create_index("ix_outbound_emails_email_id", "outbound_emails", ["email_id"])
+    op.create_index(
+        "ix_outbound_emails_due", "outbound_emails", ["next_attempt_at"],
+        postgresql_where=sa.text("status IN ('queued', 'sending')"),
+        sqlite_where=sa.text("status IN ('queued', 'sending')")
+    )
+
+def downgrade():
+    op.drop_index("ix_outbound_emails_due", table_name="outbound_emails")
+    op.drop_index("ix_outbound_emails_email_id", table_name="outbound_emails")
+    op.drop_index("ix_outbound_emails_id", table_name="outbound_emails")
+    op.drop_table("outbound_emails")
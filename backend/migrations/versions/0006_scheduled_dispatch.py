@@ -0,0 +1,35 @@
+"""track scheduled-send dispatch on emails
+
+Emails scheduled before this revision already had their inbox copy created at
+compose time, so they are marked dispatched rather than delivered a second time.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+PREDICATE = "scheduled_for IS NOT NULL AND dispatched_at IS NULL"
+
+def upgrade():
+    op.add_column("emails", sa.Column("dispatched_at", sa.DateTime(timezone=True), nullable=True))
+    op.execute("UPDATE emails SET dispatched_at = created_at WHERE scheduled_for IS NOT NULL")
+
+    options = {"postgresql_where": sa.text(PREDICATE), "sqlite_where": sa.text(PREDICATE)}
+    if op.get_bind().dialect.name == "postgresql":
+        with op.get_context().autocommit_block():
+            op.create_index("ix_emails_scheduled_due", "emails", ["scheduled_for", "id"],
+                            postgresql_concurrently=True, **options)
+    else:
+        op.create_index("ix_emails_scheduled_due", "emails", ["scheduled_for", "id"], **options)
+
+def downgrade():
+    op.drop_index("ix_emails_scheduled_due", table_name="emails")
+    # Plain ALTER so SQLite does not rebuild the table (which would drop its FTS triggers)
+    op.execute("ALTER TABLE emails DROP COLUMN dispatched_at")
@@ -0,0 +1,19 @@
+"""content hash on attachments
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column("attachments", sa.Column("content_hash", sa.String(64), nullable=True))
+
+def downgrade():
+    op.execute("ALTER TABLE attachments DROP COLUMN content_hash")
@@ -0,0 +1,101 @@
+"""content-addressed blob store with reference counts
+
+blobs.refcount is maintained by triggers on attachments.content_hash and
+chat_messages.file_hash, so bulk deletes keep it right without going through
+the ORM. Hashes recorded before this revision get a blob row counting their
+existing references; their files stay where they are.
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0008"
+down_revision = "0007"
+branch_labels = None
+depends_on = None
+
+# table -> hash column referencing blobs.sha256
+REFERENCES = {
+    "attachments": "content_hash",
+    "chat_messages": "file_hash",
+}
+
+def _release(column, prefix):
+    return (
+        f"UPDATE blobs SET refcount = refcount - 1, "
+        f"orphaned_at = CASE WHEN refcount = 1 THEN CURRENT_TIMESTAMP ELSE orphaned_at END "
+        f"WHERE sha256 = {prefix}.{column}"
+    )
+
+def _acquire(column, prefix):
+    return f"UPDATE blobs SET refcount = refcount + 1, orphaned_at = NULL WHERE sha256 = {prefix}.{column}"
+
+def _pg_triggers(table, column):
+    op.execute(
+        f"CREATE FUNCTION {table}_blob_refcount() RETURNS trigger AS $$ BEGIN "
+        f"IF TG_OP IN ('DELETE', 'UPDATE') AND OLD.{column} IS NOT NULL THEN {_release(column, 'OLD')}; END IF; "
+        f"IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.{column} IS NOT NULL THEN {_acquire(column, 'NEW')}; END IF; "
+        f"RETURN NULL; END $$ LANGUAGE plpgsql"
+    )
+    op.execute(
+        f"CREATE TRIGGER {table}_blob_refcount AFTER INSERT OR DELETE OR UPDATE OF {column} ON {table} "
+        f"FOR EACH ROW EXECUTE FUNCTION {table}_blob_refcount()"
+    )
+
+def _sqlite_triggers(table, column):
+    op.execute(
+        f"CREATE TRIGGER {table}_blob_ai AFTER INSERT ON {table} WHEN new.{column} IS NOT NULL "
+        f"BEGIN {_acquire(column, 'new')}; END"
+    )
+    op.execute(
+        f"CREATE TRIGGER {table}_blob_ad AFTER DELETE ON {table} WHEN old.{column} IS NOT NULL "
+        f"BEGIN {_release(column, 'old')}; END"
+    )
+    op.execute(
+        f"CREATE TRIGGER {table}_blob_au AFTER UPDATE OF {column} ON {table} "
+        f"BEGIN {_release(column, 'old')}; {_acquire(column, 'new')}; END"
+    )
+
+def upgrade():
+    op.create_table(
+        "blobs",
+        sa.Column("sha256", sa.String(64), primary_key=True),
+        sa.Column("size", sa.Integer(), nullable=False),
+        sa.Column("refcount", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+        sa.Column("orphaned_at", sa.DateTime(timezone=True)),
+    )
+    op.create_index(
+        "ix_blobs_orphaned", "blobs", ["orphaned_at"],
+        postgresql_where=sa.text("refcount = 0"), sqlite_where=sa.text("refcount = 0")
+    )
+    op.add_column("chat_messages", sa.Column("file_hash", sa.String(64), nullable=True))
+
+    op.execute(
+        "INSERT INTO blobs (sha256, size, refcount) "
+        "SELECT content_hash, MAX(size), COUNT(*) FROM attachments WHERE content_hash IS NOT NULL GROUP BY content_hash"
+    )
+
+    dialect = op.get_bind().dialect.name
+    for table, column in REFERENCES.items():
+        if dialect == "postgresql":
+            _pg_triggers(table, column)
+        else:
+            _sqlite_triggers(table, column)
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table in REFERENCES:
+        if dialect == "postgresql":
+            op.execute(f"DROP TRIGGER IF EXISTS {table}_blob_refcount ON {table}")
+            op.execute(f"DROP FUNCTION IF EXISTS {table}_blob_refcount()")
+        else:
+            for suffix in ("ai", "ad", "au"):
+                op.execute(f"DROP TRIGGER IF EXISTS {table}_blob_{suffix}")
+    # Plain ALTER so SQLite does not rebuild the table (which would drop its triggers)
+    op.execute("ALTER TABLE chat_messages DROP COLUMN file_hash")
+    op.drop_index("ix_blobs_orphaned", table_name="blobs")
+    op.drop_table("blobs")
@@ -0,0 +1,167 @@
+"""materialized mailbox and chat unread counters
+
+mailbox_counters holds total and unread emails per (user, folder, category)
+and chat_unread_counters unread chat messages per (user, sender) and
+(user, group). Triggers keep both in step with every write to emails and
+chat_messages. The same per-folder rules live in counters.py, whose
+reconciliation job corrects any drift.
+
+Group chats get a per-member read marker; existing group history starts out read.
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0010"
+down_revision = "0009"
+branch_labels = None
+depends_on = None
+
+# (user column, folder, condition) for each folder an email row shows up in;
+# mirrors crud.folder_filter
+EMAIL_FOLDERS = [
+    ("recipient_id", "'inbox'", "{p}.status = 'inbox'"),
+    ("sender_id", "'sent'", "{p}.status = 'sent'"),
+    ("sender_id", "'draft'", "{p}.is_draft"),
+    ("recipient_id", "{p}.status", "{p}.status IN ('spam', 'trash')"),
+    ("sender_id", "{p}.status",
+     "{p}.status IN ('spam', 'trash') AND ({p}.recipient_id IS NULL OR {p}.sender_id <> {p}.recipient_id)"),
+]
+
+UNREAD = "CASE WHEN {p}.is_read THEN 0 ELSE 1 END"
+
+EMAIL_UPSERT = (
+    " ON CONFLICT (user_id, folder, category) DO UPDATE SET"
+    " total = mailbox_counters.total + excluded.total,"
+    " unread = mailbox_counters.unread + excluded.unread"
+)
+CHAT_UPSERT = (
+    " ON CONFLICT (user_id, kind, peer_id) DO UPDATE SET"
+    " unread = chat_unread_counters.unread + excluded.unread"
+)
+
+def _email_apply(p, sign):
+    """Statements adding (sign=1) or removing (sign=-1) row `p` from the counters"""
+    return [
+        f"INSERT INTO mailbox_counters (user_id, folder, category, total, unread) "
+        f"SELECT {p}.{user}, {folder.format(p=p)}, COALESCE({p}.category, 'primary'), {sign}, "
+        f"{sign} * {UNREAD.format(p=p)} "
+        f"WHERE {p}.{user} IS NOT NULL AND {condition.format(p=p)}" + EMAIL_UPSERT
+        for user, folder, condition in EMAIL_FOLDERS
+    ]
+
+def _private_chat_apply(p, sign):
+    return (
+        f"INSERT INTO chat_unread_counters (user_id, kind, peer_id, unread) "
+        f"SELECT {p}.recipient_id, 'user', {p}.sender_id, {sign} "
+        f"WHERE {p}.recipient_id IS NOT NULL AND {p}.sender_id IS NOT NULL AND NOT COALESCE({p}.is_read, FALSE)"
+        + CHAT_UPSERT
+    )
+
+GROUP_CHAT_FANOUT = (
+    "INSERT INTO chat_unread_counters (user_id, kind, peer_id, unread) "
+    "SELECT m.user_id, 'group', {p}.group_id, 1 FROM chat_group_members m "
+    "WHERE {p}.group_id IS NOT NULL AND m.group_id = {p}.group_id AND m.user_id <> {p}.sender_id"
+    + CHAT_UPSERT
+)
+
+EMAIL_COLUMNS = "status, is_read, is_draft, category, sender_id, recipient_id"
+CHAT_COLUMNS = "is_read, recipient_id, sender_id"
+
+def _pg_function(name, body):
+    op.execute(f"CREATE FUNCTION {name}() RETURNS trigger AS $$ BEGIN {body} RETURN NULL; END $$ LANGUAGE plpgsql")
+
+def _pg_triggers():
+    release = "; ".join(_email_apply("OLD", -1))
+    acquire = "; ".join(_email_apply("NEW", 1))
+    _pg_function(
+        "emails_counters",
+        f"IF TG_OP IN ('DELETE', 'UPDATE') THEN {release}; END IF; "
+        f"IF TG_OP IN ('INSERT', 'UPDATE') THEN {acquire}; END IF;"
+    )
+    op.execute(
+        f"CREATE TRIGGER emails_counters AFTER INSERT OR DELETE OR UPDATE OF {EMAIL_COLUMNS} ON emails "
+        f"FOR EACH ROW EXECUTE FUNCTION emails_counters()"
+    )
+    _pg_function(
+        "chat_messages_counters",
+        f"IF TG_OP IN ('DELETE', 'UPDATE') THEN {_private_chat_apply('OLD', -1)}; END IF; "
+        f"IF TG_OP IN ('INSERT', 'UPDATE') THEN {_private_chat_apply('NEW', 1)}; END IF; "
+        f"IF TG_OP = 'INSERT' THEN {GROUP_CHAT_FANOUT.format(p='NEW')}; END IF;"
+    )
+    op.execute(
+        f"CREATE TRIGGER chat_messages_counters AFTER INSERT OR DELETE OR UPDATE OF {CHAT_COLUMNS} ON chat_messages "
+        f"FOR EACH ROW EXECUTE FUNCTION chat_messages_counters()"
+    )
+
+def _sqlite_trigger(name, event, table, statements):
+    op.execute(f"CREATE TRIGGER {name} AFTER {event} ON {table} BEGIN {'; '.join(statements)}; END")
+
+def _sqlite_triggers():
+    _sqlite_trigger("emails_counters_ai", "INSERT", "emails", _email_apply("new", 1))
+    _sqlite_trigger("emails_counters_ad", "DELETE", "emails", _email_apply("old", -1))
+    _sqlite_trigger("emails_counters_au", f"UPDATE OF {EMAIL_COLUMNS}", "emails",
+                    _email_apply("old", -1) + _email_apply("new", 1))
+    _sqlite_trigger("chat_messages_counters_ai", "INSERT", "chat_messages",
+                    [_private_chat_apply("new", 1), GROUP_CHAT_FANOUT.format(p="new")])
+    _sqlite_trigger("chat_messages_counters_ad", "DELETE", "chat_messages", [_private_chat_apply("old", -1)])
+    _sqlite_trigger("chat_messages_counters_au", f"UPDATE OF {CHAT_COLUMNS}", "chat_messages",
+                    [_private_chat_apply("old", -1), _private_chat_apply("new", 1)])
+
+def upgrade():
+    op.create_table(
+        "mailbox_counters",
+        sa.Column("user_id", sa.Integer(), primary_key=True),
+        sa.Column("folder", sa.String(), primary_key=True),
+        sa.Column("category", sa.String(), primary_key=True),
+        sa.Column("total", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("unread", sa.Integer(), nullable=False, server_default="0"),
+    )
+    op.create_table(
+        "chat_unread_counters",
+        sa.Column("user_id", sa.Integer(), primary_key=True),
+        sa.Column("kind", sa.String(), primary_key=True),
+        sa.Column("peer_id", sa.Integer(), primary_key=True),
+        sa.Column("unread", sa.Integer(), nullable=False, server_default="0"),
+    )
+    op.add_column("chat_group_members", sa.Column("last_read_message_id", sa.Integer(), nullable=True))
+
+    for user, folder, condition in EMAIL_FOLDERS:
+        op.execute(
+            f"INSERT INTO mailbox_counters (user_id, folder, category, total, unread) "
+            f"SELECT e.{user}, {folder.format(p='e')}, COALESCE(e.category, 'primary'), COUNT(*), "
+            f"SUM({UNREAD.format(p='e')}) FROM emails e "
+            f"WHERE e.{user} IS NOT NULL AND {condition.format(p='e')} GROUP BY 1, 2, 3" + EMAIL_UPSERT
+        )
+    op.execute(
+        "INSERT INTO chat_unread_counters (user_id, kind, peer_id, unread) "
+        "SELECT recipient_id, 'user', sender_id, COUNT(*) FROM chat_messages "
+        "WHERE recipient_id IS NOT NULL AND sender_id IS NOT NULL AND NOT COALESCE(is_read, FALSE) "
+        "GROUP BY recipient_id, sender_id"
+    )
+    op.execute(
+        "UPDATE chat_group_members SET last_read_message_id = "
+        "(SELECT MAX(id) FROM chat_messages WHERE chat_messages.group_id = chat_group_members.group_id)"
+    )
+
+    if op.get_bind().dialect.name == "postgresql":
+        _pg_triggers()
+    else:
+        _sqlite_triggers()
+
+def downgrade():
+    if op.get_bind().dialect.name == "postgresql":
+        for table in ("emails", "chat_messages"):
+            op.execute(f"DROP TRIGGER IF EXISTS {table}_counters ON {table}")
+            op.execute(f"DROP FUNCTION IF EXISTS {table}_counters()")
+    else:
+        for table in ("emails", "chat_messages"):
+            for suffix in ("ai", "ad", "au"):
+                op.execute(f"DROP TRIGGER IF EXISTS {table}_counters_{suffix}")
+    # Plain ALTER so SQLite does not rebuild the table
+    op.execute("ALTER TABLE chat_group_members DROP COLUMN last_read_message_id")
+    op.drop_table("chat_unread_counters")
+    op.drop_table("mailbox_counters")
@@ -0,0 +1,38 @@
+"""emails.priority NOT NULL
+
+Keyset pages compare (priority, created_at, id) as a row value, and a NULL
+priority makes the comparison NULL, so such rows fell between pages. Old rows
+get priority 0. SQLite cannot add NOT NULL without rebuilding the table (which
+would drop its FTS and counter triggers), so there triggers refuse a NULL
+instead.
+
+Revision ID: 0011
+Revises: 0010
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0011"
+down_revision = "0010"
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.execute("UPDATE emails SET priority = 0 WHERE priority IS NULL")
+    if op.get_bind().dialect.name == "postgresql":
+        op.alter_column("emails", "priority", existing_type=sa.Integer(), nullable=False, server_default="0")
+        return
+    for event in ("INSERT", "UPDATE OF priority"):
+        name = "emails_priority_not_null_" + event.split()[0].lower()
+        op.execute(
+            f"CREATE TRIGGER {name} BEFORE {event} ON emails WHEN NEW.priority IS NULL "
+            "BEGIN SELECT RAISE(ABORT, 'NOT NULL constraint failed: emails.priority'); END"
+        )
+
+def downgrade():
+    if op.get_bind().dialect.name == "postgresql":
+        op.alter_column("emails", "priority", existing_type=sa.Integer(), nullable=True, server_default=None)
+        return
+    op.execute("DROP TRIGGER IF EXISTS emails_priority_not_null_insert")
+    op.execute("DROP TRIGGER IF EXISTS emails_priority_not_null_update")
@@ -0,0 +1,31 @@
+"""fail held delivery jobs of scheduled emails trashed or deleted before sending
+
+Until now trashing or deleting a scheduled email left its outbox job
+"scheduled" forever. Such jobs fail, and trashed scheduled emails are stamped
+dispatched so restoring them does not send them (see scheduler.cancel).
+
+Revision ID: 0012
+Revises: 0011
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = "0012"
+down_revision = "0011"
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.execute(
+        "UPDATE outbound_emails SET status = 'failed', last_error = 'Cancelled before its send time'"
+        " WHERE status = 'scheduled' AND (email_id IS NULL"
+        " OR email_id IN (SELECT id FROM emails WHERE status <> 'sent'))"
+    )
+    op.execute(
+        "UPDATE emails SET dispatched_at = CURRENT_TIMESTAMP"
+        " WHERE scheduled_for IS NOT NULL AND dispatched_at IS NULL AND status <> 'sent'"
+    )
+
+def downgrade():
+    # The cancelled jobs cannot be told apart from ones that failed delivery
+    pass
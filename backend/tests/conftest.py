@@ -0,0 +1,33 @@
+"""
+Tests run against a throwaway SQLite database, migrated once per session.
+Settings are set here, before any test module imports app.
+"""
+import os
+import tempfile
+
+TEST_DIR = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{TEST_DIR}/tests.db"
+os.environ["BLOB_STORE_DIR"] = f"{TEST_DIR}/blobs"
+# Tests run outbox and scheduler batches themselves, not in background workers
+os.environ["OUTBOX_WORKERS"] = "0"
+os.environ["SCHEDULER_WORKERS"] = "0"
+
+import pytest
+from fastapi.testclient import TestClient
+from app.init_db import run_migrations
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    run_migrations()
+
+@pytest.fixture(scope="session")
+def client(database):
+    from app.main import app
+    with TestClient(app) as client:
+        yield client
+
+def login(client: TestClient, email: str) -> dict:
+    """Register a user (once) and return (auth headers, user id)"""
+    client.post("/api/register", json={"email": email, "full_name": email, "password": "secret"})
+    token = client.post("/api/token", json={"username": email, "password": "secret"}).json()
+    return {"Authorization": f"Bearer {token['access_token']}"}, token["user"]["id"]
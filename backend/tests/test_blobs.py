@@ -0,0 +1,66 @@
+"""
+The blob collector deletes only blobs still unreferenced when their rows go.
+"""
+import hashlib
+from datetime import timedelta
+from sqlalchemy import update
+from app import blobs, models
+from app.database import SessionLocal
+from app.outbox import utcnow
+
+def orphaned_blob(content: bytes) -> str:
+    """An unreferenced blob past its grace period, with its file"""
+    sha256 = hashlib.sha256(content).hexdigest()
+    path = blobs.blob_path(sha256)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    db = SessionLocal()
+    try:
+        db.add(models.Blob(sha256=sha256, size=len(content), refcount=0,
+                           orphaned_at=utcnow() - timedelta(seconds=blobs.settings.BLOB_GC_GRACE_SECONDS + 60)))
+        db.commit()
+    finally:
+        db.close()
+    return sha256
+
+def blob_row(sha256: str):
+    db = SessionLocal()
+    try:
+        return db.get(models.Blob, sha256)
+    finally:
+        db.close()
+
+class ReferencedAfterSelect:
+    """A session on which the blob gains a reference right after the collector's select"""
+
+    def __init__(self, db, sha256: str):
+        self.db = db
+        self.sha256 = sha256
+        self.selected = False
+
+    def execute(self, statement, *args, **kwargs):
+        result = self.db.execute(statement, *args, **kwargs)
+        if not self.selected:
+            self.selected = True
+            # What the refcount trigger does when an attachment is added
+            self.db.execute(update(models.Blob).where(models.Blob.sha256 == self.sha256).values(refcount=1))
+        return result
+
+    def commit(self):
+        self.db.commit()
+
+def test_collects_unreferenced_blob():
+    sha256 = orphaned_blob(b"nobody wants me")
+    assert blobs.collect_garbage() >= 1
+    assert blob_row(sha256) is None
+    assert not blobs.blob_path(sha256).exists()
+
+def test_keeps_blob_referenced_during_collection():
+    sha256 = orphaned_blob(b"wanted after all")
+    db = SessionLocal()
+    try:
+        blobs._collect_batch(ReferencedAfterSelect(db, sha256), 10)
+    finally:
+        db.close()
+    assert blob_row(sha256).refcount == 1
+    assert blobs.blob_path(sha256).exists()
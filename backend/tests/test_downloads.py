@@ -0,0 +1,19 @@
+"""
+Blobs served from the signed /blobs mount validate by content, like the download routes.
+"""
+import io
+import os
+from app import blobs, downloads
+
+def test_blob_etag_is_its_hash(client):
+    stored = blobs.store_file(io.BytesIO(b"same bytes, whenever written"))
+    url = downloads.signed_url(stored.path, "notes.txt", "text/plain")
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers["etag"] == f'"{stored.sha256}"'
+
+    # Rewritten or restored with the same content: still the same ETag
+    os.utime(stored.path, (1, 1))
+    assert client.get(url).headers["etag"] == f'"{stored.sha256}"'
+    assert client.get(url, headers={"If-None-Match": f'"{stored.sha256}"'}).status_code == 304
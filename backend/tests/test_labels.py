@@ -0,0 +1,44 @@
+"""
+Both label endpoints act on the same selection: the caller's own emails only.
+"""
+import pytest
+from app import models
+from app.database import SessionLocal
+from conftest import login
+
+@pytest.fixture(scope="module")
+def mailboxes(client):
+    headers, user_id = login(client, "labels@example.com")
+    _, other_id = login(client, "labels-other@example.com")
+    db = SessionLocal()
+    try:
+        mine = models.Email(subject="Mine", content="", sender_id=other_id, recipient_id=user_id, status="inbox")
+        theirs = models.Email(subject="Theirs", content="", sender_id=other_id, recipient_id=other_id, status="inbox")
+        db.add_all([mine, theirs])
+        db.commit()
+        return headers, mine.id, theirs.id
+    finally:
+        db.close()
+
+def labels_of(email_id: int):
+    db = SessionLocal()
+    try:
+        return sorted(row.label for row in db.query(models.EmailLabel).filter_by(email_id=email_id))
+    finally:
+        db.close()
+
+@pytest.mark.parametrize("path", ["/api/emails/labels", "/api/emails/bulk/labels"])
+def test_only_own_emails_are_labelled(client, mailboxes, path):
+    headers, mine, theirs = mailboxes
+    label = path.strip("/").replace("/", "-")
+    response = client.post(path, json={"email_ids": [mine, theirs], "add": [label]}, headers=headers)
+    assert response.status_code == 200
+    assert response.json()["updated"] == 1
+    assert label in labels_of(mine)
+    assert label not in labels_of(theirs)
+
+def test_legacy_endpoint_takes_a_folder(client, mailboxes):
+    headers, mine, _ = mailboxes
+    response = client.post("/api/emails/labels", json={"folder": "inbox", "add": ["inboxed"]}, headers=headers)
+    assert response.json() == {"message": "Labels updated successfully", "updated": 1}
+    assert "inboxed" in labels_of(mine)
@@ -0,0 +1,170 @@
+"""
+Outbox delivery against a local stand-in SMTP server.
+
+Runs claim -> send -> record_results (outbox.process_batch) on the test
+database and checks what ends up on each row. The stand-in accepts every
+recipient except those starting with "busy" (451, retried) or "reject" (550,
+final).
+
+    cd backend && python -m pytest -q tests
+"""
+import socketserver
+import threading
+from datetime import timedelta
+import pytest
+from app import models, outbox
+from app.config import get_settings
+from app.database import SessionLocal
+from app.email_utils import pool as smtp_pool
+
+settings = get_settings()
+
+class StandInSMTP(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib: EHLO, MAIL, RCPT, DATA, NOOP, RSET and QUIT"""
+    received = []
+
+    def reply(self, line: str):
+        self.wfile.write((line + "\r\n").encode())
+
+    def handle(self):
+        self.reply("220 stand-in")
+        data = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode().rstrip("\r\n")
+            if data is not None:
+                if line == ".":
+                    self.received.append("\n".join(data))
+                    data = None
+                    self.reply("250 queued")
+                else:
+                    data.append(line)
+                continue
+            command = line.upper()
+            if command.startswith("EHLO"):
+                self.reply("250-stand-in")
+                self.reply("250 PIPELINING")
+            elif command.startswith("RCPT TO:<BUSY"):
+                self.reply("451 try again later")
+            elif command.startswith("RCPT TO:<REJECT"):
+                self.reply("550 no such user")
+            elif command.startswith("DATA"):
+                data = []
+                self.reply("354 end with .")
+            elif command.startswith("QUIT"):
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 ok")
+
+@pytest.fixture(scope="module", autouse=True)
+def smtp_server(database):
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), StandInSMTP)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    saved = settings.SMTP_HOST, settings.SMTP_PORT, settings.SMTP_TLS, settings.SMTP_SSL
+    settings.SMTP_HOST, settings.SMTP_PORT = server.server_address
+    settings.SMTP_TLS = settings.SMTP_SSL = False
+    yield server
+    smtp_pool.close()
+    server.shutdown()
+    settings.SMTP_HOST, settings.SMTP_PORT, settings.SMTP_TLS, settings.SMTP_SSL = saved
+
+@pytest.fixture(autouse=True)
+def db():
+    StandInSMTP.received.clear()
+    session = SessionLocal()
+    session.query(models.OutboundEmail).delete()
+    session.commit()
+    yield session
+    session.close()
+
+def queue(db, *addresses, attempts=0):
+    jobs = [outbox.enqueue(db, address, "Hello", "<p>Hi</p>") for address in addresses]
+    for job in jobs:
+        job.attempts = attempts
+    db.commit()
+    return [job.id for job in jobs]
+
+def row(db, job_id) -> models.OutboundEmail:
+    db.expire_all()
+    return db.get(models.OutboundEmail, job_id)
+
+def test_sent(db):
+    job_id, = queue(db, "someone@example.com")
+    assert outbox.process_batch() == 1
+    job = row(db, job_id)
+    assert (job.status, job.attempts, job.last_error) == (outbox.SENT, 1, None)
+    assert job.sent_at is not None
+    assert len(StandInSMTP.received) == 1
+    assert outbox.process_batch() == 0
+
+def test_temporary_failure_is_retried(db):
+    job_id, = queue(db, "busy@example.com")
+    assert outbox.process_batch() == 1
+    job = row(db, job_id)
+    assert (job.status, job.attempts) == (outbox.QUEUED, 1)
+    assert "451" in job.last_error
+    # Backed off, so not due again yet
+    assert outbox.process_batch() == 0
+    assert StandInSMTP.received == []
+
+def test_permanent_failure(db):
+    job_id, = queue(db, "reject@example.com")
+    assert outbox.process_batch() == 1
+    job = row(db, job_id)
+    assert (job.status, job.attempts) == (outbox.FAILED, 1)
+    assert "550" in job.last_error
+
+def test_gives_up_after_max_attempts(db):
+    job_id, = queue(db, "busy@example.com", attempts=settings.OUTBOX_MAX_ATTEMPTS - 1)
+    assert outbox.process_batch() == 1
+    job = row(db, job_id)
+    assert (job.status, job.attempts) == (outbox.FAILED, settings.OUTBOX_MAX_ATTEMPTS)
+
+def test_batch_mixes_outcomes(db):
+    sent, retried, failed = queue(db, "someone@example.com", "busy@example.com", "reject@example.com")
+    assert outbox.process_batch() == 3
+    assert [row(db, job_id).status for job_id in (sent, retried, failed)] == [outbox.SENT, outbox.QUEUED, outbox.FAILED]
+    assert len(StandInSMTP.received) == 1
+
+def test_expired_claim_result_is_ignored(db):
+    job_id, = queue(db, "someone@example.com")
+    first, second = SessionLocal(), SessionLocal()
+    try:
+        stale = outbox.claim_batch(first, 10)
+        # The claim expires and another worker takes the row over
+        db.query(models.OutboundEmail).filter_by(id=job_id).update({"next_attempt_at": outbox.utcnow() - timedelta(seconds=1)})
+        db.commit()
+        current = outbox.claim_batch(second, 10)
+        assert [job.attempts for job in current] == [2]
+        outbox.record_results(first, stale, [None])
+        assert row(db, job_id).status == outbox.SENDING
+        outbox.record_results(second, current, [None])
+        assert row(db, job_id).status == outbox.SENT
+    finally:
+        first.close()
+        second.close()
+
+def test_concurrent_claims_do_not_overlap(db):
+    job_ids = queue(db, *(f"user{n}@example.com" for n in range(40)))
+    claims, barrier = [], threading.Barrier(4)
+
+    def claim():
+        session = SessionLocal()
+        try:
+            barrier.wait()
+            claims.append([job.id for job in outbox.claim_batch(session, len(job_ids))])
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=claim) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    claimed = [job_id for ids in claims for job_id in ids]
+    assert sorted(claimed) == sorted(job_ids)
+    assert all(row(db, job_id).attempts == 1 for job_id in job_ids)
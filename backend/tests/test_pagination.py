@@ -0,0 +1,55 @@
+"""
+Keyset pages of a folder: every email exactly once, whatever the page size.
+"""
+import pytest
+from sqlalchemy.exc import IntegrityError
+from app import models
+from app.database import SessionLocal
+from conftest import login
+
+@pytest.fixture(scope="module")
+def inbox(client):
+    headers, user_id = login(client, "pages@example.com")
+    db = SessionLocal()
+    try:
+        emails = [
+            models.Email(subject=f"Email {n}", content="", sender_id=user_id, recipient_id=user_id,
+                         status="inbox", priority=n % 3)
+            for n in range(11)
+        ]
+        db.add_all(emails)
+        db.commit()
+        return headers, sorted(email.id for email in emails)
+    finally:
+        db.close()
+
+@pytest.mark.parametrize("limit", [1, 3, 4, 11, 20])
+def test_pages_cover_the_folder(client, inbox, limit):
+    headers, ids = inbox
+    seen, cursor = [], ""
+    while cursor is not None:
+        response = client.get("/api/folders/inbox", params={"cursor": cursor, "limit": limit}, headers=headers)
+        assert response.status_code == 200
+        page = response.json()
+        assert len(page["items"]) <= limit
+        seen += [email["id"] for email in page["items"]]
+        cursor = page["next_cursor"]
+    assert sorted(seen) == ids
+
+@pytest.mark.parametrize("path", ["/api/folders/inbox", "/api/emails/inbox", "/api/emails/sent"])
+@pytest.mark.parametrize("limit", [0, -1, 100000])
+def test_out_of_range_limit_is_refused(client, inbox, path, limit):
+    headers, _ = inbox
+    response = client.get(path, params={"cursor": "", "limit": limit}, headers=headers)
+    assert response.status_code == 422
+
+def test_priority_is_required(inbox):
+    # A NULL would make the row-value comparison NULL and drop the row between pages
+    db = SessionLocal()
+    try:
+        with pytest.raises(IntegrityError):
+            db.execute(models.Email.__table__.insert().values(subject="No priority", status="inbox", priority=None))
+            db.commit()
+    finally:
+        db.rollback()
+        db.close()
@@ -0,0 +1,28 @@
+"""
+Room websockets through the app: what clients may put into a room.
+"""
+def meeting(client, room_id: str, user_id: str):
+    return client.websocket_connect(f"/ws/meeting/{room_id}?user_id={user_id}&user_name={user_id}")
+
+def next_event(ws) -> dict:
+    """The next message, past other participants joining"""
+    while True:
+        message = ws.receive_json()
+        if message["type"] != "user_joined":
+            return message
+
+def test_client_file_event_is_refused(client):
+    with meeting(client, "forged-file", "a") as a, meeting(client, "forged-file", "b") as b:
+        assert next_event(a)["type"] == "room_state"
+        assert next_event(b)["type"] == "room_state"
+        a.send_json({"type": "file", "user_id": "b", "file_data": {"filename": "invoice.pdf", "url": "https://example.com/x"}})
+        assert next_event(a) == {"type": "error", "message": "file is sent by the server only"}
+        a.send_json({"type": "chat", "content": "hello"})
+        # b joined last, so the chat is the first thing it gets unless the file got through
+        message = next_event(b)
+        assert (message["type"], message["content"]) == ("chat", "hello")
+
+        # Nor does it reach the history later joins get
+        with meeting(client, "forged-file", "c") as c:
+            state = next_event(c)
+            assert [message["type"] for message in state["data"]["messages"]] == ["chat"]
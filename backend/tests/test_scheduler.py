@@ -0,0 +1,83 @@
+"""
+Scheduled emails trashed or deleted before their send time are never sent.
+"""
+from datetime import datetime, timedelta
+import pytest
+from app import crud, models, outbox, scheduler
+from app.database import SessionLocal
+from conftest import login
+
+@pytest.fixture
+def scheduled(client):
+    """Schedule an email an hour out; returns (sender's headers, email id)"""
+    headers, _ = login(client, "scheduler@example.com")
+    login(client, "scheduled-recipient@example.com")
+    response = client.post("/api/emails", headers=headers, data={
+        "subject": "Later",
+        "content": "Sent in an hour",
+        "recipient_email": "scheduled-recipient@example.com",
+        "scheduled_for": (datetime.utcnow() + timedelta(hours=1)).isoformat()
+    })
+    assert response.status_code == 200
+    return headers, response.json()["id"]
+
+def job_for(email_id: int) -> models.OutboundEmail:
+    db = SessionLocal()
+    try:
+        return db.query(models.OutboundEmail).filter_by(email_id=email_id).one()
+    finally:
+        db.close()
+
+def make_due(email_id: int):
+    db = SessionLocal()
+    try:
+        db.query(models.Email).filter_by(id=email_id).update({"scheduled_for": datetime.utcnow() - timedelta(minutes=1)})
+        db.commit()
+    finally:
+        db.close()
+
+def dispatch() -> int:
+    db = SessionLocal()
+    try:
+        return scheduler.dispatch_batch(db, 100)
+    finally:
+        db.close()
+
+def test_trashed_before_send_time(client, scheduled):
+    headers, email_id = scheduled
+    assert job_for(email_id).status == outbox.SCHEDULED
+
+    assert client.put(f"/api/emails/{email_id}/status", json={"status": "trash"}, headers=headers).status_code == 200
+    job = job_for(email_id)
+    assert (job.status, job.last_error) == (outbox.FAILED, "Cancelled before its send time")
+
+    # Restored after its send time, it stays unsent
+    assert client.put(f"/api/emails/{email_id}/status", json={"status": "inbox"}, headers=headers).status_code == 200
+    make_due(email_id)
+    assert dispatch() == 0
+    assert job_for(email_id).status == outbox.FAILED
+
+def test_bulk_trashed_before_send_time(client, scheduled):
+    headers, email_id = scheduled
+    response = client.post("/api/emails/bulk/status", json={"email_ids": [email_id], "status": "trash"}, headers=headers)
+    assert response.json()["updated"] == 1
+    assert job_for(email_id).status == outbox.FAILED
+
+def test_deleted_before_send_time(scheduled):
+    _, email_id = scheduled
+    job_id = job_for(email_id).id
+    db = SessionLocal()
+    try:
+        deleted, _ = crud.bulk_delete(db, models.Email.id == email_id)
+        db.commit()
+        job = db.get(models.OutboundEmail, job_id)
+        assert deleted == [email_id]
+        assert (job.email_id, job.status) == (None, outbox.FAILED)
+    finally:
+        db.close()
+
+def test_dispatched_when_left_alone(client, scheduled):
+    _, email_id = scheduled
+    make_due(email_id)
+    assert dispatch() == 1
+    assert job_for(email_id).status == outbox.QUEUED
@@ -0,0 +1,25 @@
+"""
+Search snippets are HTML with matches in <mark>; the stored text in them is escaped.
+"""
+from app import models
+from app.database import SessionLocal
+from conftest import login
+
+def test_snippet_escapes_stored_html(client):
+    headers, user_id = login(client, "search@example.com")
+    db = SessionLocal()
+    try:
+        db.add(models.Email(
+            subject="Quarterly numbers", sender_id=user_id, recipient_id=user_id, status="inbox",
+            content='Invoice attached <script>alert("x")</script> <img src=x onerror=alert(1)> see invoice'
+        ))
+        db.commit()
+    finally:
+        db.close()
+
+    hits = client.get("/api/search/emails", params={"q": "invoice"}, headers=headers).json()
+    assert len(hits) == 1
+    snippet = hits[0]["snippet"]
+    assert "<mark>Invoice</mark>" in snippet
+    assert "&lt;script&gt;" in snippet and "&lt;img" in snippet
+    assert "<script" not in snippet and "<img" not in snippet
@@ -66,6 +66,9 @@ import EmojiPicker from 'emoji-picker-react';
 
 const API_URL = process.env.REACT_APP_API_URL || 'http://localhost:8000';
 
+// Prefer the signed URL the API mints for each file; it needs no auth header
+const chatFileUrl = (signedUrl, path) => signedUrl ? `${API_URL}${signedUrl}` : `${API_URL}/api/chat/files/${path}`;
+
 const REACTIONS = ['👍', '❤️', '😂', '😮', '😢', '😡'];
 
 const VideoCallDialog = ({ open, onClose, user, selectedUser }) => {
@@ -960,7 +963,7 @@ const Chat = () => {
               style={{ width: '250px' }}
             >
               <source 
-                src={`${API_URL}/api/chat/files/${message.voice_message_path}`} 
+                src={chatFileUrl(message.voice_message_url, message.voice_message_path)}
                 type="audio/webm;codecs=opus"
               />
               Your browser does not support the audio element.
@@ -982,7 +985,7 @@ const Chat = () => {
                   style={{ width: '250px' }}
                 >
                   <source 
-                    src={`${API_URL}/api/chat/files/${message.file_path}`}
+                    src={chatFileUrl(message.file_url, message.file_path)}
                     type={message.file_type}
                   />
                   Your browser does not support the audio element.
@@ -993,7 +996,7 @@ const Chat = () => {
               </>
             ) : (
               <Link
-                href={`${API_URL}/api/chat/files/${message.file_path}`}
+                href={chatFileUrl(message.file_url, message.file_path)}
                 target="_blank"
                 rel="noopener noreferrer"
                 sx={{ color: isOwn ? 'inherit' : 'primary.main', textDecoration: 'none' }}
@@ -1050,7 +1053,13 @@ const Chat = () => {
     }
   };
 
-  // Add this effect to update unread counts
+  // The open conversation, for the notification handler below
+  const openChatRef = useRef({ user: null, group: null });
+  useEffect(() => {
+    openChatRef.current = { user: selectedUser, group: selectedGroup };
+  }, [selectedUser, selectedGroup]);
+
+  // Unread counts and new messages arrive over the per-user notification channel
   useEffect(() => {
     const fetchUnreadCounts = async () => {
       try {
@@ -1064,9 +1073,66 @@ const Chat = () => {
       }
     };
 
-    fetchUnreadCounts();
-    const interval = setInterval(fetchUnreadCounts, 30000); // Update every 30 seconds
-    return () => clearInterval(interval);
+    const isOpen = (message) => {
+      const { user: openUser, group: openGroup } = openChatRef.current;
+      if (message.group_id) {
+        return openGroup?.id === message.group_id;
+      }
+      return openUser && [message.sender_id, message.recipient_id].includes(openUser.id);
+    };
+
+    let socket = null;
+    let retryTimer = null;
+    let stopped = false;
+
+    const connect = () => {
+      const token = localStorage.getItem('token');
+      // Sent as a subprotocol rather than in the URL, which proxies log
+      socket = new WebSocket(`${API_URL.replace('http', 'ws')}/ws/user`, ['bearer', token]);
+
+      // Catch up on anything missed while disconnected
+      socket.onopen = fetchUnreadCounts;
+
+      socket.onmessage = (event) => {
+        const data = JSON.parse(event.data);
+        if (data.type === 'chat_message') {
+          if (isOpen(data.message)) {
+            setMessages(prev => prev.some(m => m.id === data.message.id) ? prev : [...prev, data.message]);
+            if (data.message.sender_id !== user.id) {
+              markMessagesAsRead([data.message]);
+            }
+          } else if (data.message.sender_id !== user.id && !data.message.group_id) {
+            setUnreadCounts(prev => ({
+              ...prev,
+              [data.message.sender_id]: (prev[data.message.sender_id] || 0) + 1
+            }));
+          }
+        } else if (data.type === 'chat_reaction') {
+          setMessages(prev => prev.map(m =>
+            m.id === data.message_id ? { ...m, reactions: JSON.stringify(data.reactions) } : m
+          ));
+        } else if (data.type === 'chat_read') {
+          setMessages(prev => prev.map(m =>
+            data.message_ids.includes(m.id) ? { ...m, is_read: true } : m
+          ));
+        } else if (data.type === 'counters' && data.scope === 'chat') {
+          fetchUnreadCounts();
+        }
+      };
+
+      socket.onclose = () => {
+        if (!stopped) {
+          retryTimer = setTimeout(connect, 5000);
+        }
+      };
+    };
+
+    connect();
+    return () => {
+      stopped = true;
+      clearTimeout(retryTimer);
+      socket?.close();
+    };
   }, []);
 
   return (
@@ -65,7 +65,18 @@ const EmailDetail = () => {
     }
   };
 
-  const handleDownloadAttachment = async (attachmentId, filename) => {
+  const handleDownloadAttachment = async (attachment) => {
+    const { filename } = attachment;
+    if (attachment.download_url) {
+      // Signed URL: the browser downloads it directly, with range and cache support
+      const link = document.createElement('a');
+      link.href = `${API_URL}${attachment.download_url}`;
+      link.setAttribute('download', filename);
+      document.body.appendChild(link);
+      link.click();
+      link.remove();
+      return;
+    }
     try {
       const token = localStorage.getItem('token');
       const response = await axios.get(
@@ -332,7 +343,7 @@ const EmailDetail = () => {
                   secondary={`${(attachment.size / 1024).toFixed(1)} KB`}
                 />
                 <IconButton
-                  onClick={() => handleDownloadAttachment(attachment.id, attachment.filename)}
+                  onClick={() => handleDownloadAttachment(attachment)}
                   color="primary"
                 >
                   <Download />
@@ -39,6 +39,11 @@ import { useParams, useNavigate } from 'react-router-dom';
 
 const API_URL = process.env.REACT_APP_API_URL || 'http://localhost:8000';
 
+// Queued versions of these can overtake other events, so their seq is not a
+// safe point to resume from (see Room in backend/app/websocket.py)
+const COALESCED_EVENTS = ['media_state', 'typing', 'poll_update', 'file_progress'];
+const RECONNECT_DELAY_MS = 1000;
+
 const getWebSocketUrl = (roomId, user) => {
   const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
   const host = process.env.REACT_APP_API_URL?.replace(/^https?:\/\//, '') || 'localhost:8000';
@@ -72,6 +77,7 @@ const Meeting = () => {
   const localStream = useRef(null);
   const peerConnections = useRef({});
   const websocket = useRef(null);
+  const lastSeq = useRef(null);
   const messagesEndRef = useRef(null);
 
   const configuration = {
@@ -89,84 +95,101 @@ const Meeting = () => {
         await initializeStream();
 
         // Then set up the WebSocket connection
-        const wsUrl = `${API_URL.replace('http', 'ws')}/ws/meeting/${roomId}?user_id=${user.id}&user_name=${encodeURIComponent(user.full_name)}`;
-        websocket.current = new WebSocket(wsUrl);
-
-        websocket.current.onopen = () => {
-          console.log('Meeting WebSocket Connected');
-        };
-
-        websocket.current.onmessage = async (event) => {
-          const data = JSON.parse(event.data);
-          
-          switch (data.type) {
-            case 'room_state':
-              setParticipants(data.data.participants);
-              setMessages(data.data.messages);
-              // Initialize peer connections for existing participants
-              if (localStream.current) {
-                Object.keys(data.data.participants).forEach(participantId => {
-                  if (participantId !== user.id) {
-                    createPeerConnection(participantId);
-                  }
-                });
-              }
-              break;
-              
-            case 'user_joined':
-              setParticipants(prev => ({
-                ...prev,
-                [data.user.id]: data.user
-              }));
-              if (data.user.id !== user.id && localStream.current) {
-                createPeerConnection(data.user.id);
-              }
-              break;
-              
-            case 'user_left':
-              setParticipants(prev => {
-                const newParticipants = { ...prev };
-                delete newParticipants[data.user_id];
-                return newParticipants;
-              });
-              if (peerConnections.current[data.user_id]) {
-                peerConnections.current[data.user_id].close();
-                delete peerConnections.current[data.user_id];
-              }
-              break;
-              
-            case 'offer':
-              await handleOffer(data);
-              break;
-              
-            case 'answer':
-              await handleAnswer(data);
-              break;
-              
-            case 'ice-candidate':
-              await handleIceCandidate(data);
-              break;
-              
-            case 'media_state':
-              handleMediaStateUpdate(data);
-              break;
-              
-            case 'chat':
-              setMessages(prev => [...prev, data]);
-              break;
-          }
-        };
-
-        websocket.current.onclose = () => {
-          console.log('Meeting WebSocket Disconnected');
-          cleanup();
-        };
+        connectWebSocket();
       } catch (err) {
         console.error('Error setting up meeting:', err);
         setError('Failed to initialize meeting');
       }
     };
 
+    const connectWebSocket = () => {
+      // After a drop, only the events missed since lastSeq are sent again
+      const resume = lastSeq.current !== null ? `&last_seq=${lastSeq.current}` : '';
+      const wsUrl = `${API_URL.replace('http', 'ws')}/ws/meeting/${roomId}?user_id=${user.id}&user_name=${encodeURIComponent(user.full_name)}${resume}`;
+      const socket = new WebSocket(wsUrl);
+      websocket.current = socket;
+
+      socket.onopen = () => {
+        console.log('Meeting WebSocket Connected');
+      };
+
+      socket.onmessage = async (event) => {
+        const data = JSON.parse(event.data);
+        if (data.seq !== undefined && !COALESCED_EVENTS.includes(data.type)) {
+          lastSeq.current = data.seq;
+        }
+        
+        switch (data.type) {
+          case 'room_state':
+            setParticipants(data.data.participants);
+            setMessages(data.data.messages);
+            // Initialize peer connections for existing participants
+            if (localStream.current) {
+              Object.keys(data.data.participants).forEach(participantId => {
+                if (participantId !== user.id) {
+                  createPeerConnection(participantId);
+                }
+              });
+            }
+            break;
+            
+          case 'user_joined':
+            setParticipants(prev => ({
+              ...prev,
+              [data.user.id]: data.user
+            }));
+            if (data.user.id !== user.id && localStream.current) {
+              createPeerConnection(data.user.id);
+            }
+            break;
+            
+          case 'user_left':
+            setParticipants(prev => {
+              const newParticipants = { ...prev };
+              delete newParticipants[data.user_id];
+              return newParticipants;
+            });
+            if (peerConnections.current[data.user_id]) {
+              peerConnections.current[data.user_id].close();
+              delete peerConnections.current[data.user_id];
+            }
+            break;
+            
+          case 'offer':
+            await handleOffer(data);
+            break;
+            
+          case 'answer':
+            await handleAnswer(data);
+            break;
+            
+          case 'ice-candidate':
+            await handleIceCandidate(data);
+            break;
+            
+          case 'media_state':
+            handleMediaStateUpdate(data);
+            break;
+            
+          case 'chat':
+            setMessages(prev => [...prev, data]);
+            break;
+        }
+      };
+
+      socket.onclose = () => {
+        console.log('Meeting WebSocket Disconnected');
+        // cleanup() clears websocket.current first; anything else is a drop
+        if (websocket.current === socket) {
+          setTimeout(() => {
+            if (websocket.current === socket) {
+              connectWebSocket();
+            }
+          }, RECONNECT_DELAY_MS);
+        }
+      };
+    };
+
     setupMeeting();
 
     return () => cleanup();